@@ -1,22 +1,62 @@
-from flask import Flask, Response, request
+from flask import Flask, Response, g, request
 from dotenv import dotenv_values
-import pymonetdb
-import asyncio
-import json
-from sklearn import datasets
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
-import umap
+import hmac
+import multiprocessing
+import warnings
 import pandas as pd
 import numpy as np
-from model import Ensemble, Simulation, Variable, CellData
+from db.Model import get_pool
+from model import Variable, CellData, Grid
+from service import DimensionalReduction, Downsampling, EnsembleCube, FieldStore, GlobalEmbedding, JobManager, Metrics, ResultCache, SamplingProfiler, Serializer, SufficientStatistics
 from typing import Dict, List, Tuple
-from functools import lru_cache
+from functools import wraps
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Event, Lock, Thread
+import os
+import shutil
+import time
 
 app = Flask(__name__)
 
+default_envs = {
+    "SNAPSHOT_FILENAME": "ensemble-snapshot.npz",
+    "DR_CACHE_SIZE": 256,
+    "AGGREGATION_CACHE_SIZE": 256,
+    "EXPORT_CHUNK_SIZE": 1000,
+    "DR_MAX_WORKERS": 2,
+    "EMBEDDING_DIRECTORY": "embeddings",
+    "REFRESH_INTERVAL": 60,
+    "DR_WARMUP": "false",
+    "PROFILE_SLOW_REQUESTS": 0,
+    "PROFILE_INTERVAL": 0.01,
+    "FRAME_DTYPE": "float64",
+    "FRAME_STORAGE": "memory",
+    "FRAME_DIRECTORY": "frame-store",
+    "FRAME_CHUNK_MB": 64,
+    "PCA_CHUNK_ROWS": 100000,
+    "FIELD_MAX_CELLS": 10000,
+    "ADMIN_TOKEN": "",
+    "ADMIN_ALLOW_LOCAL": "false"
+}
+config = {
+    **default_envs,
+    **dotenv_values(".env")
+}
+
 # Constants
+INDEX_COLUMNS = EnsembleCube.INDEX_COLUMNS
 DR_METHODS = ['PCA', 'UMAP']
+CORRELATION_METHODS = ['pearson', 'spearman']
+AGGREGATION_STATISTICS = ['mean', 'median', 'std', 'min', 'max']
+DEFAULT_QUANTILES = [5.0, 25.0, 75.0, 95.0]
+STARTUP_RETRY_INTERVAL = 5
+FRAME_STORAGES = ['memory', 'mmap']
+LOCAL_ADDRESSES = ['127.0.0.1', '::1']
+STORE_BATCH_SIZE = 100000
+DR_PARAMETERS = {
+    'PCA': {'n_components': 2},
+    'UMAP': {}
+}
 BRAZILIAN_REGIONS = {
     'Norte': ['AC', 'AP', 'AM', 'PA', 'RO', 'RR', 'TO'],
     'Nordeste': ['AL', 'BA', 'CE', 'MA', 'PB', 'PE', 'PI', 'RN', 'SE'],
@@ -25,180 +65,1098 @@ BRAZILIAN_REGIONS = {
     'Sul': ['PR', 'RS', 'SC']
 }
 
+# Process pool for CPU-bound work, only created by the async serving mode
+compute_pool = None
+
+def use_compute_pool(max_workers: int):
+    """Sends dimensional reduction fits and correlation statistics to a process pool from now on"""
+    global compute_pool
+    if compute_pool is None and max_workers > 0:
+        # Spawned rather than forked, the server already runs threads when the pool is created
+        compute_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+def run_cpu_bound(function, *args):
+    """Runs a picklable function in the compute pool, or in the calling thread when there is no pool"""
+    if compute_pool is None:
+        return function(*args)
+    return compute_pool.submit(function, *args).result()
+
+class FrameVersion:
+    """One version of the ensemble cube, with the statistics derived from it
+
+    A version is never modified after it is built: refreshes build a new one and the manager swaps
+    it in, so a request that holds a version reads the same cube until it ends.
+    """
+    def __init__(self, dataset_version: Tuple, cube: EnsembleCube.EnsembleCube, statistics: Dict = None):
+        self.dataset_version = tuple(dataset_version)
+        self.fingerprint = ':'.join(str(item) for item in self.dataset_version)
+        self.cell_count = int(self.dataset_version[0])
+        self.cube = cube
+        self.timesteps = cube.timesteps
+        self.statistics = dict(statistics or {})
+        # Builds in progress by timestep, so each timestep is computed once without holding the lock
+        self._pending_statistics = {}
+        self._statistics_lock = Lock()
+
+    def get_timestep_rows(self, timestep: float, simulations: np.ndarray = None) -> np.ndarray:
+        """Returns the indices of the simulations with data at a timestep, among the selected ones"""
+        present = self.cube.present[:, self.cube.time_index[timestep]]
+        return np.flatnonzero(present if simulations is None else present & simulations)
+
+    def read_timestep(self, rows: np.ndarray, timestep: float) -> np.ndarray:
+        """Returns the float64 matrix of the variables of some simulations at a timestep"""
+        return self.cube.values[rows, self.cube.time_index[timestep]].astype(np.float64)
+
+    def get_statistics(self, timestep: float) -> SufficientStatistics.SufficientStatistics:
+        """Returns the sufficient statistics of a timestep, computing them on first use
+
+        Requests for a timestep being computed wait for that build, other timesteps are not blocked.
+        """
+        with self._statistics_lock:
+            statistics = self.statistics.get(timestep)
+            if statistics is not None:
+                return statistics
+            pending = self._pending_statistics.get(timestep)
+            if pending is None:
+                future = self._pending_statistics[timestep] = Future()
+        if pending is not None:
+            return pending.result()
+
+        try:
+            rows = self.get_timestep_rows(timestep)
+            statistics = run_cpu_bound(
+                SufficientStatistics.SufficientStatistics,
+                self.cube.ensembles_of(rows),
+                self.cube.names[rows],
+                self.read_timestep(rows, timestep)
+            )
+        except BaseException as e:
+            # A failed build is not kept, the next request tries again
+            with self._statistics_lock:
+                del self._pending_statistics[timestep]
+            future.set_exception(e)
+            raise
+        with self._statistics_lock:
+            self.statistics[timestep] = statistics
+            del self._pending_statistics[timestep]
+        future.set_result(statistics)
+        return statistics
+
 class DataFrameManager:
-    def __init__(self):
-        self.ensemble_df = self._create_dataframe_all_ensembles()
+    def __init__(self, snapshot_filename=None, dtype=None):
+        self.snapshot_filename = config["SNAPSHOT_FILENAME"] if snapshot_filename is None else snapshot_filename
+        self.dtype = config["FRAME_DTYPE"] if dtype is None else dtype
+        if self.dtype not in EnsembleCube.DTYPES:
+            raise Exception("Frame dtype %s not yet implemented" % self.dtype)
+        self.storage = config["FRAME_STORAGE"]
+        if self.storage not in FRAME_STORAGES:
+            raise Exception("Frame storage %s not yet implemented" % self.storage)
+        self.directory = config["FRAME_DIRECTORY"]
+        self.chunk_bytes = int(float(config["FRAME_CHUNK_MB"]) * 2 ** 20)
+        self.dr_cache = ResultCache.ResultCache(int(config["DR_CACHE_SIZE"]))
+        self.aggregation_cache = ResultCache.ResultCache(int(config["AGGREGATION_CACHE_SIZE"]))
+        self.embeddings = {}
+        self._embedding_lock = Lock()
+        self.current = None
+        self.refresh_status = {"refreshing": False, "last_refresh": None, "error": None}
+        self.ready = Event()
+        self._refresh_lock = Lock()
+        self._background_thread = None
+
+    def reload(self):
+        """Builds the first frame from the snapshot, or the database if the snapshot is stale, and swaps it in"""
+        with self._refresh_lock:
+            self._refresh(full=True, use_snapshot=True)
+
+    def refresh(self, full: bool = False) -> bool:
+        """Swaps in a new version if the dataset changed, fetching only the new cells when possible
+
+        Returns False without waiting when another refresh is running.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            self._refresh(full)
+            return True
+        finally:
+            self._refresh_lock.release()
+
+    def refresh_in_background(self, full: bool = False) -> bool:
+        """Starts a refresh in a thread, returning False if one is already running
+
+        The lock is taken here and released by the thread, so a refresh reported as started always runs.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+
+        def run():
+            try:
+                self._refresh(full)
+            finally:
+                self._refresh_lock.release()
+
+        Thread(target=run, daemon=True).start()
+        return True
+
+    def start(self, interval: float):
+        """Builds the first version in a daemon thread, then checks for new data every interval seconds
+
+        Until the first version is swapped in, current is None. A failed build is retried, so the
+        worker becomes ready as soon as the database can be reached. An interval of 0 disables polling.
+        """
+        if self._background_thread is not None:
+            return
+
+        def run():
+            while self.current is None:
+                try:
+                    self.reload()
+                except Exception:
+                    time.sleep(STARTUP_RETRY_INTERVAL)
+            while interval > 0:
+                time.sleep(interval)
+                self.refresh()
+
+        self._background_thread = Thread(target=run, daemon=True)
+        self._background_thread.start()
+
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        """Blocks until the first version is swapped in, returning False if the timeout expires first"""
+        return self.ready.wait(timeout)
+
+    def _refresh(self, full: bool, use_snapshot: bool = False):
+        """Builds and swaps in a new version, recording how it went in refresh_status
+
+        A full refresh rebuilds the cube from the database, unless use_snapshot lets the startup
+        build read the snapshot (or the stored files with the mmap storage) of the same dataset version.
+        """
+        started_at = time.perf_counter()
+        self.refresh_status["refreshing"] = True
+        try:
+            dataset_version = CellData.CellData().get_fingerprint()
+            previous = self.current
+            if previous is not None and not full and tuple(dataset_version) == previous.dataset_version:
+                self.refresh_status["error"] = None
+                return
+            version, mode = self._build_version(dataset_version, None if full else previous, use_snapshot)
+            Metrics.observe("frame.build." + mode, time.perf_counter() - started_at)
+            self.current = version
+            self.ready.set()
+            # Results of the previous version are keyed by its fingerprint and can never be hit again
+            self.dr_cache.clear()
+            self.aggregation_cache.clear()
+            self.refresh_status["last_refresh"] = {
+                "mode": mode,
+                "fingerprint": version.fingerprint,
+                "seconds": round(time.perf_counter() - started_at, 3),
+                "finished_at": time.time()
+            }
+            self.refresh_status["error"] = None
+        except Exception as e:
+            Metrics.increment("frame.build.errors")
+            self.refresh_status["error"] = str(e)
+            if self.current is None:
+                raise
+        finally:
+            self.refresh_status["refreshing"] = False
+
+    def _build_version(self, dataset_version: Tuple, previous: FrameVersion = None, use_snapshot: bool = False) -> Tuple[FrameVersion, str]:
+        """Builds the cube of a dataset version, returning it with how it was built
+
+        With a previous version, only the cells of new timesteps, simulations and variables are
+        fetched and merged into its cube, and the statistics of untouched timesteps are kept. When
+        the merged cells do not add up to the new cell count, or the dataset version shows that
+        simulations moved to other ensembles or the tables were loaded again, some existing cells
+        changed and the cube is built from scratch.
 
-    def _fetch_model_data(self) -> Tuple[Dict, Dict, List]:
-        ensemble_model = Ensemble.Ensemble()
-        simulation_model = Simulation.Simulation()
-        variable_model = Variable.Variable()
-        cell_data_model = CellData.CellData()
+        With the mmap storage, the cube lives in files and every new dataset version is written to
+        new files, see _build_store.
+        """
+        if self.storage == 'mmap':
+            return self._build_store(dataset_version, use_snapshot)
+        fingerprint = ':'.join(str(item) for item in dataset_version)
+        if previous is None and use_snapshot:
+            cube = self._load_snapshot(fingerprint)
+            if cube is not None:
+                return FrameVersion(dataset_version, cube), 'snapshot'
+        elif previous is not None and None not in previous.dataset_version and self._only_grew(dataset_version, previous):
+            cells = CellData.CellData().get_celldata_after(*previous.dataset_version[1:4])
+            if previous.cell_count + len(cells) == int(dataset_version[0]):
+                version = self._merge_cells(dataset_version, previous, cells)
+                self._write_snapshot(version)
+                return version, 'delta'
 
-        # Get variables
-        variable_records = dict(variable_model.read_all())
+        version = FrameVersion(dataset_version, self._create_cube_all_ensembles())
+        self._write_snapshot(version)
+        return version, 'full'
 
-        # Get ensembles
-        ensemble_records = dict(ensemble_model.read_all())
+    def _only_grew(self, dataset_version: Tuple, previous: FrameVersion) -> bool:
+        """Checks that the tables were not loaded again and that no simulation of the previous version moved to another ensemble"""
+        _, _, simulation_id, _, ensembles, first_load = previous.dataset_version
+        return first_load == dataset_version[5] and CellData.CellData().get_ensemble_checksum(simulation_id) == ensembles
 
-        # Get simulations
-        simulation_records = simulation_model.read_all()
-        simulation_list = [
-            (item[0], item[1], ensemble_records[item[2]])
-            for item in simulation_records
-        ]
+    def _build_store(self, dataset_version: Tuple, use_existing: bool = False) -> Tuple[FrameVersion, str]:
+        """Opens the memory-mapped cube of a dataset version, streaming it from the database into files first if needed
 
-        return variable_records, dict((x, [y, z]) for x, y, z in simulation_list), cell_data_model
+        Cells are fetched and written in batches, so building never holds more than one batch and
+        one chunk of the cube in memory. The files of other versions are removed once the new ones
+        are complete: requests still reading them keep their mappings until they end. Existing files
+        of the same version are only reused with use_existing, otherwise they are written again.
+        """
+        fingerprint = ':'.join(str(item) for item in dataset_version)
+        directory = os.path.join(self.directory, fingerprint.replace(':', '_'))
+        mode = 'store'
+        if not (use_existing and os.path.isdir(directory)):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_directory = '%s.%d.tmp' % (directory, os.getpid())
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            variable_names = [record[1] for record in Variable.Variable().read_all()]
+            cell_data = CellData.CellData()
+            with Metrics.timer("frame.query"):
+                simulations = cell_data.get_simulations()
+                timesteps = [record[0] for record in cell_data.get_timesteps()]
+            cube = EnsembleCube.EnsembleCube.create_store(tmp_directory, simulations, timesteps, variable_names, self.dtype, self.chunk_bytes)
+            with Metrics.timer("frame.pivot"):
+                for cells in cell_data.iter_celldata_all_simulations(STORE_BATCH_SIZE):
+                    cube.scatter(cells)
+                cube.finish(self.chunk_bytes)
+            del cube
+            if not use_existing:
+                shutil.rmtree(directory, ignore_errors=True)
+            try:
+                os.rename(tmp_directory, directory)
+                mode = 'full'
+            except OSError:
+                # Another worker sharing the directory stored this version first
+                shutil.rmtree(tmp_directory, ignore_errors=True)
 
-    def _create_dataframe_all_ensembles(self) -> pd.DataFrame:
-        variable_records, simulation_records, cell_data_model = self._fetch_model_data()
+        for name in os.listdir(self.directory):
+            if name != os.path.basename(directory) and not name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return FrameVersion(dataset_version, EnsembleCube.EnsembleCube.open_store(directory)), mode
 
-        # Create column list
-        df_columns = ['ensemble', 'name', 'time'] + list(variable_records.values())
+    def _merge_cells(self, dataset_version: Tuple, previous: FrameVersion, cells: List) -> FrameVersion:
+        """Adds new cells to the cube of the previous version"""
+        variable_names = [record[1] for record in Variable.Variable().read_all()]
+        delta = self._pivot_cells(cells, variable_names)
+        cube = previous.cube.merge(delta, variable_names)
 
-        # Get timesteps - Fix for tuple return type
-        timesteps = [float(ts[0]) for ts in cell_data_model.get_timesteps()]
+        # A new variable adds a column to every timestep, otherwise only the timesteps of the new cells change
+        statistics = {}
+        if previous.cube.variables == variable_names:
+            changed = set(delta.timesteps.tolist())
+            statistics = {t: s for t, s in previous.statistics.items() if t not in changed}
+        version = FrameVersion(dataset_version, cube, statistics)
+        for timestep in previous.statistics:
+            if timestep in cube.time_index:
+                version.get_statistics(timestep)
+        return version
 
-        # Initialize data array
-        row_size = len(simulation_records) * len(timesteps)
-        data = np.zeros((row_size, len(df_columns)), dtype=object)
+    def _load_snapshot(self, fingerprint: str):
+        """Returns the cube stored in the snapshot, or None if it is missing, from another dataset version or in another layout"""
+        if not self.snapshot_filename or not os.path.exists(self.snapshot_filename):
+            return None
+        with np.load(self.snapshot_filename) as snapshot:
+            if str(snapshot['fingerprint']) != fingerprint or 'present' not in snapshot.files:
+                return None
+            cube = EnsembleCube.EnsembleCube.from_arrays(snapshot)
+        if cube.values.dtype != np.dtype(self.dtype):
+            cube.values = cube.values.astype(self.dtype)
+        return cube
 
-        # Fill data array
-        for row_idx, (sim_name, sim_data) in enumerate(simulation_records.items()):
-            base_idx = row_idx * len(timesteps)
-            for t_idx, timestep in enumerate(timesteps):
-                curr_idx = base_idx + t_idx
+    def _write_snapshot(self, version: FrameVersion):
+        """Stores the arrays of the cube uncompressed, replacing the previous snapshot atomically"""
+        if not self.snapshot_filename:
+            return
+        tmp_filename = self.snapshot_filename + '.tmp'
+        with open(tmp_filename, 'wb') as snapshot_file:
+            np.savez(snapshot_file, fingerprint=np.array(version.fingerprint), **version.cube.to_arrays())
+        os.replace(tmp_filename, self.snapshot_filename)
 
-                # Fill basic information
-                data[curr_idx, 0] = sim_data[1]  # ensemble
-                data[curr_idx, 1] = sim_data[0]  # name
-                data[curr_idx, 2] = timestep     # time
+    def _create_cube_all_ensembles(self) -> EnsembleCube.EnsembleCube:
+        variable_names = [record[1] for record in Variable.Variable().read_all()]
 
-                # Fill variable data
-                result = cell_data_model.get_celldata_all_variables(sim_data[0], timestep)
-                for cell_data in result:
-                    col_idx = df_columns.index(cell_data[2])
-                    data[curr_idx, col_idx] = float(cell_data[4])
+        # Fetch every value in one query, one row per (ensemble, name, variable, time)
+        with Metrics.timer("frame.query"):
+            cells = CellData.CellData().get_celldata_all_simulations()
+        return self._pivot_cells(cells, variable_names)
 
-        return pd.DataFrame(data=data, columns=df_columns)
+    def _pivot_cells(self, cells: List, variable_names: List[str]) -> EnsembleCube.EnsembleCube:
+        # Scatter the values into a (simulation, time, variable) array
+        with Metrics.timer("frame.pivot"):
+            return EnsembleCube.EnsembleCube.from_cells(cells, variable_names, self.dtype)
 
-# Initialize DataFrameManager
+    def get_global_embedding(self, method: str, timestep: float, frame: FrameVersion) -> GlobalEmbedding.GlobalEmbedding:
+        """Returns the embedding fitted on all simulations of a timestep, fitting it only once per dataset
+
+        Embeddings are persisted in EMBEDDING_DIRECTORY. When the dataset version changed since the
+        fit, the simulations are projected with the fitted reducer instead of refitting it. Values
+        are only read when a fit or a projection is needed, and it runs outside the lock: the new
+        embedding replaces the old one, which requests may still be reading.
+        """
+        key = (method, timestep)
+        filename = None
+        if config["EMBEDDING_DIRECTORY"]:
+            os.makedirs(config["EMBEDDING_DIRECTORY"], exist_ok=True)
+            filename = os.path.join(config["EMBEDDING_DIRECTORY"], '%s-%s.pkl' % (method, timestep))
+
+        with self._embedding_lock:
+            embedding = self.embeddings.get(key)
+        if embedding is None and filename:
+            embedding = GlobalEmbedding.GlobalEmbedding.load(filename)
+        if embedding is not None and embedding.fingerprint == frame.fingerprint:
+            with self._embedding_lock:
+                self.embeddings.setdefault(key, embedding)
+            return embedding
+
+        rows = frame.get_timestep_rows(timestep)
+        names = frame.cube.names[rows].tolist()
+        data = frame.read_timestep(rows, timestep)
+        if embedding is None or embedding.parameters != DR_PARAMETERS[method] or not embedding.can_update(data):
+            embedding = run_cpu_bound(GlobalEmbedding.GlobalEmbedding, method, DR_PARAMETERS[method], frame.fingerprint, names, data)
+        else:
+            embedding = embedding.update(frame.fingerprint, names, data)
+
+        with self._embedding_lock:
+            # A concurrent request may have swapped in the embedding of this version first
+            current = self.embeddings.get(key)
+            if current is not None and current.fingerprint == frame.fingerprint:
+                return current
+            self.embeddings[key] = embedding
+        if filename:
+            embedding.save(filename)
+        return embedding
+
+# Initialize DataFrameManager, building the frame off the import path
 df_manager = DataFrameManager()
+# Spawned pool workers import this module as __mp_main__ when it is run as a script, they serve no requests
+if __name__ != '__mp_main__':
+    df_manager.start(float(config["REFRESH_INTERVAL"]))
+dr_jobs = JobManager.JobManager(max_workers=int(config["DR_MAX_WORKERS"]))
+dr_warmed_up = Event()
+# Open field stores by grid name, with the id of the grid record they were opened for
+field_stores = {}
+field_store_lock = Lock()
+
+def _warm_up_dr():
+    """Compiles the dimensional reduction kernels before the first request needs them"""
+    try:
+        DimensionalReduction.warm_up()
+    finally:
+        dr_warmed_up.set()
+
+if str(config["DR_WARMUP"]).lower() in ('true', '1') and __name__ != '__mp_main__':
+    # The numba thread pool hangs the interpreter at exit when it is first started outside the main thread
+    import numba
+    numba.get_num_threads()
+    Thread(target=_warm_up_dr, daemon=True).start()
+else:
+    dr_warmed_up.set()
+
+# Opt-in profiler, keeping the stacks of the requests slower than PROFILE_SLOW_REQUESTS seconds
+profiler = None
+if float(config["PROFILE_SLOW_REQUESTS"]) > 0:
+    profiler = SamplingProfiler.SamplingProfiler(float(config["PROFILE_SLOW_REQUESTS"]), float(config["PROFILE_INTERVAL"]))
 
-def create_cors_response(data, status_code=200):
+@app.before_request
+def start_request_metrics():
+    """Starts timing the request and its stages"""
+    g.started_at = time.perf_counter()
+    Metrics.start_request()
+    if profiler is not None:
+        profiler.begin()
+
+@app.after_request
+def add_request_metrics(resp):
+    """Records the latency of the route and sends the duration of each stage in the Server-Timing header
+
+    Streamed responses are timed until the first chunk, the rest is sent after this hook.
+    """
+    seconds = time.perf_counter() - g.started_at
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    Metrics.observe("request." + route, seconds)
+    Metrics.increment("responses.%s.%d" % (route, resp.status_code))
+    stages = Metrics.end_request()
+    stages['total'] = seconds
+    resp.headers['Server-Timing'] = Metrics.server_timing(stages)
+    resp.headers['Timing-Allow-Origin'] = '*'
+    return resp
+
+@app.teardown_request
+def end_request_metrics(error=None):
+    """Stops the stage timing and the profiler, also when the route raised an exception"""
+    Metrics.end_request()
+    if profiler is not None:
+        profiler.end("%s %s" % (request.method, request.full_path.rstrip('?')))
+
+def create_cors_response(data, status_code=200, mimetype="application/json"):
     """Helper function to create CORS-enabled responses"""
+    if isinstance(data, (dict, list)):
+        with Metrics.stage('serialize'):
+            data = Serializer.dumps_json(data)
     resp = Response(
-        response=json.dumps(data) if isinstance(data, (dict, list)) else data,
+        response=data,
         status=status_code,
-        mimetype="application/json"
+        mimetype=mimetype
     )
     resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
+def create_data_response(table: pd.DataFrame, json_payload, status_code=200):
+    """Creates a CORS-enabled response in the format chosen by the format parameter or the Accept header
+
+    JSON responses keep the layout of each endpoint, built from the table by json_payload, while
+    arrow and binary responses send the table itself as typed columns.
+    """
+    format_name = Serializer.negotiate_format(request.args.get('format'), request.accept_mimetypes)
+    dtype = request.args.get('dtype', default='float64', type=str)
+    if format_name is None:
+        return create_cors_response({"error": "Unsupported format", "formats": Serializer.available_formats()}, 406)
+    if dtype not in Serializer.DTYPES:
+        return create_cors_response({"error": "Invalid dtype"}, 400)
+
+    if format_name == 'json':
+        with Metrics.stage('group'):
+            payload = json_payload(table)
+        resp = create_cors_response(payload, status_code)
+    else:
+        with Metrics.stage('serialize'):
+            body, mimetype = Serializer.serialize_table(table, format_name, dtype)
+        resp = create_cors_response(body, status_code, mimetype)
+    resp.headers['Vary'] = 'Accept'
+    return resp
+
+def requires_frame(route):
+    """Answers 503 on a data route while the first version of the frame is being built"""
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        if df_manager.current is None:
+            resp = create_cors_response({"error": "Data is not loaded yet"}, 503)
+            resp.headers['Retry-After'] = str(STARTUP_RETRY_INTERVAL)
+            return resp
+        return route(*args, **kwargs)
+    return wrapper
+
+def _float_args(name: str) -> List[float]:
+    """Reads every value of a query parameter as a float, raising ValueError if one is not a finite number"""
+    values = [float(value) for value in request.args.getlist(name)]
+    if not np.all(np.isfinite(values)):
+        raise ValueError("%s is not a finite number" % name)
+    return values
+
+def _float_arg(name: str) -> float:
+    """Reads a query parameter as a float, None if it is absent, raising ValueError if it is not a finite number"""
+    values = _float_args(name)
+    return values[0] if values else None
+
+def _parse_timestep(frame: FrameVersion):
+    """Reads the time query parameter, defaulting to the last timestep, or None if it is invalid or has no data"""
+    try:
+        timestep = _float_arg('time')
+    except ValueError:
+        return None
+    if timestep is None:
+        return float(frame.timesteps[-1]) if len(frame.timesteps) else None
+    return timestep if timestep in frame.cube.time_index else None
+
+def _exceeds_memory(row_count: int, variable_count: int) -> bool:
+    """Tells whether a table built in memory would be larger than a read chunk of a memory-mapped cube"""
+    return df_manager.storage == 'mmap' and row_count * variable_count * 8 > df_manager.chunk_bytes
+
 @app.route('/')
+@requires_frame
 def hello():
-    return create_cors_response(df_manager.ensemble_df.to_json(orient='index'))
+    frame = df_manager.current
+    format_name = request.args.get('format', default='', type=str)
+    if not format_name:
+        format_name = next((name for name, mimetype in Serializer.STREAM_FORMATS.items()
+                            if request.accept_mimetypes.best == mimetype), '')
+    if format_name not in Serializer.STREAM_FORMATS:
+        # A memory-mapped cube is only sent whole by the streamed formats
+        if _exceeds_memory(int(np.count_nonzero(frame.cube.present)), len(frame.cube.variables)):
+            return create_cors_response({"error": "Response too large, stream it with format=%s" % "|".join(Serializer.STREAM_FORMATS)}, 413)
+        return create_data_response(frame.cube.to_frame(), lambda df: df.to_json(orient='index'))
+
+    # Streaming export, filtered chunk by chunk
+    ensemble_list = request.args.getlist('ensemble')
+    simulation_list = request.args.getlist('simulation')
+    variable_list = request.args.getlist('variable')
+    chunk_size = request.args.get('chunk_size', default=int(config["EXPORT_CHUNK_SIZE"]), type=int)
+    try:
+        time_from = _float_arg('time_from')
+        time_to = _float_arg('time_to')
+    except ValueError:
+        return create_cors_response({"error": "Invalid time_from or time_to"}, 400)
+    if any(variable not in frame.cube.variables for variable in variable_list):
+        return create_cors_response({"error": "Invalid variable"}, 400)
+    if chunk_size <= 0:
+        return create_cors_response({"error": "Invalid chunk_size"}, 400)
+
+    # Only the rows of one chunk are taken out of the cube at a time
+    variables = variable_list or frame.cube.variables
+    frames = frame.cube.iter_frames(
+        frame.cube.select(ensemble_list, simulation_list),
+        frame.cube.time_slice(time_from, time_to),
+        variables,
+        chunk_size
+    )
+    return create_cors_response(
+        Serializer.iter_frame_chunks(frames, format_name, INDEX_COLUMNS + list(variables)),
+        mimetype=Serializer.STREAM_FORMATS[format_name]
+    )
 
 @app.route('/list-ensembles')
+@requires_frame
 def list_ensembles():
-    df = df_manager.ensemble_df[df_manager.ensemble_df['time'] == 2023][['ensemble', 'name']]
-    grouped = df.groupby('ensemble')['name'].apply(lambda x: x.values.tolist())
-    return create_cors_response(grouped.to_json(orient='index'))
+    frame = df_manager.current
+    timestep = _parse_timestep(frame)
+    if timestep is None:
+        return create_cors_response({"error": "Invalid time"}, 400)
+    rows = frame.get_timestep_rows(timestep)
+    with Metrics.stage('group'):
+        grouped = {}
+        for ensemble_name, name in zip(frame.cube.ensembles_of(rows), frame.cube.names[rows]):
+            grouped.setdefault(ensemble_name, []).append(name)
+    return create_cors_response(dict(sorted(grouped.items())))
+
+@app.route('/ready')
+def readiness():
+    frame_ready = df_manager.current is not None
+    ready = frame_ready and dr_warmed_up.is_set()
+    return create_cors_response({
+        "ready": ready,
+        "frame": frame_ready,
+        "dr_warm_up": dr_warmed_up.is_set(),
+        "error": df_manager.refresh_status["error"]
+    }, 200 if ready else 503)
 
 @app.route('/dr-methods')
 def list_dr_methods():
     return create_cors_response(DR_METHODS)
 
 @app.route('/variables')
+@requires_frame
 def list_variables():
-    columns = [col for col in df_manager.ensemble_df.columns
-              if col not in ('ensemble', 'time', 'name')]
-    return create_cors_response(columns)
+    return create_cors_response(df_manager.current.cube.variables)
 
-@app.route('/dimensional-reduction')
-def get_ensemble_dr():
+def _filter_dr_data(frame: FrameVersion, ensemble_list: List[str], simulation_list: List[str], timestep: float) -> Tuple[pd.DataFrame, np.ndarray]:
+    with Metrics.stage('filter'):
+        # Select the simulations of the timestep, their values are read by the caller
+        rows = frame.get_timestep_rows(timestep, frame.cube.select(ensemble_list, simulation_list))
+        identifiers = pd.DataFrame({
+            'ensemble': frame.cube.ensembles_of(rows),
+            'time': np.full(len(rows), timestep),
+            'name': frame.cube.names[rows]
+        })
+        return identifiers, rows
+
+def _format_dr_result(identifiers: pd.DataFrame, reduced_data: np.ndarray) -> pd.DataFrame:
+    return pd.concat([
+        identifiers,
+        pd.DataFrame(reduced_data, columns=['x', 'y'], index=identifiers.index)
+    ], axis=1).reset_index(drop=True)
+
+def _group_dr_records(result_df: pd.DataFrame) -> Dict:
+    records = result_df[['name', 'x', 'y']].to_dict('records')
+    grouped = {}
+    for ensemble_name, record in zip(result_df['ensemble'], records):
+        grouped.setdefault(ensemble_name, []).append(record)
+    return grouped
+
+def _parse_dr_request(frame: FrameVersion) -> Tuple[str, List[str], List[str], float, Tuple]:
     method = request.args.get('method', default="PCA", type=str)
     ensemble_list = request.args.getlist('ensemble')
     simulation_list = request.args.getlist('simulation')
+    timestep = _parse_timestep(frame)
+    cache_key = (
+        method,
+        tuple(sorted(ensemble_list)),
+        tuple(sorted(simulation_list)),
+        timestep,
+        tuple(sorted(DR_PARAMETERS.get(method, {}).items())),
+        frame.fingerprint
+    )
+    return method, ensemble_list, simulation_list, timestep, cache_key
 
-    # Filter data
-    df = df_manager.ensemble_df[df_manager.ensemble_df['time'] == 2023]
-    if ensemble_list:
-        df = df[df['ensemble'].isin(ensemble_list)]
-    if simulation_list:
-        df = df[df['name'].isin(simulation_list)]
-
-    # Prepare data
-    identifiers = df[['ensemble', 'time', 'name']]
-    data = df.drop(columns=['ensemble', 'time', 'name'])
-    scaled_data = StandardScaler().fit_transform(data)
-
-    # Apply dimensional reduction
-    if method == "PCA":
-        reduced_data = PCA(n_components=2).fit_transform(scaled_data)
-    elif method == "UMAP":
-        reduced_data = umap.UMAP().fit_transform(scaled_data)
+def _reduce_dimensions(frame: FrameVersion, method: str, ensemble_list: List[str], simulation_list: List[str], timestep: float, run) -> pd.DataFrame:
+    """Fits a dimensional reduction of the selected simulations at a timestep, running the fit with run unless it is chunked"""
+    identifiers, rows = _filter_dr_data(frame, ensemble_list, simulation_list, timestep)
+    chunk_rows = int(config["PCA_CHUNK_ROWS"])
+    if method == 'PCA' and chunk_rows > 0 and len(rows) > chunk_rows:
+        # Too many rows to be read at once, PCA is fitted chunk by chunk in this thread
+        chunks = np.array_split(rows, -(-len(rows) // chunk_rows))
+        reduced_data = DimensionalReduction.incremental_fit_transform(
+            DR_PARAMETERS[method],
+            lambda: (frame.read_timestep(chunk, timestep) for chunk in chunks)
+        )
     else:
+        reduced_data = run(DimensionalReduction.fit_transform, method, DR_PARAMETERS[method], frame.read_timestep(rows, timestep))
+    return _format_dr_result(identifiers, reduced_data)
+
+@app.route('/dimensional-reduction')
+@requires_frame
+def get_ensemble_dr():
+    frame = df_manager.current
+    method, ensemble_list, simulation_list, timestep, cache_key = _parse_dr_request(frame)
+    embedding = request.args.get('embedding', default='local', type=str)
+    if method not in DR_METHODS:
         return create_cors_response({"error": "Invalid method"}, 400)
+    if timestep is None:
+        return create_cors_response({"error": "Invalid time"}, 400)
+    if embedding not in ('local', 'global'):
+        return create_cors_response({"error": "Invalid embedding"}, 400)
 
-    # Format results
-    result_df = pd.concat([
-        identifiers,
-        pd.DataFrame(reduced_data, columns=['x', 'y'], index=data.index)
-    ], axis=1)
+    # Global embedding: slice the coordinates fitted once on every simulation
+    if embedding == 'global':
+        identifiers, _ = _filter_dr_data(frame, ensemble_list, simulation_list, timestep)
+        with Metrics.stage('embedding'):
+            global_embedding = df_manager.get_global_embedding(method, timestep, frame)
+        result_df = _format_dr_result(identifiers, global_embedding.lookup(identifiers['name']))
+        return create_data_response(result_df, _group_dr_records)
+
+    def compute():
+        # Without a compute pool, the fit also reports its scale and method stages
+        with Metrics.stage('compute'):
+            return _reduce_dimensions(frame, method, ensemble_list, simulation_list, timestep, run_cpu_bound)
+
+    result_df = df_manager.dr_cache.get_or_compute(cache_key, compute)
+
+    return create_data_response(result_df, _group_dr_records)
+
+@app.route('/dimensional-reduction/jobs', methods=['POST'])
+@requires_frame
+def submit_ensemble_dr_job():
+    frame = df_manager.current
+    method, ensemble_list, simulation_list, timestep, cache_key = _parse_dr_request(frame)
+    if method not in DR_METHODS:
+        return create_cors_response({"error": "Invalid method"}, 400)
+    if timestep is None:
+        return create_cors_response({"error": "Invalid time"}, 400)
+
+    result_df = df_manager.dr_cache.get(cache_key)
+    if result_df is not None:
+        job_id = dr_jobs.complete(cache_key, result_df)
+    else:
+        # The job reads the data itself, so a submit of a job already in flight reads nothing
+        def finalize(result):
+            df_manager.dr_cache.put(cache_key, result)
+            return result
+
+        job_id = dr_jobs.submit(
+            cache_key,
+            _reduce_dimensions,
+            frame, method, ensemble_list, simulation_list, timestep, dr_jobs.run_in_process,
+            finalize=finalize
+        )
+
+    job = dr_jobs.get(job_id)
+    return create_cors_response({"job_id": job_id, "status": job["status"]}, 202)
+
+@app.route('/dimensional-reduction/jobs/<job_id>')
+def get_ensemble_dr_job(job_id):
+    job = dr_jobs.get(job_id)
+    if job is None:
+        return create_cors_response({"error": "Job not found"}, 404)
+    del job["result"]
+    return create_cors_response(job)
+
+@app.route('/dimensional-reduction/jobs/<job_id>/result')
+def get_ensemble_dr_job_result(job_id):
+    job = dr_jobs.get(job_id)
+    if job is None:
+        return create_cors_response({"error": "Job not found"}, 404)
+    if job["status"] == "failed":
+        return create_cors_response({"error": job["error"]}, 500)
+    if job["status"] != "done":
+        return create_cors_response({"job_id": job_id, "status": job["status"]}, 202)
+    return create_data_response(job["result"], _group_dr_records)
+
+@app.route('/cache-stats')
+def cache_stats():
+    return create_cors_response({
+        'dimensional-reduction': df_manager.dr_cache.stats(),
+        'temporal-evolution': df_manager.aggregation_cache.stats()
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Latency histograms of routes, stages, queries and frame builds, with cache and pool usage"""
+    frame = df_manager.current
+    return create_cors_response({
+        **Metrics.snapshot(),
+        "caches": {
+            'dimensional-reduction': df_manager.dr_cache.stats(),
+            'temporal-evolution': df_manager.aggregation_cache.stats()
+        },
+        "frame": {
+            "fingerprint": frame.fingerprint if frame is not None else None,
+            "shape": list(frame.cube.values.shape) if frame is not None else None,
+            "dtype": df_manager.dtype,
+            "storage": df_manager.storage,
+            "bytes": frame.cube.nbytes if frame is not None else 0,
+            "last_refresh": df_manager.refresh_status["last_refresh"]
+        },
+        "db_pool": get_pool().stats(),
+        "slow_request_profiles": len(profiler.profiles()) if profiler is not None else None
+    })
+
+@app.route('/metrics/profiles')
+def slow_request_profiles():
+    """Sampled stacks of the slowest recent requests, when PROFILE_SLOW_REQUESTS is set"""
+    if profiler is None:
+        return create_cors_response({"error": "Profiling is disabled, set PROFILE_SLOW_REQUESTS"}, 404)
+    return create_cors_response({"threshold": profiler.threshold, "profiles": profiler.profiles()})
+
+def _is_admin_request() -> bool:
+    """Checks the bearer token of the request against ADMIN_TOKEN, or that it comes from this host if ADMIN_ALLOW_LOCAL is set"""
+    if str(config["ADMIN_ALLOW_LOCAL"]).lower() in ('true', '1') and request.remote_addr in LOCAL_ADDRESSES:
+        return True
+    token = config["ADMIN_TOKEN"]
+    if not token:
+        return False
+    authorization = request.headers.get('Authorization', '')
+    return hmac.compare_digest(authorization.encode(), ('Bearer ' + token).encode())
+
+@app.route('/admin/refresh', methods=['GET', 'POST'])
+@requires_frame
+def refresh_data():
+    if request.method == 'POST':
+        if not _is_admin_request():
+            return create_cors_response({"error": "Forbidden"}, 403)
+        full = request.args.get('full', default='false', type=str).lower() in ('true', '1')
+        started = df_manager.refresh_in_background(full)
+        return create_cors_response({"fingerprint": df_manager.current.fingerprint, "started": started}, 202)
+    return create_cors_response({"fingerprint": df_manager.current.fingerprint, **df_manager.refresh_status})
+
+def _aggregate_temporal_data(frame: FrameVersion, variable: str, ensemble_list: List[str], simulation_list: List[str], quantiles: List[float]) -> pd.DataFrame:
+    # Apply filters
+    cube = frame.cube
+    selected = cube.select(ensemble_list, simulation_list)
+    column = cube.variables.index(variable)
+
+    # Reduce the (simulation, time) matrix of each ensemble along its simulations, missing rows are NaN.
+    # The matrix is read a chunk of timesteps at a time, so memory does not grow with the series
+    tables = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for code, ensemble_name in enumerate(cube.ensemble_names):
+            rows = np.flatnonzero(selected & (cube.ensemble_codes == code))
+            times = np.flatnonzero(cube.present[rows].any(axis=0))
+            for chunk in cube.chunks(len(times), len(rows) * 8, df_manager.chunk_bytes):
+                block = cube.values[rows[:, None], times[chunk][None, :], column].astype(np.float64)
+                table = {
+                    'ensemble': ensemble_name,
+                    'time': cube.timesteps[times[chunk]],
+                    'mean': np.nanmean(block, axis=0),
+                    'median': np.nanmedian(block, axis=0),
+                    'std': np.nanstd(block, axis=0, ddof=1),
+                    'min': np.nanmin(block, axis=0),
+                    'max': np.nanmax(block, axis=0)
+                }
+                if quantiles:
+                    for q, band in zip(quantiles, np.nanquantile(block, [q / 100 for q in quantiles], axis=0)):
+                        table['p%g' % q] = band
+                tables.append(pd.DataFrame(table))
+    if not tables:
+        return pd.DataFrame(columns=['ensemble', 'time'] + AGGREGATION_STATISTICS + ['p%g' % q for q in quantiles])
+    return pd.concat(tables, ignore_index=True)
 
-    result_df['record_object'] = result_df[['name', 'x', 'y']].to_dict('records')
-    grouped = result_df.groupby('ensemble')['record_object'].apply(list).to_dict()
+def _group_temporal_statistics(statistics: pd.DataFrame) -> Dict:
+    # One list per statistic for each ensemble
+    statistics = statistics.astype(object).where(statistics.notna(), None)
+    result = {}
+    for ensemble_name, ensemble_statistics in statistics.groupby('ensemble'):
+        result[ensemble_name] = ensemble_statistics.drop(columns='ensemble').to_dict('list')
+    return result
+
+def _group_temporal_series(df: pd.DataFrame) -> Dict:
+    # Sort the rows of each simulation together and split the converted points at the boundaries
+    variable = df.columns[-1]
+    df = df.sort_values(['ensemble', 'name', 'time'], kind='stable')
+    ensembles = df['ensemble'].to_numpy()
+    names = df['name'].to_numpy()
+    points = df[['time', variable]].to_numpy(dtype=np.float64).tolist()
+    starts = np.flatnonzero(np.concatenate([[True], (ensembles[1:] != ensembles[:-1]) | (names[1:] != names[:-1])])) if len(df) else []
+    result = {}
+    for start, stop in zip(starts, list(starts[1:]) + [len(df)]):
+        result.setdefault(ensembles[start], {})[names[start]] = points[start:stop]
+    return result
+
+def _downsample_series(frame: FrameVersion, simulations: np.ndarray, variable: str, max_points: int, method: str) -> pd.DataFrame:
+    """Keeps at most max_points points of the series of each simulation, choosing them for all simulations at once"""
+    # One row per simulation and one column per timestep any of them has data for, NaN where a simulation has none
+    cube = frame.cube
+    rows = np.flatnonzero(simulations)
+    times = cube.present[rows].any(axis=0)
+    values = cube.values[rows, :, cube.variables.index(variable)][:, times].astype(np.float64)
+    return _series_table(cube.ensembles_of(rows), cube.names[rows], cube.timesteps[times], values, variable, max_points, method)
 
-    return create_cors_response(grouped)
+def _series_table(ensembles: np.ndarray, names: np.ndarray, timesteps: np.ndarray, values: np.ndarray, variable: str, max_points: int, method: str) -> pd.DataFrame:
+    """Builds the long table of series given as one row of values per simulation, keeping at most max_points points of each if given"""
+    indices = Downsampling.downsample(method, timesteps, values, max_points or len(timesteps))
+    points = indices.shape[1]
+
+    # Back to one row per point, skipping repeated points and times a simulation has no value for
+    values = np.take_along_axis(values, indices, axis=1).ravel()
+    keep = np.concatenate([np.ones((len(indices), 1), dtype=bool), np.diff(indices, axis=1) != 0], axis=1).ravel()
+    keep &= ~np.isnan(values)
+    return pd.DataFrame({
+        'ensemble': np.repeat(ensembles, points)[keep],
+        'name': np.repeat(names, points)[keep],
+        'time': timesteps[indices].ravel()[keep],
+        variable: values[keep]
+    })
 
 @app.route('/temporal-evolution')
+@requires_frame
 def temporal_data():
-    aggregate = request.args.get('aggregate', default=False, type=bool)
+    aggregate = request.args.get('aggregate', default='false', type=str).lower() in ('true', '1')
     variable = request.args.get('variable', default='', type=str)
     ensemble_list = request.args.getlist('ensemble')
     simulation_list = request.args.getlist('simulation')
+    max_points = request.args.get('max_points', default=None, type=int)
+    downsampling = request.args.get('downsample', default='lttb', type=str)
 
     # Get data
-    df = df_manager.ensemble_df
-    if not variable:
-        variable = df.columns[-1]
+    frame = df_manager.current
+    if not variable and frame.cube.variables:
+        variable = frame.cube.variables[-1]
+    if variable not in frame.cube.variables:
+        return create_cors_response({"error": "Invalid variable"}, 400)
+    if 'max_points' in request.args and (max_points is None or max_points < 3):
+        return create_cors_response({"error": "Invalid max_points"}, 400)
+    if downsampling not in Downsampling.METHODS:
+        return create_cors_response({"error": "Invalid downsample"}, 400)
 
-    # Apply filters
-    if ensemble_list:
-        df = df[df['ensemble'].isin(ensemble_list)]
-    if simulation_list:
-        df = df[df['name'].isin(simulation_list)]
+    if aggregate:
+        # Quantiles are percentages, as the names of their columns (p5, p95, ...)
+        try:
+            quantiles = _float_args('quantile') or DEFAULT_QUANTILES
+        except ValueError:
+            return create_cors_response({"error": "Invalid quantile"}, 400)
+        if any(q < 0 or q > 100 for q in quantiles):
+            return create_cors_response({"error": "Invalid quantile"}, 400)
+        cache_key = (
+            variable,
+            tuple(sorted(ensemble_list)),
+            tuple(sorted(simulation_list)),
+            tuple(quantiles),
+            frame.fingerprint
+        )
+        with Metrics.stage('aggregate'):
+            statistics = df_manager.aggregation_cache.get_or_compute(
+                cache_key,
+                lambda: _aggregate_temporal_data(frame, variable, ensemble_list, simulation_list, quantiles)
+            )
+        return create_data_response(statistics, _group_temporal_statistics)
 
-    # Group data and convert to a serializable format
-    result = {}
-    for ensemble_name, ensemble_group in df.groupby('ensemble'):
-        result[ensemble_name] = {}
-        for name, group in ensemble_group.groupby('name'):
-            result[ensemble_name][name] = group[['time', variable]].values.tolist()
+    # Apply filters
+    simulations = frame.cube.select(ensemble_list, simulation_list)
 
-    if aggregate:
-        return create_cors_response({"message": "Aggregation not implemented"}, 501)
+    # Long series are cut to max_points per simulation, so the payload does not grow with them
+    if max_points is not None and len(frame.timesteps) > max_points:
+        with Metrics.stage('downsample'):
+            df = _downsample_series(frame, simulations, variable, max_points, downsampling)
+    else:
+        if _exceeds_memory(int(np.count_nonzero(frame.cube.present[simulations])), 1):
+            return create_cors_response({"error": "Response too large, downsample it with max_points"}, 413)
+        with Metrics.stage('filter'):
+            df = frame.cube.to_frame(simulations, variables=[variable])
 
-    return create_cors_response(result)
+    return create_data_response(df, _group_temporal_series)
 
 @app.route('/correlation-matrix')
+@requires_frame
 def correlation_matrix():
+    method = request.args.get('method', default='pearson', type=str)
+    ensemble_list = request.args.getlist('ensemble')
+    simulation_list = request.args.getlist('simulation')
+    frame = df_manager.current
+    timestep = _parse_timestep(frame)
+    if method not in CORRELATION_METHODS:
+        return create_cors_response({"error": "Invalid method"}, 400)
+    if timestep is None:
+        return create_cors_response({"error": "Invalid time"}, 400)
+
+    # Calculate correlation matrix from the precomputed statistics
+    with Metrics.stage('statistics'):
+        statistics = frame.get_statistics(timestep)
+    with Metrics.stage('correlation'):
+        if method == 'pearson':
+            matrix = statistics.pearson(ensemble_list, simulation_list)
+        else:
+            matrix = statistics.spearman(ensemble_list, simulation_list)
+    columns = frame.cube.variables
+    correlation_matrix = pd.DataFrame(matrix, index=columns, columns=columns).dropna(axis=0, how='all').dropna(axis=1, how='all')
+
+    return create_data_response(
+        correlation_matrix.rename_axis('variable').reset_index(),
+        lambda table: table.set_index('variable').rename_axis(None).to_json(orient='index')
+    )
+
+def _open_field_store(record: Tuple) -> FieldStore.FieldStore:
+    """Returns the store of a grid record, opening it once per record so a grid loaded again is read from its new directory"""
+    with field_store_lock:
+        grid_id, store = field_stores.get(record[1], (None, None))
+        if grid_id != record[0]:
+            with Metrics.timer("field.open"):
+                store = FieldStore.FieldStore.open(record[-1])
+            field_stores[record[1]] = (record[0], store)
+        return store
+
+def _parse_field_request() -> Tuple[FieldStore.FieldStore, str, float, str]:
+    """Reads the grid, variable and time query parameters, returning the store and an error message if any is invalid"""
+    grid_name = request.args.get('grid', default='', type=str)
+    variable = request.args.get('variable', default='', type=str)
+    try:
+        timestep = _float_arg('time')
+    except ValueError:
+        return None, None, None, "Invalid time"
+    record = Grid.Grid().read_by_name(grid_name)
+    if record is None:
+        return None, None, None, "Invalid grid"
+    store = _open_field_store(record)
+    if not variable and store.variables:
+        variable = store.variables[-1]
+    if variable not in store.variables:
+        return None, None, None, "Invalid variable"
+    if timestep is None and len(store.timesteps):
+        timestep = float(store.timesteps[-1])
+    if timestep not in store.time_index:
+        return None, None, None, "Invalid time"
+    return store, variable, timestep, None
+
+def _select_field_cells(store: FieldStore.FieldStore) -> np.ndarray:
+    """Returns the positions of the cells in the region or bbox query parameters, every cell if neither is given, or None if they are invalid"""
+    try:
+        region = [float(item) for item in request.args['region'].split(',')] if 'region' in request.args else None
+        bbox = [float(item) for item in request.args['bbox'].split(',')] if 'bbox' in request.args else None
+    except ValueError:
+        return None
+    if region is not None:
+        if len(region) < 6 or len(region) % 2 or not np.all(np.isfinite(region)):
+            return None
+        return store.positions_in_region(np.reshape(region, (-1, 2)))
+    if bbox is not None:
+        if len(bbox) != 4 or not np.all(np.isfinite(bbox)) or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            return None
+        return store.positions_in_bbox(bbox)
+    return np.arange(len(store.x))
+
+def _grid_record_json(record: Tuple, store: FieldStore.FieldStore) -> Dict:
+    return {
+        "name": record[1],
+        "kind": record[2],
+        "cells": record[3],
+        "shape": list(store.shape) if store.shape else None,
+        "bounds": [record[6], record[7], record[8], record[9]],
+        "chunk_cells": record[10],
+        "variables": store.variables,
+        "timesteps": store.timesteps,
+        "simulations": len(store.names)
+    }
+
+@app.route('/grids')
+def list_grids():
+    # The newest record of each grid name wins
+    records = {record[1]: record for record in Grid.Grid().read_all()}
+    return create_cors_response([_grid_record_json(record, _open_field_store(record)) for record in records.values()])
+
+def _field_response(default_reduction: str):
+    """Reduces the fields of the selected simulations to one value per cell and sends them averaged into a raster of at most max_cells cells"""
+    reduction = request.args.get('reduction', default=default_reduction, type=str)
     ensemble_list = request.args.getlist('ensemble')
     simulation_list = request.args.getlist('simulation')
+    max_cells = request.args.get('max_cells', default=int(config["FIELD_MAX_CELLS"]), type=int)
+    store, variable, timestep, error = _parse_field_request()
+    if error is not None:
+        return create_cors_response({"error": error}, 400)
+    if reduction not in FieldStore.REDUCTIONS:
+        return create_cors_response({"error": "Invalid reduction"}, 400)
+    if max_cells is None or max_cells < 1:
+        return create_cors_response({"error": "Invalid max_cells"}, 400)
+
+    # Only the chunks of the selected cells are read, and each one is reduced before the next is read
+    with Metrics.stage('filter'):
+        positions = _select_field_cells(store)
+        if positions is None:
+            return create_cors_response({"error": "Invalid bbox or region"}, 400)
+        rows = store.rows_at(variable, timestep, store.select(ensemble_list, simulation_list))
+    with Metrics.stage('reduce'):
+        values = store.reduce_field(variable, rows, timestep, positions, reduction)
+    with Metrics.stage('downsample'):
+        x, y = store.x[positions], store.y[positions]
+        if len(positions):
+            raster, origin, cell_size = Downsampling.bin_field(
+                x, y, values, (x.min(), y.min(), x.max(), y.max()), max_cells, store.spacing
+            )
+        else:
+            raster, origin, cell_size = np.empty((0, 0)), None, None
+
+    # Other formats send one row per raster cell with a value
+    table_rows, table_columns = np.nonzero(~np.isnan(raster))
+    table = pd.DataFrame({
+        'x': origin[0] + (table_columns + 0.5) * cell_size[0] if origin else np.empty(0),
+        'y': origin[1] + (table_rows + 0.5) * cell_size[1] if origin else np.empty(0),
+        variable: raster[table_rows, table_columns]
+    })
+    return create_data_response(table, lambda _: {
+        "variable": variable,
+        "time": timestep,
+        "reduction": reduction,
+        "simulations": len(rows),
+        "cells": len(positions),
+        "shape": list(raster.shape),
+        "origin": list(origin) if origin else None,
+        "cell_size": list(cell_size) if cell_size else None,
+        "values": raster
+    })
+
+@app.route('/field')
+def field():
+    return _field_response('mean')
 
-    # Filter data
-    df = df_manager.ensemble_df[df_manager.ensemble_df['time'] == 2023]
-    if ensemble_list:
-        df = df[df['ensemble'].isin(ensemble_list)]
-    if simulation_list:
-        df = df[df['name'].isin(simulation_list)]
+@app.route('/field-spread')
+def field_spread():
+    return _field_response('std')
+
+@app.route('/cell-series')
+def cell_series():
+    ensemble_list = request.args.getlist('ensemble')
+    simulation_list = request.args.getlist('simulation')
+    cell = request.args.get('cell', default=None, type=int)
+    x = request.args.get('x', default=None, type=float)
+    y = request.args.get('y', default=None, type=float)
+    max_points = request.args.get('max_points', default=None, type=int)
+    downsampling = request.args.get('downsample', default='lttb', type=str)
+    # Every timestep of the store is read, the time parameter does not apply
+    store, variable, _, error = _parse_field_request()
+    if error is not None:
+        return create_cors_response({"error": error}, 400)
+    if 'max_points' in request.args and (max_points is None or max_points < 3):
+        return create_cors_response({"error": "Invalid max_points"}, 400)
+    if downsampling not in Downsampling.METHODS:
+        return create_cors_response({"error": "Invalid downsample"}, 400)
 
-    # Calculate correlation matrix
-    data = df.drop(columns=['ensemble', 'time', 'name'])
-    correlation_matrix = data.corr().dropna(axis=0, how='all').dropna(axis=1, how='all')
+    with Metrics.stage('filter'):
+        if cell is not None:
+            position = store.position_of(cell)
+        elif x is not None and y is not None:
+            position = store.nearest_position(x, y)
+        else:
+            position = -1
+        if position < 0:
+            return create_cors_response({"error": "Invalid cell"}, 400)
+        rows = np.flatnonzero(store.select(ensemble_list, simulation_list))
+    with Metrics.stage('read'):
+        values = store.read_series(variable, position, rows)
+    with Metrics.stage('downsample'):
+        table = _series_table(store.ensembles_of(rows), store.names[rows], store.timesteps, values, variable, max_points, downsampling)
 
-    return create_cors_response(correlation_matrix.to_json(orient='index'))
+    return create_data_response(table, lambda table: {
+        "cell": {"id": int(store.cell_ids[position]), "x": float(store.x[position]), "y": float(store.y[position])},
+        "series": _group_temporal_series(table)
+    })
 
 if __name__ == '__main__':
     app.run(debug=True)
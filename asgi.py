@@ -0,0 +1,140 @@
+"""Async serving mode: the endpoints of app.py behind an ASGI application
+
+Run it with any ASGI server, for example ``uvicorn asgi:application``.
+
+The event loop never runs application code. Each request is handled by the Flask app in a thread
+pool, chosen by its route: metadata routes have a pool of their own, so they keep answering while
+every data thread is busy. Dimensional reduction fits and correlation statistics are sent to a
+process pool, so they neither block a thread for the whole computation while holding the GIL nor
+slow down the other requests of the process. Database queries only happen when the frame is
+built or refreshed, in the background thread of the DataFrameManager.
+"""
+from dotenv import dotenv_values
+from concurrent.futures import ThreadPoolExecutor
+import app as flask_app
+import asyncio
+import io
+import sys
+
+default_envs = {
+    "ASYNC_WORKERS": 8,
+    "ASYNC_METADATA_WORKERS": 2,
+    "COMPUTE_WORKERS": 2
+}
+config = {
+    **default_envs,
+    **dotenv_values(".env")
+}
+
+METADATA_ROUTES = ['/dr-methods', '/variables', '/grids', '/list-ensembles', '/ready', '/cache-stats', '/metrics', '/metrics/profiles', '/admin/refresh']
+
+class AsyncApplication:
+    """An ASGI application that runs a WSGI application in thread pools
+    """
+
+    def __init__(self, wsgi_app, workers, metadata_workers):
+        """Creates the thread pools
+
+        :param wsgi_app: the WSGI application
+        :type wsgi_app: callable
+        :param workers: number of threads for data routes
+        :type workers: int
+        :param metadata_workers: number of threads for the routes in METADATA_ROUTES
+        :type metadata_workers: int
+        """
+
+        self.wsgi_app = wsgi_app
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="data")
+        self.__metadata_executor = ThreadPoolExecutor(max_workers=metadata_workers, thread_name_prefix="metadata")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.__lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.__http(scope, receive, send)
+        else:
+            raise Exception("ASGI scope type %s not yet implemented" % scope["type"])
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.__executor.shutdown(wait=False)
+                self.__metadata_executor.shutdown(wait=False)
+                flask_app.dr_jobs.shutdown()
+                if flask_app.compute_pool is not None:
+                    flask_app.compute_pool.shutdown(wait=False, cancel_futures=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __http(self, scope, receive, send):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        loop = asyncio.get_running_loop()
+        executor = self.__metadata_executor if scope["path"] in METADATA_ROUTES else self.__executor
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+        # Streamed responses are produced chunk by chunk in the same pool
+        chunks = await loop.run_in_executor(executor, self.wsgi_app, self.__environ(scope, body), start_response)
+        try:
+            iterator = iter(chunks)
+            await send({"type": "http.response.start", **response_start})
+            while True:
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(chunks, "close"):
+                await loop.run_in_executor(executor, chunks.close)
+
+    @staticmethod
+    def __environ(scope, body):
+        """Builds the WSGI environ of an ASGI http scope, as described by PEP 3333
+        """
+
+        server_name, server_port = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+            "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1")
+            value = value.decode("latin-1")
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            elif name == "content-length":
+                environ["CONTENT_LENGTH"] = value
+            else:
+                key = "HTTP_" + name.upper().replace("-", "_")
+                environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+flask_app.use_compute_pool(int(config["COMPUTE_WORKERS"]))
+application = AsyncApplication(flask_app.app, int(config["ASYNC_WORKERS"]), int(config["ASYNC_METADATA_WORKERS"]))
@@ -0,0 +1,299 @@
+"""Benchmarks the loader, the startup and every endpoint on a synthetic ensemble
+
+The synthetic ensemble is loaded into a SQLite database in a temporary directory, so it runs
+offline and does not touch the database configured in .env. Each stage is timed a few times with
+the result caches cleared before every run, and run once more under tracemalloc to record its peak
+memory. Results are written as JSON, and a previous result file can be given to compare against.
+
+    python benchmark.py --ensembles 4 --simulations 50 --variables 20 --timesteps 50 --output results.json
+    python benchmark.py --compare results.json
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = {
+    'dimensional-reduction-pca': '/dimensional-reduction?method=PCA',
+    'dimensional-reduction-umap': '/dimensional-reduction?method=UMAP',
+    'correlation-matrix-pearson': '/correlation-matrix?method=pearson',
+    'correlation-matrix-spearman': '/correlation-matrix?method=spearman',
+    'temporal-evolution': '/temporal-evolution',
+    'temporal-evolution-aggregate': '/temporal-evolution?aggregate=true',
+    'temporal-evolution-downsampled': '/temporal-evolution?max_points=100',
+    'export-json': '/',
+    'export-ndjson': '/?format=ndjson',
+    'field': '/field?grid=synthetic-grid&max_cells=1000',
+    'field-spread': '/field-spread?grid=synthetic-grid&max_cells=1000',
+    'field-bbox': '/field?grid=synthetic-grid&bbox=0.25,0.25,0.5,0.5',
+    'cell-series': '/cell-series?grid=synthetic-grid&x=0.5&y=0.5',
+}
+
+def createSyntheticEnsemble(ensembles, simulations, variables, timesteps, seed=0):
+    """Generates an ensemble in the format received by loadDataIntoDatabase
+
+    Each simulation is a random walk around the mean of its ensemble, so ensembles are apart from
+    each other and variables are correlated over time.
+
+    :param ensembles: number of ensembles
+    :type ensembles: int
+    :param simulations: number of simulations of each ensemble
+    :type simulations: int
+    :param variables: number of variables
+    :type variables: int
+    :param timesteps: number of timesteps
+    :type timesteps: int
+    :param seed: seed of the random generator
+    :type seed: int
+
+    :returns: a pandas dataframe with ensemble, name and time columns and one column per variable
+    :rtype: pandas.DataFrame
+    """
+
+    rng = np.random.default_rng(seed)
+    rows = ensembles * simulations
+    means = np.repeat(rng.normal(0.0, 10.0, size=(ensembles, variables)), simulations, axis=0)
+    walks = np.cumsum(rng.normal(size=(timesteps, rows, variables)), axis=0) + means
+    ensemble_names = np.repeat(['ensemble-%d' % e for e in range(ensembles)], simulations)
+    simulation_names = ['simulation-%d-%d' % (e, s) for e in range(ensembles) for s in range(simulations)]
+    return pd.concat([
+        pd.DataFrame({
+            'ensemble': np.tile(ensemble_names, timesteps),
+            'name': np.tile(simulation_names, timesteps),
+            'time': np.repeat(np.arange(timesteps, dtype=np.float64), rows),
+        }),
+        pd.DataFrame(walks.reshape(timesteps * rows, variables), columns=['variable-%d' % v for v in range(variables)])
+    ], axis=1)
+
+def createSyntheticFields(data, grid_size, timesteps):
+    """Generates the fields of a regular grid in the format received by loadFieldsIntoStore
+
+    Each field is a smooth bump whose center moves with the simulation and the timestep, plus noise.
+
+    :param data: the synthetic ensemble, whose simulations get the fields
+    :type data: pandas.DataFrame
+    :param grid_size: number of rows and of columns of the grid, over the unit square
+    :type grid_size: int
+    :param timesteps: number of timesteps with fields
+    :type timesteps: int
+
+    :returns: the x and y of the cells, the simulations, the timesteps and a generator of fields
+    :rtype: tuple
+    """
+
+    x, y = [axis.ravel() for axis in np.meshgrid(np.linspace(0, 1, grid_size), np.linspace(0, 1, grid_size))]
+    simulations = list(data.groupby('name', sort=False)['ensemble'].first().items())
+    times = np.arange(timesteps, dtype=np.float64)
+
+    def fields():
+        rng = np.random.default_rng(0)
+        for index, (name, _) in enumerate(simulations):
+            for t in times:
+                center = 0.5 + 0.3 * np.sin(index + t / 10)
+                yield name, t, 'field-0', np.exp(-((x - center) ** 2 + (y - 0.5) ** 2) * 20) + rng.normal(0.0, 0.05, size=len(x))
+
+    return x, y, [(ensemble, name) for name, ensemble in simulations], times, fields()
+
+def measure(name, function, repeat, before=None, memory=True):
+    """Times a function and records its peak memory
+
+    :param name: name of the stage in the results
+    :type name: str
+    :param function: the stage, which takes no arguments
+    :type function: callable
+    :param repeat: number of timed runs
+    :type repeat: int
+    :param before: called before each run, outside of the measurement, to clear caches
+    :type before: callable
+    :param memory: runs the stage once more under tracemalloc to record its peak memory
+    :type memory: bool
+
+    :returns: the timings in seconds and the peak memory in bytes
+    :rtype: dict
+    """
+
+    runs = []
+    result = None
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - start)
+    peak_memory = None
+    if memory:
+        if before is not None:
+            before()
+        tracemalloc.start()
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    record = {
+        "name": name,
+        "runs": runs,
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+        "max": max(runs),
+        "peak_memory_bytes": peak_memory,
+    }
+    status = getattr(result, 'status_code', None)
+    if status is not None:
+        record["status"] = status
+    print("%-32s median %9.4f s  min %9.4f s  peak %s" % (
+        name, record["median"], record["min"], "-" if peak_memory is None else "%.1f MB" % (peak_memory / 1e6)
+    ), file=sys.stderr)
+    return record
+
+def runBenchmarks(arguments):
+    """Loads a synthetic ensemble and measures every stage
+
+    :param arguments: the parsed command line arguments
+    :type arguments: argparse.Namespace
+
+    :returns: the parameters of the run and the measurement of each stage
+    :rtype: dict
+    """
+
+    data = createSyntheticEnsemble(arguments.ensembles, arguments.simulations, arguments.variables, arguments.timesteps)
+
+    # Every module reads .env from the working directory when it is imported
+    working_directory = tempfile.mkdtemp(prefix='ensemble-benchmark-')
+    with open(os.path.join(working_directory, '.env'), 'w') as env_file:
+        env_file.write("DB_DRIVER=sqlite\nLOAD_MODE=replace\nSNAPSHOT_FILENAME=\nEMBEDDING_DIRECTORY=\nREFRESH_INTERVAL=0\nDR_WARMUP=false\n")
+    os.chdir(working_directory)
+    sys.path.insert(0, REPOSITORY_DIRECTORY)
+    spec = importlib.util.spec_from_file_location('database_load', os.path.join(REPOSITORY_DIRECTORY, 'database-load.py'))
+    database_load = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(database_load)
+
+    results = [measure(
+        'load-data-into-database',
+        lambda: database_load.loadDataIntoDatabase(data, mode='replace'),
+        arguments.loader_repeat,
+        memory=arguments.memory
+    )]
+
+    x, y, simulations, times, fields = createSyntheticFields(data, arguments.grid_size, min(arguments.timesteps, 10))
+    results.append(measure(
+        'load-fields-into-store',
+        lambda: database_load.loadFieldsIntoStore('synthetic-grid', x, y, simulations, times, ['field-0'], fields, shape=(arguments.grid_size, arguments.grid_size)),
+        1,
+        memory=False
+    ))
+
+    start = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    app.df_manager.wait_until_ready()
+    ready = time.perf_counter()
+    results.append({"name": "startup-import", "runs": [imported - start], "median": imported - start})
+    results.append({"name": "startup-ready", "runs": [ready - start], "median": ready - start})
+
+    results.append(measure(
+        'create-dataframe-all-ensembles',
+        app.df_manager._create_cube_all_ensembles,
+        arguments.repeat,
+        memory=arguments.memory
+    ))
+
+    def clear_caches():
+        app.df_manager.dr_cache.clear()
+        app.df_manager.aggregation_cache.clear()
+        app.df_manager.embeddings.clear()
+        app.df_manager.current.statistics.clear()
+
+    client = app.app.test_client()
+    for name, url in ENDPOINTS.items():
+        # Untimed runs, so one-off costs such as numba compilation stay out of the timings. The body is read
+        # in every run, since the test client only builds the first chunk of a streamed response otherwise
+        for _ in range(arguments.warmup):
+            client.get(url).get_data()
+        results.append(measure(name, lambda: client.get(url).get_data(), arguments.repeat, before=clear_caches, memory=arguments.memory))
+
+    return {
+        "commit": gitCommit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "ensembles": arguments.ensembles,
+            "simulations": arguments.simulations,
+            "variables": arguments.variables,
+            "timesteps": arguments.timesteps,
+            "cells": len(data) * arguments.variables,
+            "grid_size": arguments.grid_size,
+            "repeat": arguments.repeat,
+        },
+        "results": results,
+    }
+
+def gitCommit():
+    """Returns the commit checked out in the repository, or None outside of git
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_DIRECTORY, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compareResults(baseline, current):
+    """Prints the median time of each stage in two result files and their ratio
+
+    :param baseline: results of a previous run
+    :type baseline: dict
+    :param current: results of this run
+    :type current: dict
+    """
+
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    print("%-32s %12s %12s %8s" % ("stage", "baseline", "current", "ratio"))
+    for result in current["results"]:
+        previous = baseline_results.get(result["name"])
+        if previous is None:
+            print("%-32s %12s %12.4f" % (result["name"], "-", result["median"]))
+        else:
+            print("%-32s %12.4f %12.4f %8.2f" % (result["name"], previous["median"], result["median"], result["median"] / previous["median"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the loader, the startup and every endpoint on a synthetic ensemble")
+    parser.add_argument('--ensembles', type=int, default=4)
+    parser.add_argument('--simulations', type=int, default=50, help="simulations of each ensemble")
+    parser.add_argument('--variables', type=int, default=20)
+    parser.add_argument('--timesteps', type=int, default=50)
+    parser.add_argument('--grid-size', type=int, default=100, help="rows and columns of the synthetic grid")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs of each stage")
+    parser.add_argument('--loader-repeat', type=int, default=1, help="timed runs of the loader")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed runs of each endpoint")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="skips the tracemalloc runs")
+    parser.add_argument('--output', help="file for the JSON results, printed to stdout if not given")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    arguments = parser.parse_args()
+    # Relative paths are resolved before the benchmark changes the working directory
+    output = os.path.abspath(arguments.output) if arguments.output else None
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    # Modules print while loading, so stdout is kept for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        current = runBenchmarks(arguments)
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(current, output_file, indent=2)
+    else:
+        print(json.dumps(current, indent=2))
+    if baseline is not None:
+        compareResults(baseline, current)
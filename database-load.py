@@ -1,11 +1,13 @@
 from dotenv import dotenv_values
-from model import Ensemble, Simulation, Variable, CellData
-from surrealdb import Surreal
-import pymonetdb
-import asyncio
-import model
+from model import Ensemble, Simulation, Variable, CellData, LoadManifest, Grid
+from service import FieldStore
+#from surrealdb import Surreal
 import pandas as pd
 import numpy as np
+import hashlib
+import os
+import shutil
+import time
 
 default_envs = {
     "DB_DRIVER": "monetdb",
@@ -14,7 +16,13 @@ default_envs = {
     "DB_DATABASE": "ensemble",
     "DB_USERNAME": "ensemble",
     "DB_PASSWORD": "ensemble",
-    "DATA_FILENAME": "data.csv"
+    "DATA_FILENAME": "data.csv",
+    "LOAD_BATCH_SIZE": 50000,
+    "CSV_CHUNK_SIZE": 20000,
+    "LOAD_MODE": "replace",
+    "FIELD_DIRECTORY": "field-store",
+    "FIELD_CHUNK_CELLS": 4096,
+    "FIELD_DTYPE": "float64"
     }
 config = {
     **default_envs,
@@ -23,6 +31,8 @@ config = {
 print(config)
 print(config["DB_DRIVER"])
 
+LOAD_MODES = ['incremental', 'replace']
+
 brazilian_regions = {
     'Norte': ['AC', 'AP', 'AM', 'PA', 'RO', 'RR', 'TO'], 
     'Nordeste': ['AL', 'BA', 'CE', 'MA', 'PB', 'PE', 'PI', 'RN', 'SE'], 
@@ -31,34 +41,81 @@ brazilian_regions = {
     'Sul': ['PR', 'RS', 'SC']
     }
 
-def loadBRStatesTaxRevenues():
+def parseNumericColumn(column):
+    """Converts a column to float, coercing values that are not valid numbers to NaN
+
+    :param column: A pandas Series of numbers or text
+    :type column: pandas.Series
+
+    :returns: the column as float
+    :rtype: pandas.Series
+    """
+
+    # astype is several times faster than to_numeric, which is only needed when there are invalid values
+    try:
+        return column.astype(np.float64)
+    except ValueError:
+        return pd.to_numeric(column, errors='coerce')
+
+def loadBRStatesTaxRevenues(chunksize=None):
     """Parses csv from brazilian tax revenue
     
     File data needs to come from: https://dados.gov.br/dados/conjuntos-dados/resultado-da-arrecadacao
     and it has to be defined in .env file as the variable DATA_FILENAME.
 
-    :returns: a pandas dataframe with all data from csv
+    The file is read in chunks of at most chunksize rows, and each chunk is added to a running
+    aggregation by region, year and state, so the memory used depends on the chunk size and on the
+    number of states and years, not on the size of the file. Chunks are not handed to
+    loadDataIntoDatabase one by one: the monthly rows of a state and year may span two chunks, and
+    only the complete sum is a cell of the ensemble.
+
+    :param chunksize: Maximum number of csv rows parsed at once, defaults to CSV_CHUNK_SIZE from .env
+    :type chunksize: int
+
+    :returns: a pandas dataframe with the yearly revenues of each state
     :rtype: pandas.DataFrame
     """
 
+    if chunksize is None:
+        chunksize = int(config["CSV_CHUNK_SIZE"])
     # inverse mapping
-    state_region = {}
-    for k,v in brazilian_regions.items():
-        for x in v:
-            state_region.setdefault(x, []).append(k)
-    df = pd.read_csv(config["DATA_FILENAME"], sep=';').fillna(0.0)
-    columns = df.columns.drop(['Ano', 'Mes', 'UF'])
-    df[columns] = df[columns].apply(pd.to_numeric, errors='coerce')
-    df['TOTAL ARRECADACAO'] = df[columns].sum(axis=1)
-    df['Regiao'] = df['UF'].apply(lambda x: state_region[x][0])
-    grouped = df.groupby(['Regiao', 'Ano', 'UF'], as_index=False).sum()
+    state_region = {state: region for region, states in brazilian_regions.items() for state in states}
+    header = pd.read_csv(config["DATA_FILENAME"], sep=';', nrows=0).columns
+    columns = header.drop(['Ano', 'Mes', 'UF'])
+    # Keys have fixed types. Value columns keep the numeric fast path of the parser, and since a chunk
+    # with an invalid number comes as text, every column is converted to float chunk by chunk
+    dtypes = {'Ano': np.int32, 'UF': str}
+    grouped = None
+    for chunk in pd.read_csv(config["DATA_FILENAME"], sep=';', dtype=dtypes, usecols=header.drop('Mes'), chunksize=chunksize):
+        values = pd.DataFrame({column: parseNumericColumn(chunk[column]) for column in columns})
+        values['TOTAL ARRECADACAO'] = values.sum(axis=1)
+        regions = chunk['UF'].map(state_region)
+        if regions.isna().any():
+            raise Exception("ERROR: unknown UF %s in %s" % (chunk['UF'][regions.isna()].iloc[0], config["DATA_FILENAME"]))
+        partial = values.groupby([regions.rename('Regiao'), chunk['Ano'], chunk['UF']]).sum()
+        grouped = partial if grouped is None else grouped.add(partial, fill_value=0.0)
+    grouped = grouped.sort_index().reset_index()
     print(grouped)
-    grouped = grouped.drop(columns=['Mes'])
     grouped = grouped[grouped['Ano'] != 2024]
     grouped = grouped.rename(columns={'Regiao': 'ensemble', 'Ano': 'time', 'UF': 'name'})
     return grouped
 
-def loadDataIntoDatabase(ensemble_data):
+def getDataFingerprint(ensemble_data):
+    """Returns a hash of the columns and values of a pandas DataFrame
+
+    :param ensemble_data: A pandas DataFrame in the format received by loadDataIntoDatabase
+    :type ensemble_data: pandas.DataFrame
+
+    :returns: the hexadecimal sha256 of the data
+    :rtype: str
+    """
+
+    digest = hashlib.sha256()
+    digest.update("\0".join(str(column) for column in ensemble_data.columns).encode())
+    digest.update(pd.util.hash_pandas_object(ensemble_data, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def loadDataIntoDatabase(ensemble_data, batch_size=None, mode=None):
     """Receives a pandas DataFrame formated and insert the data in the database
 
     The pandas DataFrame needs to have the following columns to be the indexes: 
@@ -66,56 +123,188 @@ def loadDataIntoDatabase(ensemble_data):
     Variables are going to be other columns and the values of these variables
     need to be numeric values.
 
+    Records are inserted in bulk: each table receives its records in batches of
+    at most batch_size records, and each batch is committed once.
+
+    In replace mode the tables are recreated and every record is inserted. In
+    incremental mode the tables are kept: ensembles, simulations and variables
+    are upserted by name, and only cells that are not in the database yet are
+    appended. Every run is recorded in load_manifest with its last committed
+    batch, so loading the same data after an interrupted run resumes from the
+    next batch, and loading data that was already loaded does nothing.
+
     :param ensemble_data: A pandas DataFrame with each row a value from a simulation in a certain cell
     :type ensemble_data: pandas.DataFrame
+    :param batch_size: Maximum number of cell records per insert, defaults to LOAD_BATCH_SIZE from .env
+    :type batch_size: int
+    :param mode: incremental or replace, defaults to LOAD_MODE from .env
+    :type mode: str
     """
 
+    if batch_size is None:
+        batch_size = int(config["LOAD_BATCH_SIZE"])
+    if mode is None:
+        mode = config["LOAD_MODE"]
+    if mode not in LOAD_MODES:
+        raise Exception("Load mode %s not yet implemented" % mode)
+    replace = mode == 'replace'
     ensemble_list = ensemble_data['ensemble'].unique()
-    ensemble_id_map = {}
-    simulation_list = ensemble_data['name'].unique()
-    simulation_id_map = {}
+    simulation_ensembles = ensemble_data.groupby('name', sort=False)['ensemble'].first()
     variable_list = ensemble_data.columns.drop(['ensemble', 'time', 'name'])
-    variable_id_map = {}
     ensemble_model = Ensemble.Ensemble()
     simulation_model = Simulation.Simulation()
     variable_model = Variable.Variable()
     cell_data_model = CellData.CellData()
-    # TODO: Create one model for each table, after remove these drops
-    #ensemble_model.get_cursor().execute("DROP TABLE IF EXISTS cell")
-    #ensemble_model.get_cursor().execute("DROP TABLE IF EXISTS variable")
-    #ensemble_model.get_cursor().execute("DROP TABLE IF EXISTS simulation")
-    ensemble_model.create_table()
-    simulation_model.create_table()
-    variable_model.create_table()
-    cell_data_model.create_table()
-    for ensemble_name in ensemble_list:
-        record = {"name": ensemble_name}
-        uuid = ensemble_model.insert_one(record)
-        ensemble_id_map[ensemble_name] = uuid
-    for simulation_name in simulation_list:
-        ensemble_from_simulation = ensemble_data.loc[ensemble_data['name'] == simulation_name]['ensemble'].iloc[0]
-        record = {"name": simulation_name, "ensemble_id": ensemble_id_map[ensemble_from_simulation]}
-        uuid = simulation_model.insert_one(record)
-        simulation_id_map[simulation_name] = uuid
-    for variable_name in variable_list:
-        record = {"name": variable_name}
-        uuid = variable_model.insert_one(record)
-        variable_id_map[variable_name] = uuid
-    for index, row in ensemble_data.iterrows():
-        for variable_name in variable_list:
-            simulation_id = simulation_id_map[row['name']]
-            variable_id = variable_id_map[variable_name]
-            record = {
-                "value": float(row[variable_name]),
-                "simulation_id": simulation_id, 
-                "variable_id": variable_id, 
-                "timestep": float(row['time']), 
+    load_manifest_model = LoadManifest.LoadManifest()
+    ensemble_model.create_table(replace=replace)
+    simulation_model.create_table(replace=replace)
+    variable_model.create_table(replace=replace)
+    cell_data_model.create_table(replace=replace)
+    load_manifest_model.create_table(replace=replace)
+    if len(variable_list) == 0:
+        print("No variables to load")
+        return
+
+    fingerprint = getDataFingerprint(ensemble_data)
+    last_run = None if replace else load_manifest_model.get_latest_run(fingerprint)
+    if last_run is not None and last_run[5] == 'complete':
+        print("Data %s was already loaded" % fingerprint)
+        return
+    if last_run is not None:
+        # Resume with the batches of the interrupted run
+        manifest_id, batch_size, batch_count, last_batch, cell_count, _ = last_run
+        print("Resuming load %s after batch %s of %s" % (manifest_id, last_batch, batch_count))
+    rows_per_batch = max(1, batch_size // len(variable_list))
+    if last_run is None:
+        batch_count = -(-len(ensemble_data) // rows_per_batch)
+        manifest_id = load_manifest_model.insert_one(
+            {"fingerprint": fingerprint, "mode": mode, "batch_size": batch_size, "batch_count": batch_count}
+        )
+        last_batch = -1
+        cell_count = 0
+
+    # Tables are empty in replace mode, so there are no names to look up
+    upsert_ensembles = ensemble_model.insert_many if replace else ensemble_model.upsert_many
+    upsert_simulations = simulation_model.insert_many if replace else simulation_model.upsert_many
+    upsert_variables = variable_model.insert_many if replace else variable_model.upsert_many
+    ensemble_id_map = dict(zip(
+        ensemble_list,
+        upsert_ensembles([{"name": str(name)} for name in ensemble_list])
+    ))
+    simulation_id_map = dict(zip(
+        simulation_ensembles.index,
+        upsert_simulations([
+            {"name": str(simulation_name), "ensemble_id": ensemble_id_map[ensemble_name]}
+            for simulation_name, ensemble_name in simulation_ensembles.items()
+        ])
+    ))
+    variable_id_map = dict(zip(
+        variable_list,
+        upsert_variables([{"name": str(name)} for name in variable_list])
+    ))
+
+    # One row per (simulation, variable, timestep), which is the layout of cell_data. The frame is
+    # melted a few rows at a time, so each batch is built right before it is inserted
+    for batch in range(last_batch + 1, batch_count):
+        rows = ensemble_data.iloc[batch * rows_per_batch:(batch + 1) * rows_per_batch]
+        cells = rows.melt(id_vars=['name', 'time'], value_vars=variable_list, var_name='variable', value_name='value')
+        records = [
+            {
+                "value": value,
+                "simulation_id": simulation_id,
+                "variable_id": variable_id,
+                "timestep": timestep,
             }
-            cell_data_model.insert_one(record)
+            for simulation_id, variable_id, timestep, value in zip(
+                cells['name'].map(simulation_id_map).tolist(),
+                cells['variable'].map(variable_id_map).tolist(),
+                cells['time'].astype(float).tolist(),
+                cells['value'].astype(float).tolist()
+            )
+        ]
+        if replace:
+            cell_count += len(cell_data_model.insert_many(records))
+        else:
+            cell_count += cell_data_model.append_many(records)
+        load_manifest_model.update_progress(manifest_id, batch, cell_count)
+    load_manifest_model.complete(manifest_id)
+    print("Load %s complete: %s new cells" % (manifest_id, cell_count))
+
+def loadFieldsIntoStore(grid_name, x, y, simulations, timesteps, variables, fields, shape=None, chunk_cells=None, dtype=None):
+    """Writes the fields of a grid or mesh into a chunked store and registers the grid in the database
+
+    Fields are not rows of cell_data: their values go to a store in a new directory of
+    FIELD_DIRECTORY (see service.FieldStore) and the grid table records where it is. Fields are
+    written one at a time as they come from the iterable, so the memory used depends on the number
+    of cells of the grid, not on the number of simulations, timesteps or variables. A grid loaded
+    again under the same name replaces the previous one, whose store is removed once the new one
+    is registered.
+
+    :param grid_name: name of the grid
+    :type grid_name: str
+    :param x: x of the center of each cell, by cell id
+    :type x: numpy.ndarray
+    :param y: y of the center of each cell, by cell id
+    :type y: numpy.ndarray
+    :param simulations: (ensemble, name) of every simulation with fields
+    :type simulations: list
+    :param timesteps: every timestep with fields
+    :type timesteps: list
+    :param variables: the names of the field variables
+    :type variables: list
+    :param fields: (simulation name, timestep, variable name, value of each cell by cell id) of each field
+    :type fields: iterable
+    :param shape: (rows, columns) of a regular grid whose cell ids go row by row, None for a mesh
+    :type shape: tuple
+    :param chunk_cells: number of cells of each chunk of the store, defaults to FIELD_CHUNK_CELLS from .env
+    :type chunk_cells: int
+    :param dtype: precision of the values, float64 or float32, defaults to FIELD_DTYPE from .env
+    :type dtype: str
+    """
+
+    if chunk_cells is None:
+        chunk_cells = int(config["FIELD_CHUNK_CELLS"])
+    if dtype is None:
+        dtype = config["FIELD_DTYPE"]
+    grid_model = Grid.Grid()
+    grid_model.create_table(replace=False)
+    previous = grid_model.read_by_name(grid_name)
+
+    # Grid names are free text, so directories are named after a hash of the name and the load time
+    directory = os.path.join(
+        config["FIELD_DIRECTORY"],
+        "%s-%d" % (hashlib.sha256(grid_name.encode()).hexdigest()[:16], time.time_ns())
+    )
+    store = FieldStore.FieldStore.create(directory, x, y, simulations, timesteps, variables, shape, chunk_cells, dtype)
+    field_count = 0
+    for simulation_name, timestep, variable_name, values in fields:
+        store.write(variable_name, simulation_name, timestep, values)
+        field_count += 1
+    store.finish()
+
+    min_x, min_y, max_x, max_y = store.bounds
+    grid_model.insert_one({
+        "name": grid_name,
+        "kind": store.kind,
+        "cell_count": len(store.x),
+        "nx": store.shape[1] if store.shape else 0,
+        "ny": store.shape[0] if store.shape else 0,
+        "min_x": min_x,
+        "min_y": min_y,
+        "max_x": max_x,
+        "max_y": max_y,
+        "chunk_cells": chunk_cells,
+        "directory": directory,
+    })
+    if previous is not None:
+        grid_model.delete(previous[0])
+        shutil.rmtree(previous[-1], ignore_errors=True)
+    print("Grid %s complete: %s fields of %s cells" % (grid_name, field_count, len(store.x)))
 
-data = loadBRStatesTaxRevenues()
+if __name__ == '__main__':
+    data = loadBRStatesTaxRevenues()
+    loadDataIntoDatabase(data)
 
-loadDataIntoDatabase(data)
 #def connect_monet_db():
 #    try:
 #        with pymonetdb.connect(username="monetdb", password="monetdb", hostname="localhost", database="ensemble") as db:
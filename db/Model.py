@@ -1,9 +1,14 @@
 from dotenv import dotenv_values
 #from surrealdb import Surreal
-import pymonetdb
 import sqlite3
+from uuid import UUID
 #import asyncio
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from service import Metrics
+import os
+import threading
+import time
 
 default_envs = {
     "DB_DRIVER": "monetdb",
@@ -12,6 +17,9 @@ default_envs = {
     "DB_DATABASE": "ensemble",
     "DB_USERNAME": "ensemble",
     "DB_PASSWORD": "ensemble",
+    "DB_POOL_SIZE": 8,
+    "DB_POOL_TIMEOUT": 30,
+    "DB_POOL_PING_INTERVAL": 30,
     "DATA_FILENAME": "data.csv"
     }
 config = {
@@ -21,59 +29,395 @@ config = {
 print(config)
 print(config["DB_DRIVER"])
 
+class ConnectionPool:
+    """A thread-safe pool of database connections shared by every model of the process
+
+    Connections are created on demand up to the size of the pool, and an operation that needs a
+    connection when all of them are checked out waits for one to be returned. A connection that
+    stayed idle for longer than the ping interval is checked with a trivial query before being
+    handed out, and replaced by a new one if the check fails.
+    """
+
+    def __init__(self, driver, size, timeout, ping_interval):
+        """Creates an empty pool
+
+        :param driver: the database driver, monetdb or sqlite
+        :type driver: str
+        :param size: maximum number of open connections
+        :type size: int
+        :param timeout: seconds to wait for a connection before failing
+        :type timeout: float
+        :param ping_interval: idle seconds after which a connection is checked before use
+        :type ping_interval: float
+        """
+
+        self.driver = driver
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.pid = os.getpid()
+        # Idle connections with the time they were released, the most recently released last
+        self.__idle = []
+        self.__opened = 0
+        self.__prepared_statements = {}
+        self.__lock = threading.Lock()
+        # Notified whenever a connection is released or discarded, waking an acquire that waits
+        self.__available = threading.Condition(self.__lock)
+
+    def acquire(self):
+        """Checks out a healthy connection, creating it if the pool is not full
+
+        :returns: a database connection
+        :rtype: object
+        """
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.__available:
+                while not self.__idle and self.__opened >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Exception("No database connection available after %s seconds" % self.timeout)
+                    self.__available.wait(remaining)
+                if self.__idle:
+                    con, released_at = self.__idle.pop()
+                else:
+                    con = None
+                    self.__opened += 1
+            if con is None:
+                try:
+                    return self.__create_connection()
+                except Exception:
+                    with self.__available:
+                        self.__opened -= 1
+                        self.__available.notify()
+                    raise
+            if time.monotonic() - released_at < self.ping_interval or self.__is_healthy(con):
+                return con
+            self.discard(con)
+
+    def release(self, con):
+        """Returns a connection to the pool
+
+        :param con: a connection obtained from acquire
+        :type con: object
+        """
+
+        with self.__available:
+            self.__idle.append((con, time.monotonic()))
+            self.__available.notify()
+
+    def discard(self, con):
+        """Closes a broken connection, so a new one can be opened in its place
+
+        :param con: a connection obtained from acquire
+        :type con: object
+        """
+
+        try:
+            con.close()
+        except Exception:
+            pass
+        with self.__available:
+            self.__opened -= 1
+            self.__prepared_statements.pop(id(con), None)
+            self.__available.notify()
+
+    def get_prepared_statements(self, con):
+        """Returns the ids of the statements prepared in a connection, by query text
+
+        :param con: a connection obtained from acquire
+        :type con: object
+
+        :rtype: dict
+        """
+
+        with self.__lock:
+            return self.__prepared_statements.setdefault(id(con), {})
+
+    def stats(self):
+        """Returns the number of open and idle connections of the pool
+
+        :rtype: dict
+        """
+
+        with self.__lock:
+            return {"size": self.size, "opened": self.__opened, "idle": len(self.__idle)}
+
+    def __create_connection(self):
+        """Creates the database connection according to the driver set
+        """
+
+        if self.driver == "monetdb":
+            import pymonetdb
+            return pymonetdb.connect(username=config["DB_USERNAME"], password=config["DB_PASSWORD"], hostname=config["DB_HOSTNAME"], port=config["DB_PORT"], database=config["DB_DATABASE"])
+        elif self.driver == "sqlite":
+            # The pool guarantees a connection is used by one thread at a time
+            return sqlite3.connect("ensemble.db", check_same_thread=False)
+        else:
+            raise Exception("Database driver %s not yet implemented" % self.driver)
+
+    @staticmethod
+    def __is_healthy(con):
+        try:
+            cur = con.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            con.rollback()
+            return True
+        except Exception:
+            return False
+
+_pool = None
+_pool_lock = threading.Lock()
+# Cursor of the transaction open in each thread, joined by the transactions opened inside it
+_open_transaction = threading.local()
+
+def get_pool():
+    """Returns the connection pool of the process, creating it on first use
+
+    A process created by fork gets a new pool instead of sharing the connections of its parent.
+
+    :rtype: ConnectionPool
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(
+                config["DB_DRIVER"],
+                int(config["DB_POOL_SIZE"]),
+                float(config["DB_POOL_TIMEOUT"]),
+                float(config["DB_POOL_PING_INTERVAL"])
+            )
+        return _pool
+
+class TimedCursor:
+    """Wraps a cursor to count and time the queries executed with it
+
+    The duration of each query goes to the histogram db.<model> and the time spent fetching its
+    rows to db.<model>.fetch, since SQLite only runs most of a query while the rows are fetched.
+    Both are also added to the db stage of the request being served by the thread, if any. Every other attribute is read from the cursor.
+    """
+
+    def __init__(self, cursor, name):
+        """
+        :param cursor: the cursor of a connection
+        :type cursor: object
+        :param name: name of the histogram, db.<model>
+        :type name: str
+        """
+
+        self.cursor = cursor
+        self.name = name
+
+    def execute(self, *args, **kwargs):
+        with Metrics.timer(self.name, "db"):
+            return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with Metrics.timer(self.name, "db"):
+            return self.cursor.executemany(*args, **kwargs)
+
+    def fetchone(self):
+        with Metrics.timer(self.name + ".fetch", "db"):
+            return self.cursor.fetchone()
+
+    def fetchall(self):
+        with Metrics.timer(self.name + ".fetch", "db"):
+            return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        with Metrics.timer(self.name + ".fetch", "db"):
+            return self.cursor.fetchmany(size)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
 class Model(ABC):
     """An abstract class with some basic implementation to be a base for data models
 
-    It implements the connection creation, returns the cursor from the database and commits the executed queries.
-    Other methods are abstract methods.
+    It checks out connections from the pool of the process, returns cursors from the database and commits the
+    executed queries. Other methods are abstract methods.
 
     For now, it only supports pymonetdb as the database driver. In the future it may support more drivers, but it
     needs to be more general to support more different DBMS.
     """
 
     def __init__(self):
-        """Sets the database driver according to what is in the variable DB_DRIVER in .env file and
-        creates the connection to the database.
+        """Sets the database driver according to what is in the variable DB_DRIVER in .env file.
+
+        No connection is kept by the model: each operation checks one out from the pool.
         """
 
         self.__driver = config["DB_DRIVER"]
-        self.__con = self.__create_connection()
-        self.__cur = self.__con.cursor()
-    
-    def __create_connection(self):
-        """Creates the database connection according to the driver set
+
+    def get_driver(self):
+        """Returns the driver used by the model
+        """
+        return self.__driver
+
+    def _execute(self, cursor, query, parameters=()):
+        """Executes a query with bound parameters
+
+        Queries are written with ``?`` placeholders. SQLite binds the parameters itself and reuses the
+        compiled statement from its statement cache. With MonetDB the query is prepared once per
+        connection with ``PREPARE`` and then run with ``EXEC``, so the server only parses and plans it
+        once. The values are never formatted into the query text by the caller: SQLite binds them, and
+        pymonetdb escapes them when it formats the arguments of ``EXEC`` on the client.
+
+        :param cursor: cursor from transaction
+        :type cursor: object
+        :param query: the query, with one ? for each parameter
+        :type query: str
+        :param parameters: the values of the parameters
+        :type parameters: tuple
         """
 
+        parameters = tuple(str(value) if isinstance(value, UUID) else value for value in parameters)
         if self.__driver == "monetdb":
-            return pymonetdb.connect(username=config["DB_USERNAME"], password=config["DB_PASSWORD"], hostname=config["DB_HOSTNAME"], port=config["DB_PORT"], database=config["DB_DATABASE"])
+            statements = get_pool().get_prepared_statements(cursor.connection)
+            statement_id = statements.get(query)
+            if statement_id is None:
+                cursor.execute("PREPARE " + query)
+                statement_id = statements[query] = cursor.lastrowid
+            cursor.execute("EXEC %d(%s)" % (statement_id, ", ".join(["%s"] * len(parameters))), parameters or None)
         elif self.__driver == "sqlite":
-            return sqlite3.connect("ensemble.db")
+            cursor.execute(query, parameters)
         else:
             raise Exception("Database driver %s not yet implemented" % self.__driver)
 
-    def get_driver(self):
-        """Returns the driver used by the model
+    @contextmanager
+    def transaction(self, join=True):
+        """Checks out a connection for one operation and yields its cursor
+
+        The queries executed with the cursor are committed when the block ends, or rolled back if it
+        raises an exception. Connections that fail while rolling back are discarded, so the pool
+        reconnects instead of handing them out again.
+
+        A transaction opened inside another one in the same thread joins it: its queries run on the
+        same connection and are committed or rolled back with the outer transaction. With SQLite the
+        transaction is started explicitly, so that table definitions are part of it too.
+
+        :param join: joins the transaction open in this thread, if any. Without join, the transaction
+            has a connection of its own that other transactions do not join, e.g. for a generator that
+            keeps a result set open while its caller runs other queries
+        :type join: bool
         """
-        return self.__driver
 
-    def get_cursor(self):
-        """Returns the database cursor to execute queries
+        if self.__driver != "monetdb" and self.__driver != "sqlite":
+            raise Exception("Database driver %s not yet implemented" % self.__driver)
+        outer = getattr(_open_transaction, "cursor", None)
+        if join and outer is not None:
+            yield outer
+            return
+        pool = get_pool()
+        con = pool.acquire()
+        try:
+            if self.__driver == "sqlite" and not con.in_transaction:
+                con.execute("BEGIN")
+            cur = TimedCursor(con.cursor(), "db." + type(self).__name__)
+            if not join:
+                yield cur
+            else:
+                _open_transaction.cursor = cur
+                try:
+                    yield cur
+                finally:
+                    _open_transaction.cursor = None
+            con.commit()
+        except BaseException:
+            try:
+                con.rollback()
+            except Exception:
+                pool.discard(con)
+                raise
+            pool.release(con)
+            raise
+        else:
+            pool.release(con)
+
+    def _table_exists(self, cursor, table):
+        """Checks if a table exists in the database
+
+        :param cursor: cursor from transaction
+        :type cursor: object
+        :param table: name of the table
+        :type table: str
+
+        :returns: True if the table exists
+        :rtype: bool
         """
 
-        if self.__driver == "monetdb" or self.__driver == "sqlite":
-            return self.__cur
+        if self.__driver == "monetdb":
+            self._execute(cursor, "SELECT COUNT(*) FROM sys.tables WHERE name = ? AND NOT system", (table,))
         else:
-            raise Exception("Database driver %s not yet implemented" % self.__driver)
-        
-    def commit(self):
-        """Commits all executes queries to the database
+            self._execute(cursor, "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        return cursor.fetchone()[0] > 0
+
+    def _next_ids(self, cursor, table, count):
+        """Reserves sequential integer ids for new records of a table
+
+        Ids continue from the largest id in the table, so they need to be reserved in the same
+        transaction that inserts the records.
+
+        :param cursor: cursor from transaction
+        :type cursor: object
+        :param table: name of the table
+        :type table: str
+        :param count: number of ids
+        :type count: int
+
+        :returns: the reserved ids
+        :rtype: list
         """
 
-        if self.__driver == "monetdb" or self.__driver == "sqlite":
-            self.__con.commit()
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM %s" % table)
+        first = int(cursor.fetchone()[0]) + 1
+        return list(range(first, first + count))
+
+    def _bulk_insert(self, cursor, table, columns, rows):
+        """Inserts many rows in a table using the fastest path available for the driver
+
+        With MonetDB all rows are sent in a single ``COPY INTO ... FROM STDIN`` statement, and with
+        SQLite they are sent through ``executemany``. It does not commit, so the caller decides
+        where the transaction ends.
+
+        :param cursor: cursor from transaction
+        :type cursor: object
+        :param table: name of the table
+        :type table: str
+        :param columns: names of the columns, in the same order as the values in each row
+        :type columns: list
+        :param rows: the rows to be inserted, each one a tuple of values
+        :type rows: list
+        """
+
+        if not rows:
+            return
+        if self.__driver == "monetdb":
+            data = "\n".join("|".join(self.__copy_field(value) for value in row) for row in rows)
+            cursor.execute(
+                "COPY %d RECORDS INTO %s (%s) FROM STDIN USING DELIMITERS '|', E'\\n', '\"' NULL AS '';\n%s\n"
+                % (len(rows), table, ", ".join(columns), data)
+            )
+        elif self.__driver == "sqlite":
+            cursor.executemany(
+                "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), ", ".join("?" * len(columns))),
+                [tuple(str(value) if isinstance(value, UUID) else value for value in row) for row in rows]
+            )
         else:
             raise Exception("Database driver %s not yet implemented" % self.__driver)
 
+    @staticmethod
+    def __copy_field(value):
+        """Formats one value as a field of the text sent to MonetDB by ``COPY INTO``
+        """
+
+        if isinstance(value, str):
+            return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+        return str(value)
+
     # NOTE: Maybe, in the future, we are going to make a more generic implementation of a query    
     #def execute_query(self, query):
     #    if self.__driver == "monetdb":
@@ -82,8 +426,11 @@ class Model(ABC):
     #        raise Exception("Database driver %s not yet implemented" % self.__driver)
     
     @abstractmethod
-    def create_table(self):
+    def create_table(self, replace=True):
         """Abstract method for the model to create table in the database
+
+        :param replace: drops the table if it exists, otherwise an existing table is kept as it is
+        :type replace: bool
         """
         
         pass
@@ -95,12 +442,27 @@ class Model(ABC):
         :param record: A record which schema needs to be defined by the model
         :type record: object
 
-        :returns: uuid from added record in the database
-        :rtype: UUID 
+        :returns: id from added record in the database
+        :rtype: int
         """
 
         pass
     
+    @abstractmethod
+    def insert_many(self, records):
+        """Abstract method for the model to insert a batch of records in the database
+
+        The whole batch is validated at once and committed in a single transaction.
+
+        :param records: A list of records which schema needs to be defined by the model
+        :type records: list
+
+        :returns: ids from added records in the database, in the same order as the records
+        :rtype: list
+        """
+
+        pass
+
     @abstractmethod
     def read_all(self):
         """Abstract method for the model to return all records from a certain model
@@ -112,11 +474,11 @@ class Model(ABC):
         pass
 
     @abstractmethod
-    def read_one(self, uuid):
+    def read_one(self, id):
         """Abstract method for the model to return a specific record
 
-        :param uuid: uuid of a record
-        :type uuid: UUID
+        :param id: id of a record
+        :type id: int
 
         :returns: a record from the database
         :rtype: object
@@ -0,0 +1,139 @@
+from model import Ensemble, Simulation, Variable, CellData
+import sys
+import time
+
+V1_TABLES = ['ensemble', 'simulation', 'variable', 'cell_data']
+SCAN_QUERIES = {
+    "scan": "SELECT COUNT(*), SUM(value) FROM cell_data",
+    "frame query": "SELECT e.name, s.name, v.name, cd.timestep, cd.value FROM cell_data AS cd, simulation AS s, variable AS v, ensemble AS e WHERE s.id = cd.simulation_id AND v.id = cd.variable_id AND e.id = s.ensemble_id",
+}
+
+def getTableColumns(model, table):
+    """Returns the names of the columns of a table
+
+    :param model: any model, used to reach the database
+    :type model: db.Model.Model
+    :param table: name of the table
+    :type table: str
+
+    :returns: names of the columns
+    :rtype: list
+    """
+
+    with model.transaction() as cursor:
+        if model.get_driver() == "monetdb":
+            model._execute(cursor, "SELECT c.name FROM sys.columns AS c, sys.tables AS t WHERE c.table_id = t.id AND t.name = ?", (table,))
+            return [row[0] for row in cursor.fetchall()]
+        else:
+            cursor.execute("PRAGMA table_info(%s)" % table)
+            return [row[1] for row in cursor.fetchall()]
+
+def measureCellData(model, repetitions=3):
+    """Measures the storage size of cell_data and the time of the queries that scan it
+
+    The size includes the indexes of the table. Each query is run a few times and the fastest
+    run is reported.
+
+    :param model: any model, used to reach the database
+    :type model: db.Model.Model
+    :param repetitions: number of runs of each query
+    :type repetitions: int
+
+    :returns: the size in bytes and the time in seconds of each query
+    :rtype: tuple
+    """
+
+    with model.transaction() as cursor:
+        if model.get_driver() == "monetdb":
+            cursor.execute("SELECT SUM(columnsize + heapsize + hashes + imprints + orderidx) FROM sys.storage WHERE \"table\" = 'cell_data'")
+        else:
+            cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = 'cell_data')")
+        size = cursor.fetchone()[0]
+        timings = {}
+        for name, query in SCAN_QUERIES.items():
+            runs = []
+            for _ in range(repetitions):
+                start = time.perf_counter()
+                cursor.execute(query)
+                cursor.fetchall()
+                runs.append(time.perf_counter() - start)
+            timings[name] = min(runs)
+    return size, timings
+
+def migrateSchema(keep_v1=False):
+    """Migrates the database from the schema with UUID keys (v1) to the compact schema (v2)
+
+    The v1 tables are copied to tables with the _v1 suffix, the models create the v2 tables and the
+    records are inserted again with integer ids, all in a single transaction. The keys of cell_data are translated inside the
+    database, through tables mapping old to new ids, so the values never go through Python. The size
+    of cell_data and the time to scan it are measured before and after the migration.
+
+    :param keep_v1: keeps the _v1 tables after the migration instead of dropping them
+    :type keep_v1: bool
+    """
+
+    ensemble_model = Ensemble.Ensemble()
+    simulation_model = Simulation.Simulation()
+    variable_model = Variable.Variable()
+    cell_data_model = CellData.CellData()
+    monetdb = cell_data_model.get_driver() == "monetdb"
+    if 'id' not in getTableColumns(cell_data_model, 'cell_data'):
+        print("cell_data already uses the schema v2")
+        return
+    size_v1, timings_v1 = measureCellData(cell_data_model)
+
+    # Everything runs in one transaction, which the transactions of the models join, so an
+    # interrupted migration leaves the v1 tables untouched and no _v1 copies behind
+    with cell_data_model.transaction() as cursor:
+        # Copy the v1 tables aside, since create_table replaces them
+        for table in V1_TABLES:
+            cursor.execute("CREATE TABLE %s_v1 AS SELECT * FROM %s%s" % (table, table, " WITH DATA" if monetdb else ""))
+        for model in (ensemble_model, simulation_model, variable_model, cell_data_model):
+            model.create_table()
+
+        cursor.execute("SELECT id, name FROM ensemble_v1")
+        ensembles = cursor.fetchall()
+        cursor.execute("SELECT id, name, ensemble_id FROM simulation_v1")
+        simulations = cursor.fetchall()
+        cursor.execute("SELECT id, name FROM variable_v1")
+        variables = cursor.fetchall()
+        ensemble_id_map = dict(zip(
+            [str(id) for id, _ in ensembles],
+            ensemble_model.insert_many([{"name": name} for _, name in ensembles])
+        ))
+        simulation_id_map = dict(zip(
+            [str(id) for id, _, _ in simulations],
+            simulation_model.insert_many([
+                {"name": name, "ensemble_id": ensemble_id_map[str(ensemble_id)]} for _, name, ensemble_id in simulations
+            ])
+        ))
+        variable_id_map = dict(zip(
+            [str(id) for id, _ in variables],
+            variable_model.insert_many([{"name": name} for _, name in variables])
+        ))
+
+        # Translate the keys of cell_data inside the database
+        for table, id_map in (("simulation_id_map", simulation_id_map), ("variable_id_map", variable_id_map)):
+            cursor.execute("CREATE TABLE %s (old_id VARCHAR(36) NOT NULL PRIMARY KEY, new_id INTEGER NOT NULL)" % table)
+            cell_data_model._bulk_insert(cursor, table, ["old_id", "new_id"], list(id_map.items()))
+        cursor.execute("""
+                       INSERT INTO cell_data (simulation_id, variable_id, timestep, value)
+                       SELECT sm.new_id, vm.new_id, CAST(cd.timestep AS DOUBLE), CAST(cd.value AS DOUBLE)
+                       FROM cell_data_v1 AS cd, simulation_id_map AS sm, variable_id_map AS vm
+                       WHERE sm.old_id = CAST(cd.simulation_id AS VARCHAR(36))
+                       AND vm.old_id = CAST(cd.variable_id AS VARCHAR(36))
+                       """)
+        cursor.execute("DROP TABLE simulation_id_map")
+        cursor.execute("DROP TABLE variable_id_map")
+        if not keep_v1:
+            for table in reversed(V1_TABLES):
+                cursor.execute("DROP TABLE %s_v1" % table)
+    size_v2, timings_v2 = measureCellData(cell_data_model)
+
+    print("%-20s %15s %15s" % ("cell_data", "v1", "v2"))
+    print("%-20s %15s %15s" % ("size (bytes)", size_v1, size_v2))
+    for name in SCAN_QUERIES:
+        print("%-20s %15.4f %15.4f" % (name + " (s)", timings_v1[name], timings_v2[name]))
+
+if __name__ == '__main__':
+    migrateSchema(keep_v1='--keep-v1' in sys.argv)
@@ -1,88 +1,186 @@
 from db.Model import Model
 from schema import Schema, And, Use, Optional, SchemaError
-from uuid import UUID, uuid4
 
 schema_record = Schema(
     {
         "value": float,
-        "simulation_id": UUID,
-        "variable_id": UUID,
+        "simulation_id": int,
+        "variable_id": int,
         "timestep": float,
     }
 )
+schema_batch = Schema([schema_record])
 
 class CellData(Model):
     def __init__(self) -> None:
         super().__init__()
 
-    def create_table(self):
-        if self.get_driver() == "monetdb":
-            self.get_cursor().execute("DROP TABLE IF EXISTS cell_data CASCADE")
-            self.get_cursor().execute("""
-                                CREATE TABLE IF NOT EXISTS cell_data (
-                                    id UUID NOT NULL PRIMARY KEY, 
-                                    timestep DECIMAL NOT NULL,
-                                    simulation_id UUID NOT NULL,
-                                    variable_id UUID NOT NULL,
-                                    value DECIMAL NOT NULL,
-                                    FOREIGN KEY(simulation_id) REFERENCES simulation(id),
-                                    FOREIGN KEY(variable_id) REFERENCES variable(id)
-                                )
-                                      """)
-        else:
-            self.get_cursor().execute("DROP TABLE IF EXISTS cell_data")
-            self.get_cursor().execute("""
-                                CREATE TABLE IF NOT EXISTS cell_data (
-                                    id TEXT NOT NULL PRIMARY KEY, 
-                                    timestep DECIMAL NOT NULL,
-                                    simulation_id TEXT NOT NULL,
-                                    variable_id TEXT NOT NULL,
-                                    value DECIMAL NOT NULL,
-                                    FOREIGN KEY(simulation_id) REFERENCES simulation(id),
-                                    FOREIGN KEY(variable_id) REFERENCES variable(id)
-                                )
-                                      """)
-        self.commit()
+    def create_table(self, replace=True):
+        with self.transaction() as cursor:
+            if not replace and self._table_exists(cursor, "cell_data"):
+                return
+            if self.get_driver() == "monetdb":
+                cursor.execute("DROP TABLE IF EXISTS cell_data CASCADE")
+                cursor.execute("""
+                                    CREATE TABLE IF NOT EXISTS cell_data (
+                                        simulation_id INTEGER NOT NULL,
+                                        variable_id INTEGER NOT NULL,
+                                        timestep DOUBLE NOT NULL,
+                                        value DOUBLE NOT NULL,
+                                        PRIMARY KEY(simulation_id, variable_id, timestep),
+                                        FOREIGN KEY(simulation_id) REFERENCES simulation(id),
+                                        FOREIGN KEY(variable_id) REFERENCES variable(id)
+                                    )
+                                          """)
+                self._create_indexes(cursor)
+            else:
+                cursor.execute("DROP TABLE IF EXISTS cell_data")
+                cursor.execute("""
+                                    CREATE TABLE IF NOT EXISTS cell_data (
+                                        simulation_id INTEGER NOT NULL,
+                                        variable_id INTEGER NOT NULL,
+                                        timestep DOUBLE NOT NULL,
+                                        value DOUBLE NOT NULL,
+                                        PRIMARY KEY(simulation_id, variable_id, timestep),
+                                        FOREIGN KEY(simulation_id) REFERENCES simulation(id),
+                                        FOREIGN KEY(variable_id) REFERENCES variable(id)
+                                    ) WITHOUT ROWID
+                                          """)
+                self._create_indexes(cursor)
+
+    def _create_indexes(self, cursor):
+        # Lookups by simulation and timestep, and by variable
+        cursor.execute("CREATE INDEX cell_data_simulation_timestep ON cell_data (simulation_id, timestep)")
+        cursor.execute("CREATE INDEX cell_data_variable ON cell_data (variable_id)")
 
     def insert_one(self, record):
         if (schema_record.is_valid(record)):
-            uuid = uuid4()
-            if self.get_driver() == "monetdb":
-                self.get_cursor().execute("""
-                                INSERT INTO cell_data (id, simulation_id, variable_id, timestep, value) 
-                                VALUES (uuid\'%s\', uuid\'%s\', uuid\'%s\', %s, %s)
-                                                              """
-                                % (uuid, record["simulation_id"], record["variable_id"], record['timestep'], record["value"])
-                                )
-            else:
-                self.get_cursor().execute("""
-                                INSERT INTO cell_data (id, simulation_id, variable_id, timestep, value) 
-                                VALUES (\"%s\", \"%s\", \"%s\", %s, %s)
-                                                              """
-                                % (uuid, record["simulation_id"], record["variable_id"], record['timestep'], record["value"])
-                                )
-            self.commit()
-            return uuid
+            key = (record["simulation_id"], record["variable_id"], record["timestep"])
+            with self.transaction() as cursor:
+                self._execute(
+                    cursor,
+                    "INSERT INTO cell_data (simulation_id, variable_id, timestep, value) VALUES (?, ?, ?, ?)",
+                    key + (record["value"],)
+                )
+            return key
         else:
             schema_record.validate(record)
             raise Exception("ERROR: record structure is not valid to be inserted in the database.")
+
+    def insert_many(self, records):
+        if (schema_batch.is_valid(records)):
+            rows = [(record["simulation_id"], record["variable_id"], record["timestep"], record["value"]) for record in records]
+            with self.transaction() as cursor:
+                self._bulk_insert(cursor, "cell_data", ["simulation_id", "variable_id", "timestep", "value"], rows)
+            return [row[:3] for row in rows]
+        else:
+            schema_batch.validate(records)
+            raise Exception("ERROR: record batch structure is not valid to be inserted in the database.")
+
+    def append_many(self, records):
+        # Cells already in the table are skipped, so the same batch can be appended again safely
+        if (schema_batch.is_valid(records)):
+            rows = [(record["simulation_id"], record["variable_id"], record["timestep"], record["value"]) for record in records]
+            with self.transaction() as cursor:
+                if self.get_driver() == "monetdb":
+                    cursor.execute("CREATE LOCAL TEMPORARY TABLE cell_data_staging (simulation_id INTEGER NOT NULL, variable_id INTEGER NOT NULL, timestep DOUBLE NOT NULL, value DOUBLE NOT NULL) ON COMMIT DROP")
+                else:
+                    cursor.execute("DROP TABLE IF EXISTS temp.cell_data_staging")
+                    cursor.execute("CREATE TEMP TABLE cell_data_staging (simulation_id INTEGER NOT NULL, variable_id INTEGER NOT NULL, timestep DOUBLE NOT NULL, value DOUBLE NOT NULL)")
+                self._bulk_insert(cursor, "cell_data_staging", ["simulation_id", "variable_id", "timestep", "value"], rows)
+                cursor.execute("""
+                               INSERT INTO cell_data (simulation_id, variable_id, timestep, value)
+                               SELECT st.simulation_id, st.variable_id, st.timestep, st.value
+                               FROM cell_data_staging AS st
+                               WHERE NOT EXISTS (
+                                   SELECT 1 FROM cell_data AS cd
+                                   WHERE cd.simulation_id = st.simulation_id AND cd.variable_id = st.variable_id AND cd.timestep = st.timestep
+                               )
+                               """)
+                appended = cursor.rowcount
+                if self.get_driver() != "monetdb":
+                    cursor.execute("DROP TABLE cell_data_staging")
+            return appended
+        else:
+            schema_batch.validate(records)
+            raise Exception("ERROR: record batch structure is not valid to be inserted in the database.")
     
     def read_all(self):
-        self.get_cursor().execute("SELECT * FROM cell_data")
-        return self.get_cursor().fetchall()
+        with self.transaction() as cursor:
+            cursor.execute("SELECT * FROM cell_data")
+            return cursor.fetchall()
 
-    def read_one(self, uuid):
-        if self.get_driver() == "monetdb":
-            self.get_cursor().execute("SELECT * FROM cell_data WHERE id = uuid\'%s\'" % uuid)
-        else:
-            self.get_cursor().execute("SELECT * FROM cell_data WHERE id = \"%s\"" % uuid)
-        return self.get_cursor().fetchone()
+    def read_one(self, key):
+        with self.transaction() as cursor:
+            self._execute(cursor, "SELECT * FROM cell_data WHERE simulation_id = ? AND variable_id = ? AND timestep = ?", tuple(key))
+            return cursor.fetchone()
     
     def get_celldata_all_variables(self, simulation, timestep):
-        self.get_cursor().execute("SELECT cd.id, s.name, v.name, cd.timestep, cd.value FROM cell_data AS cd, simulation AS s, variable AS v WHERE s.id = cd.simulation_id AND v.id = cd.variable_id AND s.name = \'%s\' AND cd.timestep = %s"
-                                  % (simulation, timestep))
-        return self.get_cursor().fetchall()
+        with self.transaction() as cursor:
+            self._execute(
+                cursor,
+                "SELECT s.name, v.name, cd.timestep, cd.value FROM cell_data AS cd, simulation AS s, variable AS v WHERE s.id = cd.simulation_id AND v.id = cd.variable_id AND s.name = ? AND cd.timestep = ?",
+                (simulation, timestep)
+            )
+            return cursor.fetchall()
     
+    def get_celldata_all_simulations(self):
+        with self.transaction() as cursor:
+            cursor.execute("SELECT e.name, s.name, v.name, cd.timestep, cd.value FROM cell_data AS cd, simulation AS s, variable AS v, ensemble AS e WHERE s.id = cd.simulation_id AND v.id = cd.variable_id AND e.id = s.ensemble_id")
+            return cursor.fetchall()
+
+    def iter_celldata_all_simulations(self, batch_size):
+        # Same rows as get_celldata_all_simulations, fetched batch_size at a time. The result set stays open
+        # between batches, so it has a connection of its own that queries of the caller do not join
+        with self.transaction(join=False) as cursor:
+            cursor.execute("SELECT e.name, s.name, v.name, cd.timestep, cd.value FROM cell_data AS cd, simulation AS s, variable AS v, ensemble AS e WHERE s.id = cd.simulation_id AND v.id = cd.variable_id AND e.id = s.ensemble_id")
+            while True:
+                cells = cursor.fetchmany(batch_size)
+                if not cells:
+                    return
+                yield cells
+
+    def get_simulations(self):
+        # Ensemble and name of the simulations that have cells
+        with self.transaction() as cursor:
+            cursor.execute("SELECT e.name, s.name FROM simulation AS s, ensemble AS e WHERE e.id = s.ensemble_id AND EXISTS (SELECT 1 FROM cell_data AS cd WHERE cd.simulation_id = s.id)")
+            return cursor.fetchall()
+
+    def get_celldata_after(self, timestep, simulation_id, variable_id):
+        # Cells of later timesteps or of simulations and variables added after the given ids
+        with self.transaction() as cursor:
+            self._execute(
+                cursor,
+                "SELECT e.name, s.name, v.name, cd.timestep, cd.value FROM cell_data AS cd, simulation AS s, variable AS v, ensemble AS e WHERE s.id = cd.simulation_id AND v.id = cd.variable_id AND e.id = s.ensemble_id AND (cd.timestep > ? OR cd.simulation_id > ? OR cd.variable_id > ?)",
+                (timestep, simulation_id, variable_id)
+            )
+            return cursor.fetchall()
+
+    def get_fingerprint(self):
+        # Ids are sequential, so new simulations and variables always raise the largest ids. Changes that do not
+        # grow cell_data are told apart by a checksum of the ensembles of the simulations, which an incremental
+        # load can move, and by the data of the load that created the tables, which a replace load rewrites
+        with self.transaction() as cursor:
+            cursor.execute("SELECT COUNT(*), MAX(timestep), MAX(simulation_id), MAX(variable_id) FROM cell_data")
+            cells = cursor.fetchone()
+            ensembles = self.__ensemble_checksum(cursor, cells[2])
+            first_load = ""
+            if self._table_exists(cursor, "load_manifest"):
+                cursor.execute("SELECT fingerprint FROM load_manifest ORDER BY id LIMIT 1")
+                row = cursor.fetchone()
+                first_load = row[0][:16] if row else ""
+            return (*cells, ensembles, first_load)
+
+    def get_ensemble_checksum(self, simulation_id):
+        # Checksum of the ensembles of the simulations up to an id, which only changes when one of them moves
+        with self.transaction() as cursor:
+            return self.__ensemble_checksum(cursor, simulation_id)
+
+    def __ensemble_checksum(self, cursor, simulation_id):
+        self._execute(cursor, "SELECT COALESCE(SUM(CAST(id AS BIGINT) * ensemble_id), 0) FROM simulation WHERE id <= ?", (simulation_id,))
+        return cursor.fetchone()[0]
+
     def get_timesteps(self):
-        self.get_cursor().execute("SELECT DISTINCT timestep FROM cell_data")
-        return self.get_cursor().fetchall()
+        with self.transaction() as cursor:
+            cursor.execute("SELECT DISTINCT timestep FROM cell_data")
+            return cursor.fetchall()
@@ -0,0 +1,102 @@
+from db.Model import Model
+from schema import Schema, And, Use, Optional, SchemaError
+
+schema_record = Schema(
+    {
+        "name": str,
+        "kind": str,
+        "cell_count": int,
+        "nx": int,
+        "ny": int,
+        "min_x": float,
+        "min_y": float,
+        "max_x": float,
+        "max_y": float,
+        "chunk_cells": int,
+        "directory": str,
+    }
+)
+schema_batch = Schema([schema_record])
+
+class Grid(Model):
+    """Describes the grids and meshes whose fields are kept in a field store
+
+    The values of a field are not rows of cell_data: each grid points to the directory of its
+    chunked store (see service.FieldStore). Regular grids have nx columns and ny rows of cells, and
+    meshes have nx and ny set to 0. The bounds are those of the cell centers.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+
+    def create_table(self, replace=True):
+        with self.transaction() as cursor:
+            if not replace and self._table_exists(cursor, "grid"):
+                return
+            if self.get_driver() == "monetdb":
+                cursor.execute("DROP TABLE IF EXISTS grid CASCADE")
+            else:
+                cursor.execute("DROP TABLE IF EXISTS grid")
+            cursor.execute("""
+                           CREATE TABLE IF NOT EXISTS grid (
+                               id INTEGER NOT NULL PRIMARY KEY,
+                               name VARCHAR(200) NOT NULL,
+                               kind VARCHAR(20) NOT NULL,
+                               cell_count BIGINT NOT NULL,
+                               nx INTEGER NOT NULL,
+                               ny INTEGER NOT NULL,
+                               min_x DOUBLE NOT NULL,
+                               min_y DOUBLE NOT NULL,
+                               max_x DOUBLE NOT NULL,
+                               max_y DOUBLE NOT NULL,
+                               chunk_cells INTEGER NOT NULL,
+                               directory VARCHAR(500) NOT NULL
+                           )
+                           """)
+            cursor.execute("CREATE INDEX grid_name ON grid (name)")
+
+    def insert_one(self, record):
+        if (schema_record.is_valid(record)):
+            return self.insert_many([record])[0]
+        else:
+            raise Exception("ERROR: record structure is not valid to be inserted in the database.")
+
+    def insert_many(self, records):
+        if (schema_batch.is_valid(records)):
+            columns = ["name", "kind", "cell_count", "nx", "ny", "min_x", "min_y", "max_x", "max_y", "chunk_cells", "directory"]
+            with self.transaction() as cursor:
+                ids = self._next_ids(cursor, "grid", len(records))
+                self._bulk_insert(
+                    cursor,
+                    "grid",
+                    ["id"] + columns,
+                    [(id, *(record[column] for column in columns)) for id, record in zip(ids, records)]
+                )
+            return ids
+        else:
+            raise Exception("ERROR: record batch structure is not valid to be inserted in the database.")
+
+    def read_all(self):
+        # Databases without fields have no grid table
+        with self.transaction() as cursor:
+            if not self._table_exists(cursor, "grid"):
+                return []
+            cursor.execute("SELECT * FROM grid ORDER BY name, id")
+            return cursor.fetchall()
+
+    def read_one(self, id):
+        with self.transaction() as cursor:
+            self._execute(cursor, "SELECT * FROM grid WHERE id = ?", (id,))
+            return cursor.fetchone()
+
+    def read_by_name(self, name):
+        # A grid loaded again keeps the rows of its previous stores until they are deleted, the newest one wins
+        with self.transaction() as cursor:
+            if not self._table_exists(cursor, "grid"):
+                return None
+            self._execute(cursor, "SELECT * FROM grid WHERE name = ? ORDER BY id DESC LIMIT 1", (name,))
+            return cursor.fetchone()
+
+    def delete(self, id):
+        with self.transaction() as cursor:
+            self._execute(cursor, "DELETE FROM grid WHERE id = ?", (id,))
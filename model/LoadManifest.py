@@ -0,0 +1,104 @@
+from db.Model import Model
+from schema import Schema, And, Use, Optional, SchemaError
+from datetime import datetime, timezone
+
+schema_record = Schema(
+    {
+        "fingerprint": str,
+        "mode": str,
+        "batch_size": int,
+        "batch_count": int,
+    }
+)
+schema_batch = Schema([schema_record])
+
+class LoadManifest(Model):
+    """Records each run of the loader and the last batch of cells it committed
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+
+    def create_table(self, replace=True):
+        with self.transaction() as cursor:
+            if not replace and self._table_exists(cursor, "load_manifest"):
+                return
+            if self.get_driver() == "monetdb":
+                cursor.execute("DROP TABLE IF EXISTS load_manifest CASCADE")
+            else:
+                cursor.execute("DROP TABLE IF EXISTS load_manifest")
+            cursor.execute("""
+                           CREATE TABLE IF NOT EXISTS load_manifest (
+                               id INTEGER NOT NULL PRIMARY KEY,
+                               fingerprint VARCHAR(64) NOT NULL,
+                               mode VARCHAR(20) NOT NULL,
+                               batch_size INTEGER NOT NULL,
+                               batch_count INTEGER NOT NULL,
+                               last_batch INTEGER NOT NULL,
+                               cell_count BIGINT NOT NULL,
+                               status VARCHAR(20) NOT NULL,
+                               started_at VARCHAR(32) NOT NULL,
+                               updated_at VARCHAR(32) NOT NULL
+                           )
+                           """)
+            cursor.execute("CREATE INDEX load_manifest_fingerprint ON load_manifest (fingerprint)")
+
+    def insert_one(self, record):
+        if (schema_record.is_valid(record)):
+            return self.insert_many([record])[0]
+        else:
+            raise Exception("ERROR: record structure is not valid to be inserted in the database.")
+
+    def insert_many(self, records):
+        # New runs have not committed any batch yet
+        if (schema_batch.is_valid(records)):
+            now = self.__now()
+            with self.transaction() as cursor:
+                ids = self._next_ids(cursor, "load_manifest", len(records))
+                self._bulk_insert(
+                    cursor,
+                    "load_manifest",
+                    ["id", "fingerprint", "mode", "batch_size", "batch_count", "last_batch", "cell_count", "status", "started_at", "updated_at"],
+                    [
+                        (id, record["fingerprint"], record["mode"], record["batch_size"], record["batch_count"], -1, 0, "running", now, now)
+                        for id, record in zip(ids, records)
+                    ]
+                )
+            return ids
+        else:
+            raise Exception("ERROR: record batch structure is not valid to be inserted in the database.")
+
+    def read_all(self):
+        with self.transaction() as cursor:
+            cursor.execute("SELECT * FROM load_manifest")
+            return cursor.fetchall()
+
+    def read_one(self, id):
+        with self.transaction() as cursor:
+            self._execute(cursor, "SELECT * FROM load_manifest WHERE id = ?", (id,))
+            return cursor.fetchone()
+
+    def get_latest_run(self, fingerprint):
+        with self.transaction() as cursor:
+            self._execute(
+                cursor,
+                "SELECT id, batch_size, batch_count, last_batch, cell_count, status FROM load_manifest WHERE fingerprint = ? ORDER BY id DESC LIMIT 1",
+                (fingerprint,)
+            )
+            return cursor.fetchone()
+
+    def update_progress(self, id, last_batch, cell_count):
+        with self.transaction() as cursor:
+            self._execute(
+                cursor,
+                "UPDATE load_manifest SET last_batch = ?, cell_count = ?, updated_at = ? WHERE id = ?",
+                (last_batch, cell_count, self.__now(), id)
+            )
+
+    def complete(self, id):
+        with self.transaction() as cursor:
+            self._execute(cursor, "UPDATE load_manifest SET status = ?, updated_at = ? WHERE id = ?", ("complete", self.__now(), id))
+
+    @staticmethod
+    def __now():
+        return datetime.now(timezone.utc).isoformat(timespec="seconds")
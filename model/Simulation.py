@@ -1,46 +1,85 @@
 from db.Model import Model
 from schema import Schema, And, Use, Optional, SchemaError
-from uuid import UUID, uuid4
 
 schema_record = Schema(
     {
         "name": str,
-        "ensemble_id": UUID,
+        "ensemble_id": int,
     }
 )
+schema_batch = Schema([schema_record])
 
 class Simulation(Model):
     def __init__(self) -> None:
         super().__init__()
 
-    def create_table(self):
-        if self.get_driver() == "monetdb":
-            self.get_cursor().execute("DROP TABLE IF EXISTS simulation CASCADE")
-            self.get_cursor().execute("CREATE TABLE IF NOT EXISTS simulation (id UUID NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL, ensemble_id UUID NOT NULL, FOREIGN KEY(ensemble_id) REFERENCES ensemble(id))")
-        else:
-            self.get_cursor().execute("DROP TABLE IF EXISTS simulation")
-            self.get_cursor().execute("CREATE TABLE IF NOT EXISTS simulation (id TEXT NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL, ensemble_id TEXT NOT NULL, FOREIGN KEY(ensemble_id) REFERENCES ensemble(id))")
-        self.commit()
+    def create_table(self, replace=True):
+        with self.transaction() as cursor:
+            if not replace and self._table_exists(cursor, "simulation"):
+                return
+            if self.get_driver() == "monetdb":
+                cursor.execute("DROP TABLE IF EXISTS simulation CASCADE")
+                cursor.execute("CREATE TABLE IF NOT EXISTS simulation (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL, ensemble_id INTEGER NOT NULL, FOREIGN KEY(ensemble_id) REFERENCES ensemble(id))")
+                cursor.execute("CREATE INDEX simulation_name ON simulation (name)")
+            else:
+                cursor.execute("DROP TABLE IF EXISTS simulation")
+                cursor.execute("CREATE TABLE IF NOT EXISTS simulation (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL, ensemble_id INTEGER NOT NULL, FOREIGN KEY(ensemble_id) REFERENCES ensemble(id))")
+                cursor.execute("CREATE INDEX simulation_name ON simulation (name)")
 
     def insert_one(self, record):
         if (schema_record.is_valid(record)):
-            uuid = uuid4()
-            if self.get_driver() == "monetdb":
-                self.get_cursor().execute("INSERT INTO simulation (id, name, ensemble_id) VALUES (uuid\'%s\', \'%s\', uuid\'%s\')" % (uuid, record["name"], record["ensemble_id"]))
-            else:
-                self.get_cursor().execute("INSERT INTO simulation (id, name, ensemble_id) VALUES (\"%s\", \"%s\", \"%s\")" % (uuid, record["name"], record["ensemble_id"]))
-            self.commit()
-            return uuid
+            with self.transaction() as cursor:
+                id = self._next_ids(cursor, "simulation", 1)[0]
+                self._execute(cursor, "INSERT INTO simulation (id, name, ensemble_id) VALUES (?, ?, ?)", (id, record["name"], record["ensemble_id"]))
+            return id
         else:
             raise Exception("ERROR: record structure is not valid to be inserted in the database.")
+
+    def insert_many(self, records):
+        if (schema_batch.is_valid(records)):
+            with self.transaction() as cursor:
+                ids = self._next_ids(cursor, "simulation", len(records))
+                self._bulk_insert(
+                    cursor,
+                    "simulation",
+                    ["id", "name", "ensemble_id"],
+                    [(id, record["name"], record["ensemble_id"]) for id, record in zip(ids, records)]
+                )
+            return ids
+        else:
+            raise Exception("ERROR: record batch structure is not valid to be inserted in the database.")
+
+    def upsert_many(self, records):
+        if (schema_batch.is_valid(records)):
+            with self.transaction() as cursor:
+                cursor.execute("SELECT name, id, ensemble_id FROM simulation")
+                existing = {name: (id, ensemble_id) for name, id, ensemble_id in cursor.fetchall()}
+                ensemble_ids = {}
+                for record in records:
+                    ensemble_ids.setdefault(record["name"], record["ensemble_id"])
+                new_names = [name for name in ensemble_ids if name not in existing]
+                ids = {name: id for name, (id, _) in existing.items()}
+                ids.update(zip(new_names, self._next_ids(cursor, "simulation", len(new_names))))
+                # Simulations that moved to another ensemble are updated
+                for name, ensemble_id in ensemble_ids.items():
+                    if name in existing and existing[name][1] != ensemble_id:
+                        self._execute(cursor, "UPDATE simulation SET ensemble_id = ? WHERE id = ?", (ensemble_id, ids[name]))
+                self._bulk_insert(
+                    cursor,
+                    "simulation",
+                    ["id", "name", "ensemble_id"],
+                    [(ids[name], name, ensemble_ids[name]) for name in new_names]
+                )
+            return [ids[record["name"]] for record in records]
+        else:
+            raise Exception("ERROR: record batch structure is not valid to be upserted in the database.")
     
     def read_all(self):
-        self.get_cursor().execute("SELECT * FROM simulation")
-        return self.get_cursor().fetchall()
+        with self.transaction() as cursor:
+            cursor.execute("SELECT * FROM simulation")
+            return cursor.fetchall()
 
-    def read_one(self, uuid):
-        if self.get_driver() == "monetdb":
-            self.get_cursor().execute("SELECT * FROM simulation WHERE id = uuid\'%s\'" % uuid)
-        else:
-            self.get_cursor().execute("SELECT * FROM simulation WHERE id = %s" % uuid)
-        return self.get_cursor().fetchone()
+    def read_one(self, id):
+        with self.transaction() as cursor:
+            self._execute(cursor, "SELECT * FROM simulation WHERE id = ?", (id,))
+            return cursor.fetchone()
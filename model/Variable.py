@@ -1,45 +1,71 @@
 from db.Model import Model
 from schema import Schema, And, Use, Optional, SchemaError
-from uuid import uuid4
 
 schema_record = Schema(
     {
         "name": str
     }
 )
+schema_batch = Schema([schema_record])
 
 class Variable(Model):
     def __init__(self) -> None:
         super().__init__()
 
-    def create_table(self):
-        if self.get_driver() == "monetdb":
-            self.get_cursor().execute("DROP TABLE IF EXISTS variable CASCADE")
-            self.get_cursor().execute("CREATE TABLE IF NOT EXISTS variable (id UUID NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL)")
-        else:
-            self.get_cursor().execute("DROP TABLE IF EXISTS variable")
-            self.get_cursor().execute("CREATE TABLE IF NOT EXISTS variable (id TEXT NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL)")
-        self.commit()
+    def create_table(self, replace=True):
+        with self.transaction() as cursor:
+            if not replace and self._table_exists(cursor, "variable"):
+                return
+            if self.get_driver() == "monetdb":
+                cursor.execute("DROP TABLE IF EXISTS variable CASCADE")
+                cursor.execute("CREATE TABLE IF NOT EXISTS variable (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL)")
+                cursor.execute("CREATE INDEX variable_name ON variable (name)")
+            else:
+                cursor.execute("DROP TABLE IF EXISTS variable")
+                cursor.execute("CREATE TABLE IF NOT EXISTS variable (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL)")
+                cursor.execute("CREATE INDEX variable_name ON variable (name)")
 
     def insert_one(self, record):
         if (schema_record.is_valid(record)):
-            uuid = uuid4()
-            if self.get_driver() == "monetdb":
-                self.get_cursor().execute("INSERT INTO variable (id, name) VALUES (uuid\'%s\', \'%s\')" % (uuid, record["name"]))
-            else:
-                self.get_cursor().execute("INSERT INTO variable (id, name) VALUES (\"%s\", \"%s\")" % (uuid, record["name"]))
-            self.commit()
-            return uuid
+            with self.transaction() as cursor:
+                id = self._next_ids(cursor, "variable", 1)[0]
+                self._execute(cursor, "INSERT INTO variable (id, name) VALUES (?, ?)", (id, record["name"]))
+            return id
         else:
             raise Exception("ERROR: record structure is not valid to be inserted in the database.")
+
+    def insert_many(self, records):
+        if (schema_batch.is_valid(records)):
+            with self.transaction() as cursor:
+                ids = self._next_ids(cursor, "variable", len(records))
+                self._bulk_insert(
+                    cursor,
+                    "variable",
+                    ["id", "name"],
+                    [(id, record["name"]) for id, record in zip(ids, records)]
+                )
+            return ids
+        else:
+            raise Exception("ERROR: record batch structure is not valid to be inserted in the database.")
+
+    def upsert_many(self, records):
+        if (schema_batch.is_valid(records)):
+            with self.transaction() as cursor:
+                cursor.execute("SELECT name, id FROM variable")
+                ids = dict(cursor.fetchall())
+                new_names = list(dict.fromkeys(record["name"] for record in records if record["name"] not in ids))
+                ids.update(zip(new_names, self._next_ids(cursor, "variable", len(new_names))))
+                self._bulk_insert(cursor, "variable", ["id", "name"], [(ids[name], name) for name in new_names])
+            return [ids[record["name"]] for record in records]
+        else:
+            raise Exception("ERROR: record batch structure is not valid to be upserted in the database.")
     
     def read_all(self):
-        self.get_cursor().execute("SELECT * FROM variable")
-        return self.get_cursor().fetchall()
+        with self.transaction() as cursor:
+            cursor.execute("SELECT * FROM variable")
+            return cursor.fetchall()
 
-    def read_one(self, uuid):
-        if self.get_driver() == "monetdb":
-            self.get_cursor().execute("SELECT * FROM variable WHERE id = uuid\'%s\'" % uuid)
-        else:
-            self.get_cursor().execute("SELECT * FROM variable WHERE id = %s" % uuid)
-        return self.get_cursor().fetchone()
+    def read_one(self, id):
+        with self.transaction() as cursor:
+            self._execute(cursor, "SELECT * FROM variable WHERE id = ?", (id,))
+            return cursor.fetchone()
@@ -0,0 +1,92 @@
+from service import Metrics
+import numpy as np
+
+# scikit-learn and umap are imported on first use: importing umap compiles numba kernels and
+# takes several seconds, which would otherwise be paid by every process that imports this module
+
+def create_reducer(method, parameters):
+    """Creates an unfitted reducer for a dimensional reduction method
+
+    :param method: the dimensional reduction method, PCA or UMAP
+    :type method: str
+    :param parameters: keyword arguments for the reducer
+    :type parameters: dict
+
+    :returns: a reducer with the scikit-learn fit/transform interface
+    :rtype: object
+    """
+
+    if method == "PCA":
+        from sklearn.decomposition import PCA
+        return PCA(**parameters)
+    elif method == "UMAP":
+        import umap
+        return umap.UMAP(**parameters)
+    else:
+        raise Exception("Dimensional reduction method %s not yet implemented" % method)
+
+def fit_transform(method, parameters, data):
+    """Standardizes the data and projects it in two dimensions
+
+    It only depends on its arguments, so it can run in a worker process of a process pool. The
+    scaling and the fit are measured as the scale and pca or umap stages of the current request,
+    which are only reported when it runs in the thread of the request.
+
+    :param method: the dimensional reduction method, PCA or UMAP
+    :type method: str
+    :param parameters: keyword arguments for the reducer
+    :type parameters: dict
+    :param data: a matrix with one row per simulation and one column per variable
+    :type data: numpy.ndarray
+
+    :returns: a matrix with the two coordinates of each row
+    :rtype: numpy.ndarray
+    """
+
+    from sklearn.preprocessing import StandardScaler
+    with Metrics.stage("scale"):
+        scaled_data = StandardScaler().fit_transform(data)
+    with Metrics.stage(method.lower()):
+        return create_reducer(method, parameters).fit_transform(scaled_data)
+
+def incremental_fit_transform(parameters, read_chunks):
+    """Standardizes and projects in two dimensions with PCA a matrix that is only read in chunks of rows
+
+    The scaler and an IncrementalPCA are fitted chunk by chunk, and the chunks are read once more to
+    be projected, so only one chunk and the coordinates are in memory at a time. Every chunk needs
+    at least as many rows as components.
+
+    :param parameters: keyword arguments for the reducer
+    :type parameters: dict
+    :param read_chunks: function without arguments that returns an iterator over the chunks, in the same order on every call
+    :type read_chunks: callable
+
+    :returns: a matrix with the two coordinates of each row
+    :rtype: numpy.ndarray
+    """
+
+    from sklearn.decomposition import IncrementalPCA
+    from sklearn.preprocessing import StandardScaler
+    scaler = StandardScaler()
+    with Metrics.stage("scale"):
+        for chunk in read_chunks():
+            scaler.partial_fit(chunk)
+    reducer = IncrementalPCA(**parameters)
+    with Metrics.stage("pca"):
+        for chunk in read_chunks():
+            reducer.partial_fit(scaler.transform(chunk))
+        return np.concatenate([reducer.transform(scaler.transform(chunk)) for chunk in read_chunks()])
+
+def warm_up(methods=("PCA", "UMAP")):
+    """Imports the reducers and fits each one on a small random matrix
+
+    The first UMAP fit of a process compiles its numba kernels, so running this in the background
+    at startup keeps that cost away from the first request.
+
+    :param methods: the dimensional reduction methods to warm up
+    :type methods: tuple
+    """
+
+    data = np.random.default_rng(0).normal(size=(64, 4))
+    for method in methods:
+        fit_transform(method, {}, data)
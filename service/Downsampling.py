@@ -0,0 +1,158 @@
+import numpy as np
+
+METHODS = ['lttb', 'minmax']
+
+def downsample(method, x, y, max_points):
+    """Chooses at most max_points points of every series with a shape-preserving method
+
+    Every series shares the same x values, so the points of all of them are chosen at once, one
+    bucket at a time, and the cost of each bucket does not grow with the number of series.
+
+    :param method: the downsampling method, lttb or minmax
+    :type method: str
+    :param x: the increasing x values shared by the series
+    :type x: numpy.ndarray
+    :param y: a matrix with one row per series and one column per x value, NaN where a series has no value
+    :type y: numpy.ndarray
+    :param max_points: maximum number of points kept in each series, at least 3
+    :type max_points: int
+
+    :returns: a matrix with the column index of each chosen point, in increasing order in each row
+    :rtype: numpy.ndarray
+    """
+
+    if len(x) <= max_points:
+        return np.broadcast_to(np.arange(len(x)), y.shape).copy()
+    if method == "lttb":
+        return lttb(x, y, max_points)
+    elif method == "minmax":
+        return min_max(x, y, max_points)
+    else:
+        raise Exception("Downsampling method %s not yet implemented" % method)
+
+def lttb(x, y, max_points):
+    """Largest-Triangle-Three-Buckets: keeps the first and last points and one point per bucket
+
+    The point chosen in a bucket forms the largest triangle with the point chosen in the previous
+    bucket and the average of the next bucket, so peaks and troughs survive the downsampling.
+
+    :param x: the increasing x values shared by the series
+    :type x: numpy.ndarray
+    :param y: a matrix with one row per series and one column per x value
+    :type y: numpy.ndarray
+    :param max_points: number of points kept in each series, at least 3 and less than len(x)
+    :type max_points: int
+
+    :returns: a matrix with the column index of each chosen point
+    :rtype: numpy.ndarray
+    """
+
+    n = len(x)
+    rows = np.arange(y.shape[0])
+    # Bucket i holds the columns [edges[i], edges[i + 1]), the last one is followed by the last point
+    edges = np.append((np.arange(max_points - 1) * ((n - 2) / (max_points - 2))).astype(np.intp) + 1, n)
+    selected = np.empty((y.shape[0], max_points), dtype=np.intp)
+    selected[:, 0] = 0
+    selected[:, -1] = n - 1
+    previous = selected[:, 0]
+    with np.errstate(invalid='ignore'):
+        for bucket in range(max_points - 2):
+            start, stop, next_stop = edges[bucket], edges[bucket + 1], edges[bucket + 2]
+            next_y = y[:, stop:next_stop]
+            average_x = x[stop:next_stop].mean()
+            average_y = np.nansum(next_y, axis=1) / np.count_nonzero(~np.isnan(next_y), axis=1)
+            previous_x = x[previous]
+            previous_y = y[rows, previous]
+            # Without values in the next bucket, or a previous point, the triangle uses the one that is left
+            average_y = np.where(np.isnan(average_y), previous_y, average_y)
+            previous_y = np.where(np.isnan(previous_y), average_y, previous_y)
+            area = np.abs(
+                (previous_x - average_x)[:, None] * (y[:, start:stop] - previous_y[:, None])
+                - (previous_x[:, None] - x[None, start:stop]) * (average_y - previous_y)[:, None]
+            )
+            chosen = np.argmax(np.nan_to_num(area, nan=-1.0), axis=1) + start
+            selected[:, bucket + 1] = chosen
+            # A bucket without values keeps the previous point as the vertex of the next triangle
+            previous = np.where(np.isnan(y[rows, chosen]), previous, chosen)
+    return selected
+
+def min_max(x, y, max_points):
+    """Keeps the smallest and the largest point of each bucket of equal width
+
+    :param x: the increasing x values shared by the series
+    :type x: numpy.ndarray
+    :param y: a matrix with one row per series and one column per x value
+    :type y: numpy.ndarray
+    :param max_points: maximum number of points kept in each series, at least 2 and less than len(x)
+    :type max_points: int
+
+    :returns: a matrix with the column index of each chosen point
+    :rtype: numpy.ndarray
+    """
+
+    buckets = max_points // 2
+    edges = np.linspace(0, len(x), buckets + 1).astype(np.intp)
+    lowest = np.where(np.isnan(y), np.inf, y)
+    highest = np.where(np.isnan(y), -np.inf, y)
+    selected = np.empty((y.shape[0], 2 * buckets), dtype=np.intp)
+    for bucket in range(buckets):
+        start, stop = edges[bucket], edges[bucket + 1]
+        selected[:, 2 * bucket] = np.argmin(lowest[:, start:stop], axis=1) + start
+        selected[:, 2 * bucket + 1] = np.argmax(highest[:, start:stop], axis=1) + start
+    return np.sort(selected, axis=1)
+
+def bin_field(x, y, values, bbox, max_cells, spacing=None):
+    """Averages the values of the cells of a field into a raster of at most max_cells cells covering a bounding box
+
+    The raster cells of a regular grid are blocks of whole grid cells, so a field with fewer cells
+    than max_cells comes back unchanged. Mesh cells are averaged into a raster with about as many
+    cells as the mesh has in the bounding box, up to max_cells.
+
+    :param x: x of the center of each cell
+    :type x: numpy.ndarray
+    :param y: y of the center of each cell
+    :type y: numpy.ndarray
+    :param values: value of each cell, NaN values are left out of the averages
+    :type values: numpy.ndarray
+    :param bbox: (min_x, min_y, max_x, max_y), whose corners are cell centers for a regular grid
+    :type bbox: tuple
+    :param max_cells: maximum number of raster cells, at least 1
+    :type max_cells: int
+    :param spacing: (dx, dy) between the centers of neighbouring cells of a regular grid, None for a mesh
+    :type spacing: tuple
+
+    :returns: the raster, with one row per y from the lowest and NaN where no value falls, the (x, y) of its lower left corner and the (width, height) of its cells
+    :rtype: tuple
+    """
+
+    min_x, min_y, max_x, max_y = bbox
+    width, height = max_x - min_x, max_y - min_y
+    if spacing is not None:
+        dx, dy = spacing
+        grid_columns = int(round(width / dx)) + 1 if dx > 0 else 1
+        grid_rows = int(round(height / dy)) + 1 if dy > 0 else 1
+        factor = max(1, int(np.sqrt(grid_columns * grid_rows / max_cells)))
+        while -(-grid_columns // factor) * -(-grid_rows // factor) > max_cells:
+            factor += 1
+        columns, rows = -(-grid_columns // factor), -(-grid_rows // factor)
+        cell_width, cell_height = factor * (dx or 1.0), factor * (dy or 1.0)
+        origin = (min_x - (dx or 1.0) / 2, min_y - (dy or 1.0) / 2)
+    else:
+        target = max(1, min(max_cells, len(x)))
+        if width > 0 and height > 0:
+            columns = min(target, max(1, int(np.sqrt(target * width / height))))
+        else:
+            columns = target if width > 0 else 1
+        rows = 1 if height == 0 else max(1, target // columns)
+        cell_width, cell_height = (width / columns) or 1.0, (height / rows) or 1.0
+        origin = (min_x, min_y)
+
+    column = np.clip(((x - origin[0]) / cell_width).astype(np.intp), 0, columns - 1)
+    row = np.clip(((y - origin[1]) / cell_height).astype(np.intp), 0, rows - 1)
+    known = ~np.isnan(values)
+    bins = row[known] * columns + column[known]
+    counts = np.bincount(bins, minlength=rows * columns)
+    sums = np.bincount(bins, weights=values[known], minlength=rows * columns)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        raster = np.where(counts > 0, sums / counts, np.nan).reshape(rows, columns)
+    return raster, origin, (cell_width, cell_height)
@@ -0,0 +1,361 @@
+import numpy as np
+import pandas as pd
+import os
+
+INDEX_COLUMNS = ['ensemble', 'name', 'time']
+DTYPES = ['float64', 'float32']
+CHUNK_BYTES = 64 * 2 ** 20
+
+class EnsembleCube:
+    """Every value of the ensembles in one dense array of shape (simulation, time, variable)
+
+    Simulations are sorted by name and timesteps in increasing order. Simulation names are unique,
+    and the ensemble of each simulation is kept as a small integer code into ensemble_names, so no
+    identifier is repeated per value. present marks the (simulation, timestep) pairs that have
+    data: the values of the other pairs are NaN, and the variables missing from a present pair are
+    0, as in the long format frame this array replaces.
+
+    Slices of the array are views, so endpoints select simulations, timesteps and variables without
+    copying the data, and long format tables are only built for the rows a response sends.
+
+    The arrays can also be memory-mapped files in a directory (see create_store), for ensembles
+    larger than the memory of a worker. The values of a (simulation, timestep) pair are contiguous
+    in the file, so a read only pages in the blocks of the rows it selects.
+    """
+
+    def __init__(self, ensemble_names, ensemble_codes, names, timesteps, variables, values, present):
+        """Wraps arrays that are already sorted and aligned
+
+        :param ensemble_names: the sorted ensemble names
+        :type ensemble_names: numpy.ndarray
+        :param ensemble_codes: the position in ensemble_names of the ensemble of each simulation
+        :type ensemble_codes: numpy.ndarray
+        :param names: the sorted simulation names
+        :type names: numpy.ndarray
+        :param timesteps: the sorted timesteps
+        :type timesteps: numpy.ndarray
+        :param variables: the variable names
+        :type variables: list
+        :param values: array of shape (simulation, time, variable)
+        :type values: numpy.ndarray
+        :param present: boolean array of shape (simulation, time)
+        :type present: numpy.ndarray
+        """
+
+        self.ensemble_names = np.asarray(ensemble_names, dtype=object)
+        self.ensemble_codes = np.asarray(ensemble_codes, dtype=np.min_scalar_type(max(len(self.ensemble_names) - 1, 0)))
+        self.names = np.asarray(names, dtype=object)
+        self.timesteps = np.asarray(timesteps, dtype=np.float64)
+        self.variables = list(variables)
+        self.values = values
+        self.present = present
+        self.time_index = {float(t): i for i, t in enumerate(self.timesteps)}
+
+    @classmethod
+    def from_cells(cls, cells, variables, dtype='float64'):
+        """Builds the cube from cell records
+
+        :param cells: records of (ensemble, simulation name, variable name, timestep, value)
+        :type cells: list
+        :param variables: the variable names, in the order of the last axis, cells of other variables are ignored
+        :type variables: list
+        :param dtype: precision of the values, float64 or float32
+        :type dtype: str
+
+        :rtype: EnsembleCube
+        """
+
+        cells = pd.DataFrame.from_records(cells, columns=['ensemble', 'name', 'variable', 'time', 'value'])
+        name_codes, names = pd.factorize(cells['name'], sort=True)
+        time_codes, timesteps = pd.factorize(cells['time'].astype(np.float64), sort=True)
+        variable_codes = pd.Index(variables).get_indexer(cells['variable'])
+
+        present = np.zeros((len(names), len(timesteps)), dtype=bool)
+        present[name_codes, time_codes] = True
+        values = np.full((len(names), len(timesteps), len(variables)), np.nan, dtype=dtype)
+        values[present] = 0.0
+        known = variable_codes >= 0
+        values[name_codes[known], time_codes[known], variable_codes[known]] = cells['value'].to_numpy(dtype=np.float64)[known]
+
+        simulation_ensembles = np.empty(len(names), dtype=object)
+        simulation_ensembles[name_codes] = cells['ensemble'].to_numpy(dtype=object)
+        ensemble_codes, ensemble_names = pd.factorize(simulation_ensembles, sort=True)
+        return cls(ensemble_names, ensemble_codes, names.to_numpy(dtype=object), timesteps.to_numpy(), variables, values, present)
+
+    @classmethod
+    def create_store(cls, directory, simulations, timesteps, variables, dtype='float64', chunk_bytes=CHUNK_BYTES):
+        """Allocates an empty cube in memory-mapped files, to be filled with scatter and finish
+
+        :param directory: new directory for the files
+        :type directory: str
+        :param simulations: (ensemble, name) of every simulation
+        :type simulations: list
+        :param timesteps: every timestep
+        :type timesteps: list
+        :param variables: the variable names
+        :type variables: list
+        :param dtype: precision of the values, float64 or float32
+        :type dtype: str
+        :param chunk_bytes: maximum number of bytes written at a time
+        :type chunk_bytes: int
+
+        :rtype: EnsembleCube
+        """
+
+        os.makedirs(directory)
+        simulations = sorted(simulations, key=lambda simulation: simulation[1])
+        names = np.array([name for _, name in simulations], dtype=object)
+        ensemble_codes, ensemble_names = pd.factorize(np.array([ensemble for ensemble, _ in simulations], dtype=object), sort=True)
+        timesteps = np.unique(np.asarray(timesteps, dtype=np.float64))
+        np.savez(
+            os.path.join(directory, 'index.npz'),
+            ensemble_names=ensemble_names.astype(str), ensemble_codes=ensemble_codes, names=names.astype(str),
+            timesteps=timesteps, variables=np.asarray(variables, dtype=str)
+        )
+        values = np.lib.format.open_memmap(
+            os.path.join(directory, 'values.npy'), mode='w+', dtype=dtype, shape=(len(names), len(timesteps), len(variables))
+        )
+        present = np.lib.format.open_memmap(os.path.join(directory, 'present.npy'), mode='w+', dtype=bool, shape=(len(names), len(timesteps)))
+        cube = cls(ensemble_names, ensemble_codes, names, timesteps, variables, values, present)
+        for block in cube.chunks(len(names), values.itemsize * len(timesteps) * len(variables), chunk_bytes):
+            values[block] = np.nan
+        return cube
+
+    @classmethod
+    def open_store(cls, directory):
+        """Opens the read-only cube stored in a directory by create_store
+
+        :param directory: the directory of the files
+        :type directory: str
+
+        :rtype: EnsembleCube
+        """
+
+        with np.load(os.path.join(directory, 'index.npz')) as index:
+            return cls(
+                index['ensemble_names'], index['ensemble_codes'], index['names'], index['timesteps'], index['variables'].tolist(),
+                np.load(os.path.join(directory, 'values.npy'), mmap_mode='r'),
+                np.load(os.path.join(directory, 'present.npy'), mmap_mode='r')
+            )
+
+    def scatter(self, cells):
+        """Writes a batch of cell records into a cube allocated by create_store
+
+        :param cells: records of (ensemble, simulation name, variable name, timestep, value)
+        :type cells: list
+        """
+
+        cells = pd.DataFrame.from_records(cells, columns=['ensemble', 'name', 'variable', 'time', 'value'])
+        simulation_indices = pd.Index(self.names).get_indexer(cells['name'])
+        time_indices = pd.Index(self.timesteps).get_indexer(cells['time'].astype(np.float64))
+        variable_indices = pd.Index(self.variables).get_indexer(cells['variable'])
+        known = (simulation_indices >= 0) & (time_indices >= 0)
+        self.present[simulation_indices[known], time_indices[known]] = True
+        known &= variable_indices >= 0
+        self.values[simulation_indices[known], time_indices[known], variable_indices[known]] = cells['value'].to_numpy(dtype=np.float64)[known]
+
+    def finish(self, chunk_bytes=CHUNK_BYTES):
+        """Sets the variables missing from present rows to 0 and writes the files of a cube allocated by create_store
+
+        :param chunk_bytes: maximum number of bytes read at a time
+        :type chunk_bytes: int
+        """
+
+        for block in self.chunks(len(self.names), self.values.itemsize * len(self.timesteps) * len(self.variables), chunk_bytes):
+            values = self.values[block]
+            values[self.present[block][:, :, None] & np.isnan(values)] = 0.0
+        self.values.flush()
+        self.present.flush()
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Builds the cube from the arrays returned by to_arrays, e.g. read back from an npz file
+
+        :param arrays: mapping of array names to arrays
+        :type arrays: dict
+
+        :rtype: EnsembleCube
+        """
+
+        return cls(
+            arrays['ensemble_names'], arrays['ensemble_codes'], arrays['names'], arrays['timesteps'],
+            arrays['variables'].tolist(), arrays['values'], arrays['present']
+        )
+
+    def to_arrays(self):
+        """Returns the arrays of the cube, with strings as fixed width unicode so they can be saved without pickling
+
+        :rtype: dict
+        """
+
+        return {
+            'ensemble_names': self.ensemble_names.astype(str),
+            'ensemble_codes': self.ensemble_codes,
+            'names': self.names.astype(str),
+            'timesteps': self.timesteps,
+            'variables': np.asarray(self.variables, dtype=str),
+            'values': self.values,
+            'present': self.present,
+        }
+
+    @property
+    def nbytes(self):
+        """Bytes used by the arrays of the cube
+        """
+
+        return self.values.nbytes + self.present.nbytes + self.ensemble_codes.nbytes
+
+    @staticmethod
+    def chunks(length, item_bytes, chunk_bytes=CHUNK_BYTES):
+        """Splits an axis in slices of at most chunk_bytes, for reads and writes of bounded memory
+
+        :param length: length of the axis
+        :type length: int
+        :param item_bytes: bytes of each position of the axis
+        :type item_bytes: int
+        :param chunk_bytes: maximum number of bytes of each slice
+        :type chunk_bytes: int
+
+        :rtype: list
+        """
+
+        step = max(1, chunk_bytes // max(1, item_bytes))
+        return [slice(start, min(start + step, length)) for start in range(0, length, step)]
+
+    def select(self, ensemble_list=None, simulation_list=None):
+        """Returns a boolean mask of the simulations that pass the filters
+
+        :param ensemble_list: ensembles to be included, all if empty
+        :type ensemble_list: list
+        :param simulation_list: simulations to be included, all if empty
+        :type simulation_list: list
+
+        :rtype: numpy.ndarray
+        """
+
+        mask = np.ones(len(self.names), dtype=bool)
+        if ensemble_list:
+            mask &= np.isin(self.ensemble_names, list(ensemble_list))[self.ensemble_codes]
+        if simulation_list:
+            mask &= np.isin(self.names, list(simulation_list))
+        return mask
+
+    def time_slice(self, time_from=None, time_to=None):
+        """Returns the slice of the time axis with the timesteps in [time_from, time_to]
+
+        :param time_from: first timestep, from the beginning if None
+        :type time_from: float
+        :param time_to: last timestep, up to the end if None
+        :type time_to: float
+
+        :rtype: slice
+        """
+
+        first = 0 if time_from is None else int(np.searchsorted(self.timesteps, time_from, side='left'))
+        last = len(self.timesteps) if time_to is None else int(np.searchsorted(self.timesteps, time_to, side='right'))
+        return slice(first, max(first, last))
+
+    def ensembles_of(self, simulations):
+        """Returns the ensemble name of each selected simulation
+
+        :param simulations: boolean mask or indices of simulations
+        :type simulations: numpy.ndarray
+
+        :rtype: numpy.ndarray
+        """
+
+        return self.ensemble_names[self.ensemble_codes[simulations]]
+
+    def rows(self, simulations=None, times=slice(None)):
+        """Returns the simulation and timestep indices of the present rows, ordered by timestep then name
+
+        :param simulations: boolean mask of the simulations, all if None
+        :type simulations: numpy.ndarray
+        :param times: slice of the time axis
+        :type times: slice
+
+        :returns: the simulation indices and the timestep indices
+        :rtype: tuple
+        """
+
+        present = self.present[:, times]
+        if simulations is not None:
+            present = present & simulations[:, None]
+        time_indices, simulation_indices = np.nonzero(present.T)
+        return simulation_indices, time_indices + (times.start or 0)
+
+    def to_frame(self, simulations=None, times=slice(None), variables=None, rows=None):
+        """Builds the long format table of the selected rows, with the columns ensemble, name, time and one per variable
+
+        :param simulations: boolean mask of the simulations, all if None
+        :type simulations: numpy.ndarray
+        :param times: slice of the time axis
+        :type times: slice
+        :param variables: names of the variables, all if None
+        :type variables: list
+        :param rows: simulation and timestep indices as returned by rows, which replace the other filters
+        :type rows: tuple
+
+        :rtype: pandas.DataFrame
+        """
+
+        simulation_indices, time_indices = self.rows(simulations, times) if rows is None else rows
+        variables = self.variables if variables is None else list(variables)
+        columns = np.array([self.variables.index(variable) for variable in variables], dtype=np.intp)
+        return pd.concat([
+            pd.DataFrame({
+                'ensemble': self.ensembles_of(simulation_indices),
+                'name': self.names[simulation_indices],
+                'time': self.timesteps[time_indices],
+            }),
+            # Only the requested variables are read, so memory-mapped cubes page in nothing else
+            pd.DataFrame(self.values[simulation_indices[:, None], time_indices[:, None], columns], columns=variables)
+        ], axis=1)
+
+    def iter_frames(self, simulations=None, times=slice(None), variables=None, chunk_size=1000):
+        """Builds the long format table of the selected rows chunk by chunk, see to_frame
+
+        :param chunk_size: number of rows of each table
+        :type chunk_size: int
+
+        :returns: a generator of tables
+        :rtype: generator
+        """
+
+        simulation_indices, time_indices = self.rows(simulations, times)
+        for start in range(0, len(simulation_indices), chunk_size):
+            stop = start + chunk_size
+            yield self.to_frame(variables=variables, rows=(simulation_indices[start:stop], time_indices[start:stop]))
+
+    def merge(self, other, variables):
+        """Returns a new cube with the rows of both cubes, keeping the values of this one where both have a row
+
+        :param other: the cube with the new rows
+        :type other: EnsembleCube
+        :param variables: the variable names of the new cube
+        :type variables: list
+
+        :rtype: EnsembleCube
+        """
+
+        names = pd.Index(self.names).union(pd.Index(other.names)).to_numpy(dtype=object)
+        timesteps = np.union1d(self.timesteps, other.timesteps)
+        values = np.full((len(names), len(timesteps), len(variables)), np.nan, dtype=self.values.dtype)
+        present = np.zeros((len(names), len(timesteps)), dtype=bool)
+        simulation_ensembles = np.empty(len(names), dtype=object)
+
+        # The other cube is written first, so the rows of this one are written over it
+        for cube in (other, self):
+            simulation_indices = pd.Index(names).get_indexer(cube.names)
+            time_indices = np.searchsorted(timesteps, cube.timesteps)
+            targets = pd.Index(variables).get_indexer(cube.variables)
+            known = targets >= 0
+            block = (simulation_indices[:, None, None], time_indices[None, :, None], targets[known][None, None, :])
+            values[block] = np.where(cube.present[:, :, None], cube.values[:, :, known], values[block])
+            present[np.ix_(simulation_indices, time_indices)] |= cube.present
+            simulation_ensembles[simulation_indices] = cube.ensembles_of(slice(None))
+
+        # Variables missing from a present row are 0
+        values[present[:, :, None] & np.isnan(values)] = 0.0
+        ensemble_codes, ensemble_names = pd.factorize(simulation_ensembles, sort=True)
+        return EnsembleCube(ensemble_names, ensemble_codes, names, timesteps, variables, values, present)
@@ -0,0 +1,467 @@
+import numpy as np
+import pandas as pd
+import warnings
+import os
+
+DTYPES = ['float64', 'float32']
+REDUCTIONS = ['mean', 'median', 'min', 'max', 'std', 'range']
+CHUNK_CELLS = 4096
+
+class FieldStore:
+    """The fields of a grid or mesh for every simulation, timestep and variable, in chunked memory-mapped files
+
+    Cells are described by the coordinates of their centers and stored in chunks of chunk_cells
+    cells that are close to each other: the bounding box of the grid is cut into tiles of about one
+    chunk each, and the cells are sorted by tile before being cut into chunks. The bounding box of
+    every chunk is kept, so a spatial query only reads the coordinates and values of the chunks it
+    overlaps.
+
+    Each variable is a file of shape (chunk, simulation, time, cell of the chunk). Inside a chunk,
+    the field of a simulation at a timestep is contiguous, and a cell's time series stays inside
+    one chunk. present marks the (variable, simulation, timestep) fields that were written; the
+    values of the others are undefined.
+
+    Cells are addressed by position, their index in storage order. Cell ids are their indices in
+    the order the grid was created with, which for regular grids is row by row.
+    """
+
+    def __init__(self, kind, shape, ensemble_names, ensemble_codes, names, timesteps, variables, x, y, cell_ids, chunk_bounds, chunk_cells, fields, present):
+        """Wraps arrays that are already sorted and aligned, see create and open
+
+        :param kind: regular or mesh
+        :type kind: str
+        :param shape: (rows, columns) of a regular grid, None for a mesh
+        :type shape: tuple
+        :param ensemble_names: the sorted ensemble names
+        :type ensemble_names: numpy.ndarray
+        :param ensemble_codes: the position in ensemble_names of the ensemble of each simulation
+        :type ensemble_codes: numpy.ndarray
+        :param names: the sorted simulation names
+        :type names: numpy.ndarray
+        :param timesteps: the sorted timesteps
+        :type timesteps: numpy.ndarray
+        :param variables: the variable names
+        :type variables: list
+        :param x: x of the center of each cell, in storage order
+        :type x: numpy.ndarray
+        :param y: y of the center of each cell, in storage order
+        :type y: numpy.ndarray
+        :param cell_ids: id of each cell, in storage order
+        :type cell_ids: numpy.ndarray
+        :param chunk_bounds: (min_x, min_y, max_x, max_y) of the cells of each chunk
+        :type chunk_bounds: numpy.ndarray
+        :param chunk_cells: number of cells of each chunk, the last one is padded
+        :type chunk_cells: int
+        :param fields: one array of shape (chunk, simulation, time, cell of the chunk) per variable
+        :type fields: list
+        :param present: boolean array of shape (variable, simulation, time)
+        :type present: numpy.ndarray
+        """
+
+        self.kind = kind
+        self.shape = None if shape is None else tuple(int(size) for size in shape)
+        self.ensemble_names = np.asarray(ensemble_names, dtype=object)
+        self.ensemble_codes = np.asarray(ensemble_codes)
+        self.names = np.asarray(names, dtype=object)
+        self.timesteps = np.asarray(timesteps, dtype=np.float64)
+        self.variables = list(variables)
+        self.x = x
+        self.y = y
+        self.cell_ids = cell_ids
+        self.chunk_bounds = chunk_bounds
+        self.chunk_cells = int(chunk_cells)
+        self.fields = fields
+        self.present = present
+        self.time_index = {float(t): i for i, t in enumerate(self.timesteps)}
+        self.__position_of_id = None
+
+    @classmethod
+    def create(cls, directory, x, y, simulations, timesteps, variables, shape=None, chunk_cells=CHUNK_CELLS, dtype='float64'):
+        """Allocates an empty store in memory-mapped files, to be filled with write and finish
+
+        :param directory: new directory for the files
+        :type directory: str
+        :param x: x of the center of each cell, by cell id
+        :type x: numpy.ndarray
+        :param y: y of the center of each cell, by cell id
+        :type y: numpy.ndarray
+        :param simulations: (ensemble, name) of every simulation
+        :type simulations: list
+        :param timesteps: every timestep
+        :type timesteps: list
+        :param variables: the variable names
+        :type variables: list
+        :param shape: (rows, columns) of a regular grid whose cell ids go row by row, None for a mesh
+        :type shape: tuple
+        :param chunk_cells: number of cells of each chunk
+        :type chunk_cells: int
+        :param dtype: precision of the values, float64 or float32
+        :type dtype: str
+
+        :rtype: FieldStore
+        """
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(x) != len(y) or len(x) == 0:
+            raise Exception("ERROR: the grid needs the same number of x and y coordinates, and at least one cell.")
+        if shape is not None and shape[0] * shape[1] != len(x):
+            raise Exception("ERROR: a regular grid of shape %s does not have %s cells." % (tuple(shape), len(x)))
+        if dtype not in DTYPES:
+            raise Exception("Field dtype %s not yet implemented" % dtype)
+
+        os.makedirs(directory)
+        kind = 'mesh' if shape is None else 'regular'
+        simulations = sorted(simulations, key=lambda simulation: simulation[1])
+        names = np.array([name for _, name in simulations], dtype=object)
+        ensemble_codes, ensemble_names = pd.factorize(np.array([ensemble for ensemble, _ in simulations], dtype=object), sort=True)
+        timesteps = np.unique(np.asarray(timesteps, dtype=np.float64))
+        cell_ids = cls.spatial_order(x, y, chunk_cells)
+        x, y = x[cell_ids], y[cell_ids]
+        starts = np.arange(0, len(x), chunk_cells)
+        chunk_bounds = np.column_stack([
+            np.minimum.reduceat(x, starts), np.minimum.reduceat(y, starts),
+            np.maximum.reduceat(x, starts), np.maximum.reduceat(y, starts)
+        ])
+        np.savez(
+            os.path.join(directory, 'index.npz'),
+            kind=kind, shape=np.asarray(shape if shape is not None else [], dtype=np.int64),
+            ensemble_names=ensemble_names.astype(str), ensemble_codes=ensemble_codes, names=names.astype(str),
+            timesteps=timesteps, variables=np.asarray(variables, dtype=str), chunk_bounds=chunk_bounds, chunk_cells=chunk_cells
+        )
+        for name, values in (('x', x), ('y', y), ('cell_ids', cell_ids)):
+            np.save(os.path.join(directory, '%s.npy' % name), values)
+
+        # New files are sparse and read as zeros, unwritten fields are told apart by present
+        fields = [
+            np.lib.format.open_memmap(
+                os.path.join(directory, 'field-%d.npy' % variable), mode='w+', dtype=dtype,
+                shape=(len(starts), len(names), len(timesteps), chunk_cells)
+            )
+            for variable in range(len(variables))
+        ]
+        present = np.lib.format.open_memmap(
+            os.path.join(directory, 'present.npy'), mode='w+', dtype=bool, shape=(len(variables), len(names), len(timesteps))
+        )
+        return cls(
+            kind, shape, ensemble_names, ensemble_codes, names, timesteps, variables,
+            x, y, cell_ids, chunk_bounds, chunk_cells, fields, present
+        )
+
+    @classmethod
+    def open(cls, directory):
+        """Opens the read-only store written in a directory by create
+
+        :param directory: the directory of the files
+        :type directory: str
+
+        :rtype: FieldStore
+        """
+
+        with np.load(os.path.join(directory, 'index.npz')) as index:
+            variables = index['variables'].tolist()
+            return cls(
+                str(index['kind']), index['shape'] if len(index['shape']) else None,
+                index['ensemble_names'], index['ensemble_codes'], index['names'], index['timesteps'], variables,
+                np.load(os.path.join(directory, 'x.npy'), mmap_mode='r'),
+                np.load(os.path.join(directory, 'y.npy'), mmap_mode='r'),
+                np.load(os.path.join(directory, 'cell_ids.npy'), mmap_mode='r'),
+                index['chunk_bounds'], int(index['chunk_cells']),
+                [np.load(os.path.join(directory, 'field-%d.npy' % variable), mmap_mode='r') for variable in range(len(variables))],
+                np.load(os.path.join(directory, 'present.npy'), mmap_mode='r')
+            )
+
+    @staticmethod
+    def spatial_order(x, y, chunk_cells):
+        """Returns the cell ids sorted so that consecutive runs of chunk_cells cells are close to each other
+
+        The bounding box is cut into about one tile per chunk, with tiles as square as the box
+        allows, and cells are sorted by tile, row by row, keeping their order inside a tile.
+
+        :rtype: numpy.ndarray
+        """
+
+        width, height = np.ptp(x), np.ptp(y)
+        tiles = max(1, -(-len(x) // chunk_cells))
+        if width > 0 and height > 0:
+            columns = max(1, int(round(np.sqrt(tiles * width / height))))
+        else:
+            columns = tiles if width > 0 else 1
+        rows = max(1, -(-tiles // columns))
+        column = np.zeros(len(x), dtype=np.int64) if width == 0 else np.minimum(((x - x.min()) / width * columns).astype(np.int64), columns - 1)
+        row = np.zeros(len(y), dtype=np.int64) if height == 0 else np.minimum(((y - y.min()) / height * rows).astype(np.int64), rows - 1)
+        return np.argsort(row * columns + column, kind='stable')
+
+    def write(self, variable, simulation, timestep, values):
+        """Writes the field of a simulation at a timestep into a store allocated by create
+
+        :param variable: the variable name
+        :type variable: str
+        :param simulation: the simulation name
+        :type simulation: str
+        :param timestep: the timestep
+        :type timestep: float
+        :param values: the value of each cell, by cell id
+        :type values: numpy.ndarray
+        """
+
+        v = self.variables.index(variable) if variable in self.variables else -1
+        s = int(np.searchsorted(self.names, simulation))
+        t = self.time_index.get(float(timestep), -1)
+        if v < 0 or s >= len(self.names) or self.names[s] != simulation or t < 0:
+            raise Exception("ERROR: field (%s, %s, %s) is not in the store." % (variable, simulation, timestep))
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) != len(self.x):
+            raise Exception("ERROR: the field has %s values for %s cells." % (len(values), len(self.x)))
+        padded = np.full(len(self.chunk_bounds) * self.chunk_cells, np.nan)
+        padded[:len(values)] = values[self.cell_ids]
+        self.fields[v][:, s, t, :] = padded.reshape(len(self.chunk_bounds), self.chunk_cells)
+        self.present[v, s, t] = True
+
+    def finish(self):
+        """Writes the files of a store allocated by create
+        """
+
+        for field in self.fields:
+            field.flush()
+        self.present.flush()
+
+    @property
+    def bounds(self):
+        """(min_x, min_y, max_x, max_y) of the cell centers
+
+        :rtype: tuple
+        """
+
+        return (
+            float(self.chunk_bounds[:, 0].min()), float(self.chunk_bounds[:, 1].min()),
+            float(self.chunk_bounds[:, 2].max()), float(self.chunk_bounds[:, 3].max())
+        )
+
+    @property
+    def spacing(self):
+        """(dx, dy) between the centers of neighbouring cells of a regular grid, None for a mesh
+
+        :rtype: tuple
+        """
+
+        if self.shape is None:
+            return None
+        min_x, min_y, max_x, max_y = self.bounds
+        rows, columns = self.shape
+        return (
+            (max_x - min_x) / (columns - 1) if columns > 1 else 0.0,
+            (max_y - min_y) / (rows - 1) if rows > 1 else 0.0
+        )
+
+    def select(self, ensemble_list=None, simulation_list=None):
+        """Returns a boolean mask of the simulations that pass the filters
+
+        :param ensemble_list: ensembles to be included, all if empty
+        :type ensemble_list: list
+        :param simulation_list: simulations to be included, all if empty
+        :type simulation_list: list
+
+        :rtype: numpy.ndarray
+        """
+
+        mask = np.ones(len(self.names), dtype=bool)
+        if ensemble_list:
+            mask &= np.isin(self.ensemble_names, list(ensemble_list))[self.ensemble_codes]
+        if simulation_list:
+            mask &= np.isin(self.names, list(simulation_list))
+        return mask
+
+    def ensembles_of(self, simulations):
+        """Returns the ensemble name of each selected simulation
+
+        :param simulations: boolean mask or indices of simulations
+        :type simulations: numpy.ndarray
+
+        :rtype: numpy.ndarray
+        """
+
+        return self.ensemble_names[self.ensemble_codes[simulations]]
+
+    def rows_at(self, variable, timestep, simulations=None):
+        """Returns the indices of the simulations with a field of the variable at a timestep
+
+        :param variable: the variable name
+        :type variable: str
+        :param timestep: the timestep
+        :type timestep: float
+        :param simulations: boolean mask of the simulations, all if None
+        :type simulations: numpy.ndarray
+
+        :rtype: numpy.ndarray
+        """
+
+        present = self.present[self.variables.index(variable), :, self.time_index[timestep]]
+        return np.flatnonzero(present if simulations is None else present & simulations)
+
+    def positions_in_bbox(self, bbox):
+        """Returns the positions of the cells whose center is inside a bounding box, reading only the chunks it overlaps
+
+        :param bbox: (min_x, min_y, max_x, max_y)
+        :type bbox: tuple
+
+        :rtype: numpy.ndarray
+        """
+
+        min_x, min_y, max_x, max_y = bbox
+        chunks = np.flatnonzero(
+            (self.chunk_bounds[:, 0] <= max_x) & (self.chunk_bounds[:, 2] >= min_x)
+            & (self.chunk_bounds[:, 1] <= max_y) & (self.chunk_bounds[:, 3] >= min_y)
+        )
+        positions = [np.arange(k * self.chunk_cells, min((k + 1) * self.chunk_cells, len(self.x))) for k in chunks]
+        positions = np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+        x, y = self.x[positions], self.y[positions]
+        return positions[(x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)]
+
+    def positions_in_region(self, polygon):
+        """Returns the positions of the cells whose center is inside a polygon
+
+        :param polygon: the (x, y) vertices of the polygon, which is closed from the last vertex to the first
+        :type polygon: numpy.ndarray
+
+        :rtype: numpy.ndarray
+        """
+
+        polygon = np.asarray(polygon, dtype=np.float64)
+        positions = self.positions_in_bbox((*polygon.min(axis=0), *polygon.max(axis=0)))
+        x, y = self.x[positions], self.y[positions]
+        # Even-odd rule: count the edges crossed by a ray going right from each center
+        inside = np.zeros(len(positions), dtype=bool)
+        for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, axis=0)):
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+        return positions[inside]
+
+    def nearest_position(self, x, y):
+        """Returns the position of the cell whose center is the nearest to a point, reading the chunks from the nearest
+
+        :param x: x of the point
+        :type x: float
+        :param y: y of the point
+        :type y: float
+
+        :rtype: int
+        """
+
+        # Distance from the point to the bounding box of each chunk, a lower bound for its cells
+        dx = np.maximum(np.maximum(self.chunk_bounds[:, 0] - x, x - self.chunk_bounds[:, 2]), 0.0)
+        dy = np.maximum(np.maximum(self.chunk_bounds[:, 1] - y, y - self.chunk_bounds[:, 3]), 0.0)
+        lower_bounds = dx ** 2 + dy ** 2
+        best, best_distance = -1, np.inf
+        for k in np.argsort(lower_bounds, kind='stable'):
+            if lower_bounds[k] > best_distance:
+                break
+            start = k * self.chunk_cells
+            distances = (self.x[start:start + self.chunk_cells] - x) ** 2 + (self.y[start:start + self.chunk_cells] - y) ** 2
+            nearest = int(np.argmin(distances))
+            if distances[nearest] < best_distance:
+                best, best_distance = start + nearest, distances[nearest]
+        return best
+
+    def position_of(self, cell_id):
+        """Returns the position of a cell id, or -1 if there is no such cell
+
+        :param cell_id: the cell id
+        :type cell_id: int
+
+        :rtype: int
+        """
+
+        if self.__position_of_id is None:
+            self.__position_of_id = np.argsort(self.cell_ids)
+        return int(self.__position_of_id[cell_id]) if 0 <= cell_id < len(self.cell_ids) else -1
+
+    def iter_field(self, variable, rows, timestep, positions):
+        """Reads the fields of some simulations at a timestep, one chunk of cells at a time
+
+        :param variable: the variable name
+        :type variable: str
+        :param rows: indices of simulations with a field at the timestep, see rows_at
+        :type rows: numpy.ndarray
+        :param timestep: the timestep
+        :type timestep: float
+        :param positions: sorted positions of the cells
+        :type positions: numpy.ndarray
+
+        :returns: for each chunk, the positions read and a float64 matrix with one row per simulation and one column per position
+        :rtype: generator
+        """
+
+        field = self.fields[self.variables.index(variable)]
+        t = self.time_index[timestep]
+        chunks = positions // self.chunk_cells
+        starts = np.flatnonzero(np.concatenate([[True], chunks[1:] != chunks[:-1]])) if len(positions) else []
+        for start, stop in zip(starts, list(starts[1:]) + [len(positions)]):
+            k = chunks[start]
+            offsets = positions[start:stop] - k * self.chunk_cells
+            yield positions[start:stop], field[k, rows, t][:, offsets].astype(np.float64)
+
+    def reduce_field(self, variable, rows, timestep, positions, reduction):
+        """Reduces the fields of some simulations at a timestep to one value per cell, one chunk of cells at a time
+
+        :param variable: the variable name
+        :type variable: str
+        :param rows: indices of simulations with a field at the timestep, see rows_at
+        :type rows: numpy.ndarray
+        :param timestep: the timestep
+        :type timestep: float
+        :param positions: sorted positions of the cells
+        :type positions: numpy.ndarray
+        :param reduction: mean, median, min, max, std (with one degree of freedom) or range across the simulations
+        :type reduction: str
+
+        :returns: the value of each position, NaN where no simulation has a value
+        :rtype: numpy.ndarray
+        """
+
+        if reduction not in REDUCTIONS:
+            raise Exception("Field reduction %s not yet implemented" % reduction)
+        reduced = np.full(len(positions), np.nan)
+        if len(rows) == 0:
+            return reduced
+        done = 0
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for chunk_positions, block in self.iter_field(variable, rows, timestep, positions):
+                if reduction == 'mean':
+                    values = np.nanmean(block, axis=0)
+                elif reduction == 'median':
+                    values = np.nanmedian(block, axis=0)
+                elif reduction == 'min':
+                    values = np.nanmin(block, axis=0)
+                elif reduction == 'max':
+                    values = np.nanmax(block, axis=0)
+                elif reduction == 'std':
+                    values = np.nanstd(block, axis=0, ddof=1)
+                else:
+                    values = np.nanmax(block, axis=0) - np.nanmin(block, axis=0)
+                reduced[done:done + len(chunk_positions)] = values
+                done += len(chunk_positions)
+        return reduced
+
+    def read_series(self, variable, position, rows):
+        """Reads the time series of a cell for some simulations
+
+        :param variable: the variable name
+        :type variable: str
+        :param position: position of the cell
+        :type position: int
+        :param rows: indices of the simulations
+        :type rows: numpy.ndarray
+
+        :returns: a float64 matrix with one row per simulation and one column per timestep, NaN where a field is missing
+        :rtype: numpy.ndarray
+        """
+
+        v = self.variables.index(variable)
+        k, offset = divmod(int(position), self.chunk_cells)
+        series = self.fields[v][k, rows, :, offset].astype(np.float64)
+        series[~self.present[v][rows]] = np.nan
+        return series
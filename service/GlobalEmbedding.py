@@ -0,0 +1,128 @@
+from service import DimensionalReduction
+import copy
+import numpy as np
+import os
+import pickle
+import threading
+
+class GlobalEmbedding:
+    """A scaler and reducer fitted once on every simulation of a timestep, with the resulting coordinates
+
+    Requests for a subset of simulations only look up their rows, so every view shares the same
+    coordinates and no request pays for a fit. When the dataset changes, new or changed simulations
+    are projected with the fitted reducer instead of refitting it, into a new embedding, so an
+    embedding is never changed once requests can read it.
+    """
+
+    def __init__(self, method, parameters, fingerprint, names, data):
+        """Fits the scaler and the reducer on all simulations
+
+        :param method: the dimensional reduction method, PCA or UMAP
+        :type method: str
+        :param parameters: keyword arguments for the reducer
+        :type parameters: dict
+        :param fingerprint: version of the dataset the data comes from
+        :type fingerprint: str
+        :param names: the simulation name of each row
+        :type names: list
+        :param data: a matrix with one row per simulation and one column per variable
+        :type data: numpy.ndarray
+        """
+
+        self.method = method
+        self.parameters = dict(parameters)
+        self.fingerprint = fingerprint
+        from sklearn.preprocessing import StandardScaler
+        self.scaler = StandardScaler().fit(data)
+        self.reducer = DimensionalReduction.create_reducer(method, parameters)
+        self.__set_rows(names, data, self.reducer.fit_transform(self.scaler.transform(data)))
+
+    def __set_rows(self, names, data, coordinates):
+        self.names = list(names)
+        self.data = data
+        self.coordinates = coordinates
+        self.__row_index = {name: idx for idx, name in enumerate(self.names)}
+
+    def can_update(self, data):
+        """Tells whether rows with the shape of data can be projected by the fitted reducer
+
+        :param data: a matrix with one row per simulation and one column per variable
+        :type data: numpy.ndarray
+
+        :rtype: bool
+        """
+
+        return data.shape[1] == self.data.shape[1]
+
+    def update(self, fingerprint, names, data):
+        """Returns a new embedding of the simulations of a new dataset version, without refitting
+
+        Simulations whose values did not change keep their coordinates, and the new or changed
+        ones are projected with the transform of the fitted scaler and reducer, which both
+        embeddings share.
+
+        :param fingerprint: version of the dataset the data comes from
+        :type fingerprint: str
+        :param names: the simulation name of each row
+        :type names: list
+        :param data: a matrix with one row per simulation and one column per variable
+        :type data: numpy.ndarray
+
+        :rtype: GlobalEmbedding
+        """
+
+        coordinates = np.empty((len(names), self.coordinates.shape[1]))
+        changed_rows = []
+        for row, name in enumerate(names):
+            idx = self.__row_index.get(name)
+            if idx is not None and np.array_equal(self.data[idx], data[row]):
+                coordinates[row] = self.coordinates[idx]
+            else:
+                changed_rows.append(row)
+        if changed_rows:
+            coordinates[changed_rows] = self.reducer.transform(self.scaler.transform(data[changed_rows]))
+        embedding = copy.copy(self)
+        embedding.fingerprint = fingerprint
+        embedding.__set_rows(names, data, coordinates)
+        return embedding
+
+    def lookup(self, names):
+        """Returns the coordinates of some simulations
+
+        :param names: names of the simulations
+        :type names: list
+
+        :returns: a matrix with the coordinates of each simulation, in the same order as names
+        :rtype: numpy.ndarray
+        """
+
+        return self.coordinates[[self.__row_index[name] for name in names]]
+
+    def save(self, filename):
+        """Stores the fitted embedding in a file, replacing it atomically
+
+        :param filename: path of the file
+        :type filename: str
+        """
+
+        # Concurrent saves each write their own temporary file
+        tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+        with open(tmp_filename, 'wb') as embedding_file:
+            pickle.dump(self, embedding_file)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def load(filename):
+        """Loads an embedding stored by save
+
+        :param filename: path of the file
+        :type filename: str
+
+        :returns: the embedding, or None if the file does not exist
+        :rtype: GlobalEmbedding
+        """
+
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as embedding_file:
+            return pickle.load(embedding_file)
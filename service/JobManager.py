@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from uuid import uuid4
+import multiprocessing
+import time
+
+class JobManager:
+    """Runs expensive computations as jobs and keeps track of them
+
+    Each job is identified by a key describing the computation. Submitting a key that already has
+    a job in flight returns the existing job before anything runs, so identical requests share one
+    computation. A job runs in a thread of this process, where it can read the data it needs a
+    chunk at a time, and sends its CPU-bound parts to a process pool with run_in_process. The size
+    of both pools limits how many computations run at the same time. Workers are spawned rather
+    than forked, since forking a server with running threads can copy locks held by those threads.
+    """
+
+    def __init__(self, max_workers=2, max_jobs=1000):
+        """Creates the thread and process pools
+
+        :param max_workers: maximum number of computations running at the same time
+        :type max_workers: int
+        :param max_jobs: maximum number of finished jobs kept before discarding the oldest
+        :type max_jobs: int
+        """
+
+        self.max_jobs = max_jobs
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.__processes = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        self.__jobs = OrderedDict()
+        self.__in_flight = {}
+        self.__lock = Lock()
+
+    def submit(self, key, function, *args, finalize=None):
+        """Submits a computation, unless a job with the same key is in flight
+
+        :param key: hashable description of the computation
+        :type key: hashable
+        :param function: function executed in a job thread
+        :type function: callable
+        :param args: arguments of the function
+        :type args: tuple
+        :param finalize: function executed with the result of the function, whose return is the job result
+        :type finalize: callable
+
+        :returns: the id of the job
+        :rtype: str
+        """
+
+        with self.__lock:
+            job_id = self.__in_flight.get(key)
+            if job_id is not None:
+                return job_id
+            job_id = uuid4().hex
+            future = self.__executor.submit(function, *args)
+            self.__jobs[job_id] = {
+                "key": key,
+                "future": future,
+                "finalize": finalize,
+                "status": "pending",
+                "result": None,
+                "error": None,
+                "submitted_at": time.time(),
+                "finished_at": None,
+            }
+            self.__in_flight[key] = job_id
+        future.add_done_callback(lambda done: self.__finish(job_id, done))
+        return job_id
+
+    def run_in_process(self, function, *args):
+        """Runs a function in the process pool and waits for its result, e.g. from a job thread
+
+        :param function: picklable function executed in a worker process
+        :type function: callable
+        :param args: picklable arguments of the function
+        :type args: tuple
+
+        :returns: the result of the function
+        :rtype: object
+        """
+
+        return self.__processes.submit(function, *args).result()
+
+    def complete(self, key, result):
+        """Registers a job that is already finished, e.g. when its result was cached
+
+        :param key: hashable description of the computation
+        :type key: hashable
+        :param result: the result of the job
+        :type result: object
+
+        :returns: the id of the job
+        :rtype: str
+        """
+
+        job_id = uuid4().hex
+        now = time.time()
+        with self.__lock:
+            self.__jobs[job_id] = {
+                "key": key,
+                "future": None,
+                "finalize": None,
+                "status": "done",
+                "result": result,
+                "error": None,
+                "submitted_at": now,
+                "finished_at": now,
+            }
+            self.__discard_old_jobs()
+        return job_id
+
+    def get(self, job_id):
+        """Returns the state of a job
+
+        :param job_id: the id of the job
+        :type job_id: str
+
+        :returns: a dict with status (pending, running, done or failed), result and error, or None if the job is unknown
+        :rtype: dict
+        """
+
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            if job is None:
+                return None
+            status = job["status"]
+            if status == "pending" and job["future"].running():
+                status = "running"
+            return {
+                "job_id": job_id,
+                "status": status,
+                "result": job["result"],
+                "error": job["error"],
+                "submitted_at": job["submitted_at"],
+                "finished_at": job["finished_at"],
+            }
+
+    def shutdown(self):
+        """Stops the worker processes, cancelling computations that did not start
+        """
+
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        self.__processes.shutdown(wait=False, cancel_futures=True)
+
+    def __finish(self, job_id, future):
+        """Stores the result of a computation, executed when its future is done
+        """
+
+        with self.__lock:
+            job = self.__jobs[job_id]
+            finalize = job["finalize"]
+        try:
+            result = future.result()
+            if finalize is not None:
+                result = finalize(result)
+            status, error = "done", None
+        except Exception as e:
+            result, status, error = None, "failed", str(e)
+        with self.__lock:
+            job.update(status=status, result=result, error=error, finished_at=time.time(), future=None, finalize=None)
+            if self.__in_flight.get(job["key"]) == job_id:
+                del self.__in_flight[job["key"]]
+            self.__discard_old_jobs()
+
+    def __discard_old_jobs(self):
+        """Removes the oldest finished jobs while there are more than max_jobs, must hold the lock
+        """
+
+        finished = [job_id for job_id, job in self.__jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_jobs)]:
+            del self.__jobs[job_id]
@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+from threading import Lock, local
+import time
+
+# Upper bounds in seconds of the histogram buckets, the last bucket counts everything above them
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_histograms = {}
+_counters = {}
+_lock = Lock()
+_request = local()
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the quantile, or the largest value for the last bucket
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                **{"le_%g" % bound: count for bound, count in zip(BUCKETS, self.buckets)},
+                "inf": self.buckets[-1]
+            }
+        }
+
+def observe(name, seconds, stage=None):
+    """Adds a duration to a histogram and, inside a request, to the time of one of its stages
+
+    :param name: name of the histogram
+    :type name: str
+    :param seconds: the duration
+    :type seconds: float
+    :param stage: stage of the current request the duration belongs to, if any
+    :type stage: str
+    """
+
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram()
+        histogram.observe(seconds)
+    stages = getattr(_request, "stages", None)
+    if stage is not None and stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+def increment(name, value=1):
+    """Adds a value to a counter
+
+    :param name: name of the counter
+    :type name: str
+    :param value: the amount added
+    :type value: int
+    """
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+@contextmanager
+def timer(name, stage=None):
+    """Measures the block and adds its duration to a histogram, see observe
+
+    :param name: name of the histogram
+    :type name: str
+    :param stage: stage of the current request the duration belongs to, if any
+    :type stage: str
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, stage)
+
+def stage(name):
+    """Measures one stage of the current request, recorded in the histogram stage.<name>
+
+    Stages with the same name in a request add up, and stages may be nested, so the durations of a
+    request do not need to add up to its total.
+
+    :param name: name of the stage, which must be a valid Server-Timing metric name
+    :type name: str
+    """
+
+    return timer("stage." + name, name)
+
+def start_request():
+    """Starts collecting the stages measured by the calling thread
+    """
+
+    _request.stages = {}
+
+def end_request():
+    """Stops collecting the stages of the calling thread
+
+    :returns: the seconds spent in each stage, in the order they started
+    :rtype: dict
+    """
+
+    stages = getattr(_request, "stages", None)
+    _request.stages = None
+    return stages or {}
+
+def server_timing(stages):
+    """Formats stage durations as the value of a Server-Timing header
+
+    :param stages: the seconds spent in each stage
+    :type stages: dict
+
+    :returns: the header value, with durations in milliseconds
+    :rtype: str
+    """
+
+    return ", ".join("%s;dur=%.3f" % (name, seconds * 1000) for name, seconds in stages.items())
+
+def snapshot():
+    """Returns every counter and a summary of every histogram
+
+    Metrics are kept per process, so each worker of a multi-process server reports its own.
+
+    :returns: a dict with counters and histograms, by name
+    :rtype: dict
+    """
+
+    with _lock:
+        return {
+            "counters": dict(sorted(_counters.items())),
+            "histograms": {name: histogram.snapshot() for name, histogram in sorted(_histograms.items())}
+        }
+
+def reset():
+    """Removes every counter and histogram
+    """
+
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from threading import Lock
+
+_MISSING = object()
+
+class ResultCache:
+    """A bounded cache with least recently used eviction and hit/miss counters
+
+    It is shared by the request threads of the server, so every access is done holding a lock.
+    Keys need to be hashable, so lists of filters should be converted to sorted tuples.
+    """
+
+    def __init__(self, maxsize=128):
+        """Creates an empty cache
+
+        :param maxsize: maximum number of entries kept before evicting the least recently used
+        :type maxsize: int
+        """
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key, default=None):
+        """Returns the value stored for a key and marks it as the most recently used
+
+        :param key: the key of the entry
+        :type key: hashable
+        :param default: value returned when the key is not in the cache
+        :type default: object
+
+        :returns: the cached value or default
+        :rtype: object
+        """
+
+        with self.__lock:
+            value = self.__entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used entries if the cache is full
+
+        :param key: the key of the entry
+        :type key: hashable
+        :param value: the value to be stored
+        :type value: object
+        """
+
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Returns the value stored for a key, computing and storing it on a miss
+
+        The lock is not held while computing, so two threads missing the same key at the same
+        time may both compute it.
+
+        :param key: the key of the entry
+        :type key: hashable
+        :param compute: function without arguments that returns the value
+        :type compute: callable
+
+        :returns: the cached or computed value
+        :rtype: object
+        """
+
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """Removes every entry, keeping the hit/miss counters
+        """
+
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        """Returns the size of the cache and its hit/miss counters
+
+        :returns: a dict with size, maxsize, hits, misses and hit_rate
+        :rtype: dict
+        """
+
+        with self.__lock:
+            requests = self.hits + self.misses
+            return {
+                "size": len(self.__entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
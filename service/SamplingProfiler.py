@@ -0,0 +1,116 @@
+from collections import Counter, deque
+from threading import Event, Lock, Thread, get_ident
+import os
+import sys
+import time
+
+class SamplingProfiler:
+    """Samples the call stacks of request threads and keeps the profiles of the slow requests
+
+    A request thread is registered when the request starts. A single background thread wakes up
+    every interval while requests are running and records the current stack of each registered
+    thread, so a request is only slowed down by the sampling itself and not by tracing every call.
+    When a request ends, its samples are kept if it took longer than the threshold and discarded
+    otherwise. Stacks are kept in the collapsed format read by flame graph tools.
+    """
+
+    def __init__(self, threshold, interval=0.01, max_profiles=20, max_stacks=50):
+        """Creates the profiler, the sampling thread starts with the first request
+
+        :param threshold: seconds after which a request is kept as slow
+        :type threshold: float
+        :param interval: seconds between two samples
+        :type interval: float
+        :param max_profiles: maximum number of slow request profiles kept before discarding the oldest
+        :type max_profiles: int
+        :param max_stacks: maximum number of distinct stacks kept in each profile, the most sampled ones
+        :type max_stacks: int
+        """
+
+        self.threshold = threshold
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.__profiles = deque(maxlen=max_profiles)
+        self.__active = {}
+        self.__lock = Lock()
+        self.__wake = Event()
+        self.__thread = None
+
+    def begin(self):
+        """Starts sampling the calling thread
+        """
+
+        with self.__lock:
+            self.__active[get_ident()] = (time.perf_counter(), Counter())
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name="sampling-profiler", daemon=True)
+                self.__thread.start()
+        self.__wake.set()
+
+    def end(self, label):
+        """Stops sampling the calling thread, keeping its profile if the request was slow
+
+        :param label: description of the request, such as its method and path
+        :type label: str
+
+        :returns: the profile if the request was kept, otherwise None
+        :rtype: dict
+        """
+
+        with self.__lock:
+            started_at, stacks = self.__active.pop(get_ident(), (None, None))
+        if started_at is None:
+            return None
+        seconds = time.perf_counter() - started_at
+        if seconds < self.threshold:
+            return None
+        profile = {
+            "request": label,
+            "seconds": seconds,
+            "finished_at": time.time(),
+            "samples": sum(stacks.values()),
+            "interval": self.interval,
+            "stacks": [{"stack": stack, "count": count} for stack, count in stacks.most_common(self.max_stacks)]
+        }
+        with self.__lock:
+            self.__profiles.append(profile)
+        return profile
+
+    def profiles(self):
+        """Returns the kept profiles, the most recent first
+
+        :rtype: list
+        """
+
+        with self.__lock:
+            return list(reversed(self.__profiles))
+
+    def __run(self):
+        while True:
+            # Samples are added holding the lock, so a profile is complete once end removed its thread
+            with self.__lock:
+                idle = not self.__active
+                if not idle:
+                    frames = sys._current_frames()
+                    for thread_id, (_, stacks) in self.__active.items():
+                        frame = frames.get(thread_id)
+                        if frame is not None:
+                            stacks[self.__collapse(frame)] += 1
+                    del frames
+            if idle:
+                self.__wake.wait()
+                self.__wake.clear()
+            else:
+                time.sleep(self.interval)
+
+    @staticmethod
+    def __collapse(frame):
+        """Formats a stack from the outermost call to the innermost, separated by semicolons
+        """
+
+        calls = []
+        while frame is not None:
+            code = frame.f_code
+            calls.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+            frame = frame.f_back
+        return ";".join(reversed(calls))
@@ -0,0 +1,173 @@
+import json
+import struct
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+FORMATS = {
+    'json': 'application/json',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'binary': 'application/octet-stream',
+}
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+DTYPES = ['float64', 'float32']
+BINARY_ALIGNMENT = 8
+
+def available_formats():
+    """Returns the formats that can be produced with the installed libraries
+
+    :returns: names of the formats
+    :rtype: list
+    """
+
+    return [name for name in FORMATS if name != 'arrow' or pyarrow is not None]
+
+def negotiate_format(format_name, accept):
+    """Chooses the response format from the format parameter or, when it is missing, the Accept header
+
+    :param format_name: value of the format parameter, if any
+    :type format_name: str
+    :param accept: the parsed Accept header of the request
+    :type accept: werkzeug.datastructures.MIMEAccept
+
+    :returns: name of the format, or None if the requested format is not available
+    :rtype: str
+    """
+
+    formats = available_formats()
+    if format_name:
+        return format_name if format_name in formats else None
+    mimetype = accept.best_match([FORMATS[name] for name in formats], default=FORMATS['json'])
+    return next(name for name in formats if FORMATS[name] == mimetype)
+
+def dumps_json(data):
+    """Encodes data as JSON, using orjson when it is installed
+
+    NumPy arrays and scalars are encoded directly, without being converted to Python lists, and
+    NaN values are encoded as null.
+
+    :param data: dicts, lists and NumPy values to be encoded
+    :type data: object
+
+    :returns: the JSON document
+    :rtype: bytes
+    """
+
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(_finite(data), allow_nan=False).encode()
+
+def _finite(value):
+    """Converts NumPy values to Python ones, and NaN and infinite floats to None, which JSON cannot represent"""
+    if isinstance(value, dict):
+        return {_finite(key): _finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return _finite(value.tolist())
+    if isinstance(value, np.generic):
+        return _finite(value.item())
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+def serialize_table(table, format_name, dtype='float64'):
+    """Encodes a table in a columnar binary format
+
+    With arrow, the table is written as an Arrow IPC stream. With binary, the body starts with the
+    length of a JSON header as a little-endian uint32, followed by the header and by one buffer per
+    numeric column, little-endian and aligned to 8 bytes so they can be read as typed arrays without
+    copies. The header describes each column with its name, dtype, offset and length; text columns
+    are stored in the header itself as a list of values.
+
+    :param table: the table to be encoded
+    :type table: pandas.DataFrame
+    :param format_name: arrow or binary
+    :type format_name: str
+    :param dtype: precision of the numeric columns, float64 or float32
+    :type dtype: str
+
+    :returns: the encoded body and its mimetype
+    :rtype: tuple
+    """
+
+    if format_name == 'arrow':
+        return _serialize_arrow(table, dtype), FORMATS['arrow']
+    elif format_name == 'binary':
+        return _serialize_binary(table, dtype), FORMATS['binary']
+    else:
+        raise Exception("Serialization format %s not yet implemented" % format_name)
+
+def _serialize_arrow(table, dtype):
+    arrays = []
+    for column in table.columns:
+        values = table[column]
+        if values.dtype.kind in 'biuf':
+            arrays.append(pyarrow.array(values.to_numpy(dtype=dtype)))
+        else:
+            arrays.append(pyarrow.array(values.astype(str).tolist(), type=pyarrow.string()))
+    arrow_table = pyarrow.Table.from_arrays(arrays, names=[str(column) for column in table.columns])
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return sink.getvalue().to_pybytes()
+
+def _serialize_binary(table, dtype):
+    columns = []
+    buffers = []
+    offset = 0
+    for column in table.columns:
+        values = table[column]
+        if values.dtype.kind in 'biuf':
+            buffer = np.ascontiguousarray(values.to_numpy(dtype=dtype), dtype=np.dtype(dtype).newbyteorder('<')).tobytes()
+            padding = -len(buffer) % BINARY_ALIGNMENT
+            columns.append({"name": str(column), "dtype": dtype, "offset": offset, "length": len(values)})
+            buffers.append(buffer + b'\0' * padding)
+            offset += len(buffer) + padding
+        else:
+            columns.append({"name": str(column), "dtype": "utf8", "values": values.astype(str).tolist()})
+    header = json.dumps({"rows": len(table), "columns": columns}).encode()
+    # Pads the header so the first buffer starts aligned, counting the 4 bytes of its length
+    header += b' ' * (-(len(header) + 4) % BINARY_ALIGNMENT)
+    return struct.pack('<I', len(header)) + header + b''.join(buffers)
+
+def iter_frame_chunks(frames, format_name, columns):
+    """Encodes tables that are produced one at a time, e.g. built chunk by chunk from a larger array
+
+    :param frames: the tables to be encoded, with the same columns
+    :type frames: iterable
+    :param format_name: ndjson or csv
+    :type format_name: str
+    :param columns: the columns of the tables, for the csv header when there are no rows
+    :type columns: list
+
+    :returns: a generator of encoded chunks
+    :rtype: generator
+    """
+
+    if format_name not in STREAM_FORMATS:
+        raise Exception("Streaming format %s not yet implemented" % format_name)
+    header = True
+    for chunk in frames:
+        if chunk.empty:
+            continue
+        if format_name == 'ndjson':
+            lines = chunk.to_json(orient='records', lines=True)
+            yield lines if lines.endswith('\n') else lines + '\n'
+        else:
+            yield chunk.to_csv(index=False, header=header)
+            header = False
+    if header and format_name == 'csv':
+        yield ','.join(str(column) for column in columns) + '\n'
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+class SufficientStatistics:
+    """Counts, sums and cross-product matrices of the variables of one timestep, by ensemble
+
+    The Pearson matrix of any set of ensembles is built by adding up the statistics of those
+    ensembles, without touching the rows. Filters by simulation only need matrix products over the
+    selected rows. Data is shifted by the mean of the timestep to avoid cancellation errors
+    when computing covariances from the sums.
+
+    As in pandas.DataFrame.corr, missing values are left out pair by pair: the statistics of each
+    pair of variables only count the rows where both are present.
+    """
+
+    def __init__(self, ensembles, names, data):
+        """Computes the statistics of each ensemble
+
+        :param ensembles: the ensemble of each row
+        :type ensembles: list
+        :param names: the simulation name of each row
+        :type names: list
+        :param data: a matrix with one row per simulation and one column per variable, NaN where a value is missing
+        :type data: numpy.ndarray
+        """
+
+        self.ensembles = np.asarray(ensembles, dtype=object)
+        self.names = np.asarray(names, dtype=object)
+        present = ~np.isnan(data)
+        counts = present.sum(axis=0)
+        center = np.where(present, data, 0.0).sum(axis=0) / np.maximum(counts, 1)
+        self.data = data - center
+        self.complete = bool(present.all())
+        self.groups = {}
+        for ensemble in np.unique(self.ensembles):
+            self.groups[ensemble] = _statistics(self.data[self.ensembles == ensemble], self.complete)
+        self.__ranks = None
+
+    def pearson(self, ensemble_list, simulation_list):
+        """Returns the Pearson correlation matrix of the selected simulations
+
+        :param ensemble_list: ensembles to be included, all if empty
+        :type ensemble_list: list
+        :param simulation_list: simulations to be included, all if empty
+        :type simulation_list: list
+
+        :returns: a square matrix, with NaN for variables without variance
+        :rtype: numpy.ndarray
+        """
+
+        if simulation_list:
+            return _correlation(*_statistics(self.data[self.__select(ensemble_list, simulation_list)], self.complete))
+
+        columns = self.data.shape[1]
+        totals = [np.zeros((columns, columns)) for _ in range(4)]
+        for ensemble, statistics in self.groups.items():
+            if not ensemble_list or ensemble in ensemble_list:
+                for total, statistic in zip(totals, statistics):
+                    total += statistic
+        return _correlation(*totals)
+
+    def spearman(self, ensemble_list, simulation_list):
+        """Returns the Spearman correlation matrix of the selected simulations
+
+        Ranks of all simulations are computed once and reused when there is no filter. With missing
+        values, the ranks of each pair of variables depend on the rows where both are present, so
+        the matrix is computed pair by pair by pandas.
+
+        :param ensemble_list: ensembles to be included, all if empty
+        :type ensemble_list: list
+        :param simulation_list: simulations to be included, all if empty
+        :type simulation_list: list
+
+        :returns: a square matrix, with NaN for variables without variance
+        :rtype: numpy.ndarray
+        """
+
+        if not self.complete:
+            data = self.data
+            if ensemble_list or simulation_list:
+                data = data[self.__select(ensemble_list, simulation_list)]
+            return pd.DataFrame(data).corr(method='spearman').to_numpy()
+
+        # scipy.stats is slow to import and only needed here
+        from scipy.stats import rankdata
+        if not ensemble_list and not simulation_list:
+            if self.__ranks is None:
+                self.__ranks = rankdata(self.data, axis=0)
+            ranks = self.__ranks
+        else:
+            ranks = rankdata(self.data[self.__select(ensemble_list, simulation_list)], axis=0)
+        return _correlation(*_statistics(ranks, True))
+
+    def __select(self, ensemble_list, simulation_list):
+        mask = np.ones(len(self.data), dtype=bool)
+        if ensemble_list:
+            mask &= np.isin(self.ensembles, ensemble_list)
+        if simulation_list:
+            mask &= np.isin(self.names, simulation_list)
+        return mask
+
+def _statistics(rows, complete):
+    """Returns the count, sums, sums of squares and cross products of each pair of variables
+
+    Entry [i, j] of the counts is the number of rows where variables i and j are both present, and
+    entry [i, j] of the sums and of the sums of squares only adds variable i over those rows.
+    Without missing values they are the same for every j, and only the cross products need a
+    matrix product.
+    """
+
+    if complete:
+        columns = rows.shape[1]
+        counts = np.full((columns, columns), float(len(rows)))
+        sums = np.repeat(rows.sum(axis=0)[:, None], columns, axis=1)
+        cross_products = rows.T @ rows
+        squares = np.repeat(np.diag(cross_products)[:, None], columns, axis=1)
+        return counts, sums, squares, cross_products
+    present = (~np.isnan(rows)).astype(np.float64)
+    values = np.where(present > 0, rows, 0.0)
+    return present.T @ present, values.T @ present, (values * values).T @ present, values.T @ values
+
+def _correlation(counts, sums, squares, cross_products):
+    """Builds a Pearson correlation matrix from the pairwise statistics of the rows
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = cross_products - sums * sums.T / counts
+        variance = squares - sums * sums / counts
+        # A constant variable can be left with a rounding error instead of a variance of 0
+        variance[variance <= squares * 1e-12] = 0.0
+        correlation = np.clip(covariance / np.sqrt(variance * variance.T), -1.0, 1.0)
+    correlation[(counts < 2) | (variance <= 0) | (variance.T <= 0)] = np.nan
+    diagonal = np.diag_indices_from(correlation)
+    correlation[diagonal] = np.where(np.isnan(correlation[diagonal]), np.nan, 1.0)
+    return correlation
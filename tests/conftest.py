@@ -0,0 +1,38 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ENV = "DB_DRIVER=sqlite\nLOAD_MODE=incremental\nSNAPSHOT_FILENAME=\nEMBEDDING_DIRECTORY=\nREFRESH_INTERVAL=0\n"
+
+def load_script(name):
+    """Imports a script of the repository whose file name is not a module name, e.g. database-load"""
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Runs the test in an empty directory, with a .env pointing to a SQLite database of its own"""
+    from db import Model
+    (tmp_path / '.env').write_text(ENV)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(Model.config, 'DB_DRIVER', 'sqlite')
+    # Connections of the pool are opened in the working directory of the test that opened them
+    monkeypatch.setattr(Model, '_pool', None)
+    return tmp_path
+
+@pytest.fixture
+def loader(database):
+    """The database-load script, configured by the .env of the test directory"""
+    return load_script('database-load')
+
+@pytest.fixture(scope='session')
+def synthetic_ensemble():
+    """The generator of synthetic ensembles of benchmark.py"""
+    return load_script('benchmark').createSyntheticEnsemble
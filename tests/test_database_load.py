@@ -0,0 +1,57 @@
+from model import CellData, Ensemble, LoadManifest, Simulation, Variable
+
+def expected_cells(data):
+    cells = data.melt(id_vars=['ensemble', 'name', 'time'], var_name='variable', value_name='value')
+    return {
+        (ensemble, name, variable, float(time), float(value))
+        for ensemble, name, variable, time, value in cells[['ensemble', 'name', 'variable', 'time', 'value']].itertuples(index=False)
+    }
+
+def stored_cells():
+    cells = CellData.CellData().get_celldata_all_simulations()
+    assert CellData.CellData().get_fingerprint()[0] == len(cells)
+    return set(cells)
+
+def test_second_load_only_adds_new_cells(loader, synthetic_ensemble):
+    data = synthetic_ensemble(2, 3, 2, 6, seed=1)
+    # The second load brings new timesteps and a new simulation
+    first = data[(data['time'] < 4) & (data['name'] != 'simulation-1-2')]
+    loader.loadDataIntoDatabase(first, batch_size=5, mode='incremental')
+    before = stored_cells()
+    assert before == expected_cells(first)
+
+    loader.loadDataIntoDatabase(data, batch_size=5, mode='incremental')
+    after = stored_cells()
+    assert after == expected_cells(data)
+    assert len(after) == len(data) * 2
+    run = LoadManifest.LoadManifest().get_latest_run(loader.getDataFingerprint(data))
+    assert run[4] == len(after) - len(before)
+    assert run[5] == 'complete'
+    assert len(Ensemble.Ensemble().read_all()) == 2
+    assert len(Simulation.Simulation().read_all()) == 6
+    assert len(Variable.Variable().read_all()) == 2
+
+def test_loading_the_same_data_again_adds_nothing(loader, synthetic_ensemble):
+    data = synthetic_ensemble(2, 2, 3, 4, seed=2)
+    loader.loadDataIntoDatabase(data, mode='incremental')
+    loaded = stored_cells()
+    loader.loadDataIntoDatabase(data, mode='incremental')
+    loader.loadDataIntoDatabase(data.sample(frac=1.0, random_state=0), mode='incremental')
+    assert stored_cells() == loaded
+    assert len(Simulation.Simulation().read_all()) == 4
+
+def test_load_without_variables_does_nothing(loader, synthetic_ensemble):
+    data = synthetic_ensemble(1, 2, 1, 3)
+    loader.loadDataIntoDatabase(data[['ensemble', 'name', 'time']], mode='incremental')
+    assert stored_cells() == set()
+
+def test_streamed_cells_are_not_cut_by_other_queries(loader, synthetic_ensemble):
+    data = synthetic_ensemble(2, 3, 2, 5)
+    loader.loadDataIntoDatabase(data, mode='incremental')
+    streamed = []
+    for cells in CellData.CellData().iter_celldata_all_simulations(7):
+        # Queries of the caller between batches, as when the frame is built
+        Variable.Variable().read_all()
+        CellData.CellData().get_fingerprint()
+        streamed.extend(cells)
+    assert set(streamed) == expected_cells(data)
@@ -0,0 +1,90 @@
+import math
+
+import numpy as np
+import pytest
+
+from service import Downsampling
+
+def reference_lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets as published by Steinarsson, for a single series"""
+    n = len(x)
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        average_start = math.floor((i + 1) * every) + 1
+        average_stop = min(math.floor((i + 2) * every) + 1, n)
+        average_x = sum(x[average_start:average_stop]) / (average_stop - average_start)
+        average_y = sum(y[average_start:average_stop]) / (average_stop - average_start)
+        best, best_area = None, -1.0
+        for j in range(math.floor(i * every) + 1, math.floor((i + 1) * every) + 1):
+            area = abs((x[a] - average_x) * (y[j] - y[a]) - (x[a] - x[j]) * (average_y - y[a])) * 0.5
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+@pytest.mark.parametrize('length, max_points', [(10, 3), (11, 4), (100, 7), (1000, 50), (997, 333), (500, 499)])
+def test_lttb_matches_reference(length, max_points):
+    rng = np.random.default_rng(length)
+    x = np.cumsum(rng.uniform(0.5, 2.0, size=length))
+    y = np.cumsum(rng.normal(size=(4, length)), axis=1)
+    indices = Downsampling.downsample('lttb', x, y, max_points)
+    assert indices.shape == (4, max_points)
+    for series, selected in zip(y, indices):
+        assert selected.tolist() == reference_lttb(x.tolist(), series.tolist(), max_points)
+
+@pytest.mark.parametrize('method', Downsampling.METHODS)
+@pytest.mark.parametrize('max_points', [5, 6, 100])
+def test_series_shorter_than_max_points_are_kept(method, max_points):
+    x = np.arange(5.0)
+    y = np.array([[1.0, np.nan, 3.0, 2.0, 0.0], [0.0, 1.0, 0.0, 1.0, 0.0]])
+    indices = Downsampling.downsample(method, x, y, max_points)
+    np.testing.assert_array_equal(indices, [np.arange(5), np.arange(5)])
+
+def test_min_max_keeps_extremes_of_each_bucket():
+    rng = np.random.default_rng(1)
+    x = np.arange(103.0)
+    y = rng.normal(size=(3, 103))
+    indices = Downsampling.downsample('minmax', x, y, 20)
+    assert indices.shape == (3, 20)
+    assert (np.diff(indices, axis=1) >= 0).all()
+    edges = np.linspace(0, 103, 11).astype(int)
+    for series, selected in zip(y, indices):
+        for bucket, (start, stop) in enumerate(zip(edges[:-1], edges[1:])):
+            chosen = series[selected[2 * bucket:2 * bucket + 2]]
+            assert sorted(chosen) == [series[start:stop].min(), series[start:stop].max()]
+
+def test_min_max_skips_missing_values():
+    x = np.arange(12.0)
+    y = np.array([
+        [np.nan, 5.0, 1.0, np.nan, 2.0, 9.0, -1.0, np.nan, np.nan, np.nan, np.nan, np.nan],
+    ])
+    indices = Downsampling.downsample('minmax', x, y, 6)[0]
+    # Buckets [0, 4), [4, 8) and [8, 12), the last one has no value at all
+    assert sorted(y[0, indices[:2]]) == [1.0, 5.0]
+    assert sorted(y[0, indices[2:4]]) == [-1.0, 9.0]
+    assert np.isnan(y[0, indices[4:]]).all()
+
+def test_lttb_skips_missing_values():
+    rng = np.random.default_rng(2)
+    x = np.arange(60.0)
+    y = np.cumsum(rng.normal(size=(4, 60)), axis=1)
+    y[0, 10:15] = np.nan
+    # Missing last point, so the last bucket has no average to aim at
+    y[1, 1::2] = np.nan
+    # Missing first point, and a bucket without values
+    y[2, 0] = np.nan
+    y[2, 15:22] = np.nan
+    indices = Downsampling.downsample('lttb', x, y, 10)
+    assert (indices[:, 0] == 0).all() and (indices[:, -1] == 59).all()
+    assert (np.diff(indices, axis=1) > 0).all()
+    values = np.take_along_axis(y, indices, axis=1)
+    assert not np.isnan(values[[0, 3]]).any()
+    assert not np.isnan(values[1, :-1]).any()
+    assert np.isnan(values[2]).tolist() == [True, False, False, True] + [False] * 6
+    # Buckets after the one without values still form triangles with real points
+    clean = Downsampling.downsample('lttb', x, y[3:], 10)[0]
+    np.testing.assert_array_equal(indices[3], clean)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+def as_table(manager):
+    table = manager.current.cube.to_frame()
+    return table.sort_values(['ensemble', 'name', 'time']).reset_index(drop=True)
+
+def rebuild(app):
+    manager = app.DataFrameManager(snapshot_filename='')
+    manager.reload()
+    return manager
+
+@pytest.fixture
+def ensemble(synthetic_ensemble):
+    data = synthetic_ensemble(3, 4, 3, 8, seed=5)
+    # Cells missing from the first version too, so the cube has holes before and after the refresh
+    return data[np.random.default_rng(5).random(len(data)) > 0.1].reset_index(drop=True)
+
+@pytest.mark.parametrize('first_version', [
+    lambda data: data[(data['time'] < 5) & (data['name'] != 'simulation-2-3')],
+    lambda data: data.drop(columns=['variable-2']),
+], ids=['new timesteps and simulation', 'new variable'])
+def test_delta_refresh_matches_full_rebuild(loader, ensemble, first_version):
+    loader.loadDataIntoDatabase(first_version(ensemble), mode='incremental')
+    import app
+    manager = rebuild(app)
+    # Statistics of the first version are kept or recomputed by the delta
+    for timestep in (1.0, 2.0):
+        manager.current.get_statistics(timestep)
+
+    loader.loadDataIntoDatabase(ensemble, mode='incremental')
+    assert manager.refresh()
+    assert manager.refresh_status["last_refresh"]["mode"] == 'delta'
+    assert manager.refresh_status["error"] is None
+
+    full = rebuild(app)
+    assert full.refresh_status["last_refresh"]["mode"] == 'full'
+    assert manager.current.fingerprint == full.current.fingerprint
+    assert manager.current.cube.variables == full.current.cube.variables
+    pd.testing.assert_frame_equal(as_table(manager), as_table(full))
+    for timestep in (1.0, 2.0, 6.0):
+        for method in ('pearson', 'spearman'):
+            np.testing.assert_allclose(
+                getattr(manager.current.get_statistics(timestep), method)([], []),
+                getattr(full.current.get_statistics(timestep), method)([], []),
+                rtol=1e-12, atol=1e-12
+            )
+
+def test_refresh_without_new_data_keeps_the_version(loader, ensemble):
+    loader.loadDataIntoDatabase(ensemble, mode='incremental')
+    import app
+    manager = rebuild(app)
+    current = manager.current
+    assert manager.refresh()
+    assert manager.current is current
+
+def test_refresh_sees_a_simulation_moved_to_another_ensemble(loader, ensemble):
+    loader.loadDataIntoDatabase(ensemble, mode='incremental')
+    import app
+    manager = rebuild(app)
+    moved = ensemble.copy()
+    moved.loc[moved['name'] == 'simulation-0-1', 'ensemble'] = 'ensemble-2'
+    loader.loadDataIntoDatabase(moved, mode='incremental')
+    assert manager.refresh()
+    assert manager.refresh_status["last_refresh"]["mode"] == 'full'
+    cube = manager.current.cube
+    assert cube.ensembles_of(np.flatnonzero(cube.names == 'simulation-0-1')).tolist() == ['ensemble-2']
+    pd.testing.assert_frame_equal(as_table(manager), as_table(rebuild(app)))
+
+def test_refresh_sees_values_replaced_without_new_cells(loader, ensemble):
+    loader.loadDataIntoDatabase(ensemble, mode='replace')
+    import app
+    manager = rebuild(app)
+    replaced = ensemble.copy()
+    replaced['variable-0'] += 1.0
+    loader.loadDataIntoDatabase(replaced, mode='replace')
+    assert manager.refresh()
+    assert manager.refresh_status["last_refresh"]["mode"] == 'full'
+    table = as_table(manager)
+    expected = replaced.sort_values(['ensemble', 'name', 'time'])['variable-0'].to_numpy()
+    np.testing.assert_array_equal(table['variable-0'].to_numpy(), expected)
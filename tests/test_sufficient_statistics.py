@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from service.SufficientStatistics import SufficientStatistics
+
+METHODS = ['pearson', 'spearman']
+
+def make_statistics(data):
+    ensembles = ['ensemble-%d' % (row % 3) for row in range(len(data))]
+    names = ['simulation-%d' % row for row in range(len(data))]
+    return SufficientStatistics(ensembles, names, data), np.array(ensembles), np.array(names)
+
+def assert_matches_pandas(matrix, data, method):
+    expected = pd.DataFrame(data).corr(method=method).to_numpy()
+    np.testing.assert_array_equal(np.isnan(matrix), np.isnan(expected))
+    np.testing.assert_allclose(matrix, expected, rtol=0, atol=1e-10, equal_nan=True)
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    # Variables far from 0 and with different scales, where sums of squares lose precision
+    return rng.normal(size=(60, 5)) * [1.0, 1e3, 0.1, 1.0, 5.0] + [0.0, 1e6, -3.0, 0.0, 100.0]
+
+@pytest.mark.parametrize('method', METHODS)
+def test_matches_pandas(data, method):
+    statistics, _, _ = make_statistics(data)
+    assert_matches_pandas(getattr(statistics, method)([], []), data, method)
+
+@pytest.mark.parametrize('method', METHODS)
+def test_filters_match_pandas(data, method):
+    statistics, ensembles, names = make_statistics(data)
+    selected = np.isin(ensembles, ['ensemble-0', 'ensemble-2'])
+    assert_matches_pandas(getattr(statistics, method)(['ensemble-0', 'ensemble-2'], []), data[selected], method)
+    simulations = list(names[::4])
+    selected = np.isin(names, simulations) & (ensembles == 'ensemble-1')
+    assert_matches_pandas(getattr(statistics, method)(['ensemble-1'], simulations), data[selected], method)
+
+@pytest.mark.parametrize('method', METHODS)
+def test_missing_values_match_pandas(data, method):
+    data[3, 1] = np.nan
+    data[10:25, 2] = np.nan
+    data[::7, 4] = np.nan
+    # A variable present in a single row has no correlation
+    data[1:, 3] = np.nan
+    statistics, ensembles, _ = make_statistics(data)
+    assert_matches_pandas(getattr(statistics, method)([], []), data, method)
+    selected = ensembles == 'ensemble-1'
+    assert_matches_pandas(getattr(statistics, method)(['ensemble-1'], []), data[selected], method)
+
+@pytest.mark.parametrize('method', METHODS)
+def test_constant_variables_match_pandas(data, method):
+    data[:, 0] = 0.1
+    # Constant only within ensemble-0, whose rows are every third one
+    data[::3, 2] = 7.3
+    statistics, ensembles, _ = make_statistics(data)
+    matrix = getattr(statistics, method)([], [])
+    assert np.isnan(matrix[0]).all() and np.isnan(matrix[:, 0]).all()
+    assert_matches_pandas(matrix, data, method)
+    selected = ensembles == 'ensemble-0'
+    assert_matches_pandas(getattr(statistics, method)(['ensemble-0'], []), data[selected], method)